@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+import argparse
+import json
+import platform
+import random
+import statistics
+import string
+import sys
+import time
+from types import SimpleNamespace
+from rydz import Pricer, PostcodeRateBook, CompiledPostcodeRateBook, \
+  FlatRateDistanceRateBook, DistanceSource, Distance, validate_address, \
+  add_booking, BookingWriter
+
+# Synthetic data, seeded so that runs are comparable
+
+def uk_districts(rng, count):
+  districts=set()
+  while len(districts)<count:
+    districts.add(''.join(rng.choice(string.ascii_uppercase) for i in range(2))+
+                  str(rng.randint(1, 99)))
+  return sorted(districts)
+
+def uk_address(rng, districts):
+  return {'number': str(rng.randint(1, 300)),
+          'street': 'High Street',
+          'town': 'Teddington',
+          'postcode': '{} {}{}{}'.format(rng.choice(districts), rng.randint(0, 9),
+                                         rng.choice(string.ascii_uppercase),
+                                         rng.choice(string.ascii_uppercase)),
+          'country': 'UK'}
+
+def us_address(rng):
+  return {'number': str(rng.randint(1, 9999)),
+          'street': 'Main Street',
+          'postcode': '{:05d}'.format(rng.randint(501, 99950)),
+          'country': 'US'}
+
+def rate_map(rng, districts, density=0.2):
+  return {origin: {destination: round(rng.uniform(10, 150), 2)
+                   for destination in districts if rng.random()<density}
+          for origin in districts}
+
+def journeys(rng, districts, count):
+  return [{'origin': uk_address(rng, districts),
+           'destination': uk_address(rng, districts)} for i in range(count)]
+
+def booking(rng, districts):
+  return {'origin': uk_address(rng, districts),
+          'destination': uk_address(rng, districts),
+          'pickup_time': '2017-09-{:02d} {:02d}:{:02d}'.format(rng.randint(1, 30),
+                                                               rng.randint(0, 23),
+                                                               rng.randint(0, 59)),
+          'passengers': ['a.passenger@acompany.com'],
+          'booker': 'booker{}@acompany.com'.format(rng.randint(1, 500))}
+
+
+class StubDistance(DistanceSource):
+  def distance(self, origin, destination):
+    return Distance('5.0 mi', 8046.72, '15 mins', 900)
+
+
+class MemoryCollection:
+  def __init__(self):
+    self.rows={}
+
+  def insert(self, doc):
+    doc['_id']=len(self.rows)+1
+    self.rows[doc['_id']]=dict(doc)
+    return doc['_id']
+
+  def insert_one(self, doc):
+    return SimpleNamespace(inserted_id=self.insert(doc))
+
+  def insert_many(self, docs, ordered=True):
+    return SimpleNamespace(inserted_ids=[self.insert(doc) for doc in docs])
+
+  def find_one(self, query):
+    return self.rows.get(query.get('_id'))
+
+  def create_index(self, keys):
+    return '_'.join('{}_{}'.format(field, order) for field, order in keys)
+
+
+# Benchmarks: each takes (rng, scale) and returns (function, operations per
+# call). Set-up cost is kept outside the timed function.
+
+def bench_quote_postcode(rng, scale):
+  districts=uk_districts(rng, scale)
+  pricer=Pricer(PostcodeRateBook(rate_map(rng, districts)))
+  batch=journeys(rng, districts, 1000)
+  return lambda: [pricer.quote(j) for j in batch], len(batch)
+
+def bench_quote_compiled(rng, scale):
+  districts=uk_districts(rng, scale)
+  pricer=Pricer(CompiledPostcodeRateBook(rate_map(rng, districts)))
+  batch=journeys(rng, districts, 1000)
+  return lambda: [pricer.quote(j) for j in batch], len(batch)
+
+def bench_quote_many_compiled(rng, scale):
+  districts=uk_districts(rng, scale)
+  pricer=Pricer(CompiledPostcodeRateBook(rate_map(rng, districts)))
+  batch=journeys(rng, districts, 1000)
+  return lambda: pricer.quote_many(batch), len(batch)
+
+def bench_quote_flat_rate(rng, scale):
+  districts=uk_districts(rng, scale)
+  pricer=Pricer(FlatRateDistanceRateBook(StubDistance(), 200))
+  batch=journeys(rng, districts, 1000)
+  return lambda: [pricer.quote(j) for j in batch], len(batch)
+
+def bench_validate_uk(rng, scale):
+  addresses=[uk_address(rng, uk_districts(rng, 50)) for i in range(1000)]
+  return lambda: [validate_address(a) for a in addresses], len(addresses)
+
+def bench_validate_us(rng, scale):
+  addresses=[us_address(rng) for i in range(1000)]
+  return lambda: [validate_address(a) for a in addresses], len(addresses)
+
+def bench_add_booking(rng, scale):
+  districts=uk_districts(rng, 50)
+  bookings=[booking(rng, districts) for i in range(1000)]
+  def run():
+    collection=MemoryCollection()
+    for b in bookings:
+      add_booking(collection, dict(b))
+  return run, len(bookings)
+
+def bench_add_booking_write_behind(rng, scale):
+  districts=uk_districts(rng, 50)
+  bookings=[booking(rng, districts) for i in range(1000)]
+  def run():
+    collection=MemoryCollection()
+    writer=BookingWriter(collection, id_factory=iter(range(1, 2**62)).__next__)
+    for b in bookings:
+      add_booking(collection, dict(b), writer)
+    writer.close()
+  return run, len(bookings)
+
+def centroid_source(rng, districts):
+  # the area grows with the number of districts, as it would going from one
+  # city to a whole region, so driver density stays realistic
+  from rydz_geo import CentroidDistance
+  span=0.4*(len(districts)/500)**0.5
+  return CentroidDistance({d: (51.3+rng.random()*span, -0.5+rng.random()*2*span)
+                           for d in districts})
+
+def bench_dispatch_nearest(rng, scale):
+  from rydz_dispatch import Dispatcher
+  districts=uk_districts(rng, scale)
+  dispatcher=Dispatcher(centroid_source(rng, districts))
+  for i in range(scale*10):
+    dispatcher.add_driver(i, uk_address(rng, districts))
+  pickups=[{'origin': uk_address(rng, districts)} for i in range(1000)]
+  return lambda: [dispatcher.nearest_drivers(p, 8) for p in pickups], len(pickups)
+
+def bench_dispatch_assign(rng, scale):
+  # scale*10 drivers and scale*5 bookings spread over a day of 15 minute windows
+  from rydz_dispatch import Dispatcher
+  districts=uk_districts(rng, scale)
+  source=centroid_source(rng, districts)
+  drivers=[uk_address(rng, districts) for i in range(scale*10)]
+  bookings=[dict(booking(rng, districts), _id=i) for i in range(scale*5)]
+  def run():
+    dispatcher=Dispatcher(source)
+    for i, address in enumerate(drivers):
+      dispatcher.add_driver(i, address)
+    dispatcher.assign(bookings)
+  return run, len(bookings)
+
+def bench_pool(rng, scale):
+  # scale*5 bookings from 50 origin areas over a day, so buckets are busy
+  from rydz_pool import Pooler
+  districts=uk_districts(rng, scale)
+  source=centroid_source(rng, districts)
+  origins=districts[:50]
+  bookings=[dict(booking(rng, districts), _id=i, origin=uk_address(rng, origins))
+            for i in range(scale*5)]
+  def run():
+    Pooler(FlatRateDistanceRateBook(source, 200), source).propose(bookings)
+  return run, len(bookings)
+
+class BenchmarkFailed(Exception):
+  pass
+
+def check_response(response):
+  # a benchmark that times error responses measures nothing useful
+  body=response.get_json(silent=True)
+  if response.status_code!=200 or not isinstance(body, dict) or body.get('status')!='OK':
+    raise BenchmarkFailed('{} {}'.format(response.status, response.get_data(as_text=True)[:200]))
+
+def rest_client(collection):
+  import rydz_rest
+  rydz_rest.mongo=SimpleNamespace(db=SimpleNamespace(bookings=collection))
+  return rydz_rest.app.test_client()
+
+def bench_rest_quote(rng, scale):
+  client=rest_client(MemoryCollection())
+  journey={'origin': {'postcode': 'TW11 1AB', 'country': 'UK'},
+           'destination': {'postcode': 'RM14 2QY', 'country': 'UK'}}
+  check_response(client.get('/quote', json=journey))
+  return lambda: [client.get('/quote', json=journey) for i in range(200)], 200
+
+def bench_rest_bookings(rng, scale):
+  client=rest_client(MemoryCollection())
+  journey={'origin': {'postcode': 'TW11 1AB', 'country': 'UK'},
+           'destination': {'postcode': 'RM14 2QY', 'country': 'UK'}}
+  bookings=[dict(booking(rng, ['TW11']), **{'destination': uk_address(rng, ['RM14'])})
+            for i in range(200)]
+  check_response(client.post('/bookings', json=dict(bookings[0])))
+  return lambda: [client.post('/bookings', json=b) for b in bookings], len(bookings)
+
+benchmarks={'quote_postcode': bench_quote_postcode,
+            'quote_compiled': bench_quote_compiled,
+            'quote_many_compiled': bench_quote_many_compiled,
+            'quote_flat_rate': bench_quote_flat_rate,
+            'validate_uk': bench_validate_uk,
+            'validate_us': bench_validate_us,
+            'add_booking': bench_add_booking,
+            'add_booking_write_behind': bench_add_booking_write_behind,
+            'dispatch_nearest': bench_dispatch_nearest,
+            'dispatch_assign': bench_dispatch_assign,
+            'pool': bench_pool,
+            'rest_quote': bench_rest_quote,
+            'rest_bookings': bench_rest_bookings}
+
+def run_benchmark(name, scale, repeat, seed):
+  try:
+    function, operations=benchmarks[name](random.Random(seed), scale)
+  except ImportError as e:
+    return {'skipped': str(e)}
+  except BenchmarkFailed as e:
+    return {'failed': str(e)}
+  timings=[]
+  for i in range(repeat):
+    started=time.perf_counter()
+    function()
+    timings.append((time.perf_counter()-started)/operations)
+  return {'best_us': min(timings)*1e6,
+          'median_us': statistics.median(timings)*1e6,
+          'operations': operations,
+          'repeat': repeat}
+
+def run(names, scale, repeat, seed):
+  return {'python': platform.python_version(),
+          'scale': scale,
+          'seed': seed,
+          'benchmarks': {name: run_benchmark(name, scale, repeat, seed)
+                         for name in names}}
+
+def compare(baseline, results, threshold):
+  regressions=[]
+  for name, result in results['benchmarks'].items():
+    before=baseline['benchmarks'].get(name, {})
+    if 'best_us' not in result or 'best_us' not in before:
+      continue
+    change=result['best_us']/before['best_us']-1
+    result['change']=change
+    if change>threshold:
+      regressions.append(name)
+  return regressions
+
+def main(argv=None):
+  parser=argparse.ArgumentParser(description='Benchmark rydz hot paths')
+  parser.add_argument('names', nargs='*', help='benchmarks to run (default all)')
+  parser.add_argument('--scale', type=int, default=2000,
+                      help='number of postcode districts in generated rate books')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--output', help='write JSON results to this file')
+  parser.add_argument('--compare', help='JSON results of an earlier run')
+  parser.add_argument('--threshold', type=float, default=0.1,
+                      help='slow-down that counts as a regression (0.1 is 10%%)')
+  args=parser.parse_args(argv)
+
+  unknown=set(args.names)-set(benchmarks)
+  if unknown:
+    parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+  results=run(args.names or list(benchmarks), args.scale, args.repeat, args.seed)
+  regressions=[]
+  if args.compare:
+    with open(args.compare) as baseline:
+      regressions=compare(json.load(baseline), results, args.threshold)
+  failed=[]
+  for name, result in results['benchmarks'].items():
+    if 'skipped' in result:
+      print('{:22} skipped: {}'.format(name, result['skipped']))
+      continue
+    if 'failed' in result:
+      print('{:22} FAILED: {}'.format(name, result['failed']))
+      failed.append(name)
+      continue
+    line='{:22} {:10.2f} us/op  (median {:.2f})'.format(name, result['best_us'],
+                                                        result['median_us'])
+    if 'change' in result:
+      line+='  {:+.1%}{}'.format(result['change'],
+                                 '  REGRESSION' if name in regressions else '')
+    print(line)
+  if args.output:
+    with open(args.output, 'w') as out:
+      json.dump(results, out, indent=2)
+  return 1 if regressions or failed else 0
+
+if __name__=='__main__':
+  sys.exit(main())
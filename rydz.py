@@ -1,12 +1,31 @@
 #!/usr/local/bin/python3
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urlsplit
 #from urllib.request import urlopen
 import urllib.request
+import hashlib
+import http.client
 import json
+import queue
 import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from rydz_metrics import metrics
+try:
+  from bson import ObjectId
+except ImportError:
+  ObjectId=None
 
 def address_str(address):
+  if type(address) is Address:
+    return address.text
   return ', '.join(filter(lambda x : x is not None,
                    [address.get('number', None), address.get('street', None),
                     address.get('town', None), address.get('postcode', None),
@@ -16,14 +35,156 @@ def postcode_area_us(address):
   return address['postcode'][:3]
 
 def postcode_area_uk(address):
-  return address['postcode'].split(' ')[0]
+  return address['postcode'].partition(' ')[0]
 
 postcode_area_by_country={'UK': postcode_area_uk,
                           'US': postcode_area_us}
 
 def postcode_area(address):
+  if type(address) is Address and address.area is not None:
+    return address.area
   return postcode_area_by_country[address['country']](address)
 
+
+# Slotted records for the wire format. They read like the dicts they replace
+# (a missing or None field is simply absent), so everything that takes an
+# address or booking dict takes these too, and to_json() gives back plain dicts.
+# Fields outside the known set are kept in extra for a lossless round trip.
+class WireModel(Mapping):
+  __slots__=()
+  fields=()
+
+  def __getitem__(self, key):
+    if key in self.field_set:
+      value=getattr(self, key)
+      if value is not None:
+        return value
+    elif self.extra is not None and key in self.extra:
+      return self.extra[key]
+    raise KeyError(key)
+
+  def get(self, key, default=None):
+    if key in self.field_set:
+      value=getattr(self, key)
+      return default if value is None else value
+    if self.extra is not None:
+      return self.extra.get(key, default)
+    return default
+
+  def __contains__(self, key):
+    return self.get(key) is not None
+
+  def __iter__(self):
+    for field in self.fields:
+      if getattr(self, field) is not None:
+        yield field
+    if self.extra is not None:
+      yield from self.extra
+
+  def __len__(self):
+    return sum(1 for key in self)
+
+  def __repr__(self):
+    return '{}({!r})'.format(type(self).__name__, self.to_json())
+
+  def to_json(self):
+    wire={}
+    for field in self.fields:
+      value=getattr(self, field)
+      if value is not None:
+        wire[field]=value.to_json() if isinstance(value, WireModel) else value
+    if self.extra is not None:
+      wire.update(self.extra)
+    return wire
+
+  @classmethod
+  def split_json(cls, data):
+    known={field: data[field] for field in cls.fields if field in data}
+    extra={key: value for key, value in data.items() if key not in cls.field_set}
+    return known, extra or None
+
+
+class Address(WireModel):
+  fields=('number', 'street', 'town', 'postcode', 'country')
+  field_set=frozenset(fields)
+  __slots__=fields+('extra', 'area', 'cached_text')
+
+  def __init__(self, number=None, street=None, town=None, postcode=None,
+               country=None, extra=None):
+    self.number=number
+    self.street=street
+    self.town=town
+    self.postcode=postcode
+    self.country=country
+    self.extra=extra
+    self.cached_text=None
+    try:
+      # areas repeat across millions of addresses, so share one string each
+      self.area=sys.intern(postcode_area_by_country[country](self))
+    except (KeyError, TypeError, AttributeError):
+      # postcode_area() falls back to the dict path and reports the problem
+      self.area=None
+
+  @property
+  def text(self):
+    if self.cached_text is None:
+      self.cached_text=', '.join(part for part in (self.number, self.street,
+                                                   self.town, self.postcode,
+                                                   self.country)
+                                 if part is not None)
+    return self.cached_text
+
+  @classmethod
+  def from_json(cls, data):
+    if isinstance(data, cls):
+      return data
+    known, extra=cls.split_json(data)
+    return cls(extra=extra, **known)
+
+
+def address_or_none(data):
+  return None if data is None else Address.from_json(data)
+
+
+class Journey(WireModel):
+  fields=('origin', 'destination')
+  field_set=frozenset(fields)
+  __slots__=fields+('extra',)
+
+  def __init__(self, origin=None, destination=None, extra=None):
+    self.origin=address_or_none(origin)
+    self.destination=address_or_none(destination)
+    self.extra=extra
+
+  @classmethod
+  def from_json(cls, data):
+    if isinstance(data, cls):
+      return data
+    known, extra=cls.split_json(data)
+    return cls(extra=extra, **known)
+
+
+class Booking(WireModel):
+  fields=('origin', 'destination', 'pickup_time', 'passengers', 'booker')
+  field_set=frozenset(fields)
+  __slots__=fields+('extra',)
+
+  def __init__(self, origin=None, destination=None, pickup_time=None,
+               passengers=None, booker=None, extra=None):
+    self.origin=address_or_none(origin)
+    self.destination=address_or_none(destination)
+    self.pickup_time=pickup_time
+    self.passengers=passengers
+    self.booker=booker
+    self.extra=extra
+
+  @classmethod
+  def from_json(cls, data):
+    if isinstance(data, cls):
+      return data
+    known, extra=cls.split_json(data)
+    return cls(extra=extra, **known)
+
 class RydzException(Exception):
   pass
 
@@ -32,15 +193,11 @@ class InvalidAddressException(RydzException):
   pass
 
 
-def validate_uk_address(address):
-  try:
-    address['number']
-    address['town']
-    address['street']
-    if re.fullmatch(r'[A-Z]{2}[0-9]{1,2} [0-9][A-Z]{2}', address['postcode']) is None:
-      raise InvalidAddressException("'postcode'")
-  except KeyError as ke:
-    raise InvalidAddressException(str(ke))
+class InvalidBookingException(RydzException):
+  def __init__(self, errors):
+    RydzException.__init__(self, error_message(errors[0]))
+    self.errors=errors
+
 
 us_states={'AL': ('Alabama', 'Ala.'),
            'AK': ('Alaska', 'Alaska'),
@@ -102,54 +259,373 @@ us_states={'AL': ('Alabama', 'Ala.'),
            'WI': ('Wisconsin', 'Wis.'),
            'WY': ('Wyoming', 'Wyo.')}
 
+# Fields are checked in the order listed, so the first error reported matches
+# the field-by-field checks these schemas replaced.
+address_schemas={'UK': {'required': ('number', 'town', 'street'),
+                        'postcode': r'[A-Z]{2}[0-9]{1,2} [0-9][A-Z]{2}'},
+                 'US': {'required': ('number', 'street'),
+                        'postcode': r'[0-9]{5}'}}
+
+booking_schema={'addresses': ('origin', 'destination'),
+                'times': ('pickup_time',),
+                'required': ('booker', 'passengers')}
+
+PICKUP_TIME_FORMAT='%Y-%m-%d %H:%M'
+pickup_time_pattern=re.compile(r'([0-9]{4})-([0-9]{2})-([0-9]{2}) ([0-9]{2}):([0-9]{2})')
+
+def parse_pickup_time(value):
+  match=pickup_time_pattern.fullmatch(value) if isinstance(value, str) else None
+  if match is not None:
+    try:
+      return datetime(*map(int, match.groups()))
+    except ValueError:
+      pass
+  # strptime handles the unusual forms and gives the familiar error messages
+  return datetime.strptime(value, PICKUP_TIME_FORMAT)
+
+def error_message(e):
+  if isinstance(e, KeyError):
+    return '{} missing'.format(e)
+  return str(e)
+
+def compile_address_schema(schema):
+  required=tuple(schema['required'])
+  postcode_match=re.compile(schema['postcode']).fullmatch
+  def address_errors(address):
+    errors=[InvalidAddressException(repr(field))
+            for field in required if field not in address]
+    postcode=address.get('postcode')
+    if not isinstance(postcode, str) or postcode_match(postcode) is None:
+      errors.append(InvalidAddressException("'postcode'"))
+    return errors
+  return address_errors
+
+address_error_checks={country: compile_address_schema(schema)
+                      for country, schema in address_schemas.items()}
+
+def address_errors(address):
+  if not isinstance(address, Mapping):
+    return [InvalidAddressException('address must be an object')]
+  if 'country' not in address:
+    return [InvalidAddressException("'country'")]
+  country=address['country']
+  check=address_error_checks.get(country) if isinstance(country, str) else None
+  if check is None:
+    return [InvalidAddressException('Unsupported country: {!r}'.format(address['country']))]
+  return check(address)
+
+def compile_booking_schema(schema):
+  addresses=tuple(schema['addresses'])
+  times=tuple(schema['times'])
+  required=tuple(schema['required'])
+  def booking_errors(booking):
+    if not isinstance(booking, Mapping):
+      return [ValueError('booking must be an object')]
+    errors=[]
+    for field in addresses:
+      if field in booking:
+        errors.extend(address_errors(booking[field]))
+      else:
+        errors.append(KeyError(field))
+    for field in times:
+      if field in booking:
+        try:
+          parse_pickup_time(booking[field])
+        except (ValueError, TypeError) as e:
+          errors.append(e)
+      else:
+        errors.append(KeyError(field))
+    errors.extend(KeyError(field) for field in required if field not in booking)
+    return errors
+  return booking_errors
+
+booking_errors=compile_booking_schema(booking_schema)
+
+def compile_update_schema(schema):
+  # the same checks as a new booking, applied only to the fields being changed
+  addresses=frozenset(schema['addresses'])
+  times=frozenset(schema['times'])
+  required=frozenset(schema['required'])
+  def update_errors(changes):
+    if not isinstance(changes, Mapping):
+      return [ValueError('changes must be an object')]
+    errors=[]
+    for field, value in changes.items():
+      if field in addresses:
+        errors.extend(address_errors(value))
+      elif field in times:
+        try:
+          parse_pickup_time(value)
+        except (ValueError, TypeError) as e:
+          errors.append(e)
+      elif field in required:
+        if value is None:
+          errors.append(KeyError(field))
+      else:
+        errors.append(ValueError('{!r} cannot be updated'.format(field)))
+    if not changes:
+      errors.append(ValueError('nothing to update'))
+    return errors
+  return update_errors
+
+update_errors=compile_update_schema(booking_schema)
+
+def raise_first(errors):
+  if errors:
+    raise errors[0]
+
+def validate_uk_address(address):
+  raise_first(address_error_checks['UK'](address))
+
 def is_usable_us_address(address):
-  #return ('state' not in address or address['state'] in us_states) and \
-  try:
-    address['number']
-    address['street']
-    if re.fullmatch(r'[0-9]{5}', address['postcode']) is None:
-      raise InvalidAddressException("'postcode'")
-  except KeyError as ke:
-    raise InvalidAddressException(str(ke))
+  raise_first(address_error_checks['US'](address))
 
 address_validators={'UK': validate_uk_address,
                     'US': is_usable_us_address}
 
 def validate_address(address):
-  try:
-    address_validators[address['country']](address)
-  except KeyError as ke:
-    if str(ke)=="'country'":
-      raise InvalidAddressException(str(ke))
-    else:
-      raise InvalidAddressException('Unsupported country: {}'.format(str(ke)))
+  raise_first(address_errors(address))
 
 def validate_booking(booking):
-  pass
+  errors=booking_errors(booking)
+  if errors:
+    raise InvalidBookingException(errors)
+
+def validate_many(records, errors_for=booking_errors):
+  return [[error_message(e) for e in errors_for(record)] for record in records]
 
 class MemberwiseEquality:
+  __slots__=()
+
+  def members(self):
+    # __dict__ for ordinary classes, the slot values for slotted ones
+    try:
+      return self.__dict__
+    except AttributeError:
+      return tuple(getattr(self, name) for name in self.__slots__)
+
   def __eq__(self, other):
     if isinstance(other, self.__class__):
-      return self.__dict__ == other.__dict__
+      return self.members() == other.members()
     return NotImplemented
 
   def __ne__(self, other):
     if isinstance(other, self.__class__):
-      return self.__dict__ != other.__dict__
+      return self.members() != other.members()
     return NotImplemented
 
 
 class PostcodeRateBook:
   def __init__(self, postcode_map):
     self.postcode_map=postcode_map
+    self.version=0
+
+  def set_price(self, origin_area, destination_area, price):
+    self.postcode_map.setdefault(origin_area, {})[destination_area]=price
+    self.version+=1
 
   def price(self, origin, destination):
     return self.postcode_map[postcode_area(origin)][postcode_area(destination)]
 
+  def pricing_key(self, origin, destination):
+    return (postcode_area(origin), postcode_area(destination))
+
+  def key_price(self, key):
+    return self.postcode_map[key[0]][key[1]]
+
+
+# Same prices as PostcodeRateBook, but with postcode areas interned to integer
+# indexes and rates held in a flat n*n array where NaN marks a missing rate.
+class CompiledPostcodeRateBook:
+  def __init__(self, postcode_map):
+    areas=list(postcode_map)
+    index={area:i for i, area in enumerate(areas)}
+    for row in postcode_map.values():
+      for area in row:
+        if area not in index:
+          index[area]=len(areas)
+          areas.append(area)
+    size=len(areas)
+    rates=array('d', [float('nan')])*(size*size)
+    for origin_area, row in postcode_map.items():
+      base=index[origin_area]*size
+      for destination_area, price in row.items():
+        rates[base+index[destination_area]]=price
+    self.set_table(areas, len(postcode_map), rates)
+
+  def set_table(self, areas, origin_count, rates):
+    # rates can be any sequence of floats indexed origin*size+destination,
+    # such as a memoryview over a memory-mapped rate file
+    self.areas=areas
+    self.index={area:i for i, area in enumerate(areas)}
+    self.size=len(areas)
+    self.rates=rates
+    self.origin_count=origin_count
+    # origin areas map straight to the start of their row and destination
+    # areas to their column, so a price is two dict lookups and an index
+    self.rows={area: i*self.size for i, area in enumerate(areas[:origin_count])}
+    self.columns=self.index
+    self.version=0
+
+  @classmethod
+  def from_table(cls, areas, origin_count, rates):
+    ratebook=cls.__new__(cls)
+    ratebook.set_table(areas, origin_count, rates)
+    return ratebook
+
+  def postcode_map(self):
+    size=self.size
+    return {origin_area: {self.areas[j]: self.rates[i*size+j]
+                          for j in range(size)
+                          if self.rates[i*size+j]==self.rates[i*size+j]}
+            for i, origin_area in enumerate(self.areas[:self.origin_count])}
+
+  def set_price(self, origin_area, destination_area, price):
+    row=self.rows.get(origin_area)
+    column=self.columns.get(destination_area)
+    if row is None or column is None:
+      # a new area changes the shape of the matrix, so recompile
+      postcode_map=self.postcode_map()
+      postcode_map.setdefault(origin_area, {})[destination_area]=price
+      version=self.version
+      self.__init__(postcode_map)
+      self.version=version
+    else:
+      if isinstance(self.rates, memoryview) and self.rates.readonly:
+        # a memory-mapped rate file is read-only, so the first change takes
+        # a private copy of the table
+        self.rates=array('d', self.rates)
+      self.rates[row+column]=price
+    self.version+=1
+
+  def area_price(self, origin_area, destination_area):
+    # a missing origin or destination raises KeyError for that area, as
+    # PostcodeRateBook does
+    price=self.rates[self.rows[origin_area]+self.columns[destination_area]]
+    if price!=price:
+      raise KeyError(destination_area)
+    return price
+
+  def price(self, origin, destination):
+    destination_area=postcode_area(destination)
+    price=self.rates[self.rows[postcode_area(origin)]+self.columns[destination_area]]
+    if price!=price:
+      raise KeyError(destination_area)
+    return price
+
+  def pricing_key(self, origin, destination):
+    return (postcode_area(origin), postcode_area(destination))
+
+  def key_price(self, key):
+    return self.area_price(key[0], key[1])
+
+  def price_many(self, origins, destinations):
+    # one result per pair: the price, or the KeyError price() would raise
+    rows=self.rows
+    columns=self.columns
+    rates=self.rates
+    results=[]
+    append=results.append
+    for origin, destination in zip(origins, destinations):
+      try:
+        destination_area=postcode_area(destination)
+        price=rates[rows[postcode_area(origin)]+columns[destination_area]]
+        append(price if price==price else KeyError(destination_area))
+      except KeyError as e:
+        append(e)
+    return results
+
+def normalised_postcode(postcode):
+  return ' '.join(postcode.upper().split())
+
+def uk_prefix_boundaries(postcode):
+  # area ("TW"), district ("TW11"), sector ("TW11 9") and full postcode, so
+  # that a "TW1" rule never matches "TW11"
+  area=len(postcode)-len(postcode.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+  district=postcode.find(' ')
+  if district<0:
+    return {area, len(postcode)}
+  return {area, district, district+2, len(postcode)}
+
+def us_prefix_boundaries(postcode):
+  return set(range(1, len(postcode)+1))
+
+prefix_boundaries_by_country={'UK': uk_prefix_boundaries,
+                              'US': us_prefix_boundaries}
+
+
+# Rates keyed on postcode prefixes of any granularity, e.g. {'TW11 9': {'NW':
+# 20.0}, 'TW': {'NW': 25.0}}. Each side resolves to its most specific matching
+# prefix, with the origin taking precedence.
+class PrefixRateBook:
+  def __init__(self, rules):
+    self.origins={}
+    self.version=0
+    for origin_prefix, row in rules.items():
+      for destination_prefix, price in row.items():
+        self.add_rule(origin_prefix, destination_prefix, price)
+
+  def add_rule(self, origin_prefix, destination_prefix, price):
+    # trie nodes map characters to child nodes; the '' key holds the payload
+    node=self.origins
+    for c in normalised_postcode(origin_prefix):
+      node=node.setdefault(c, {})
+    node=node.setdefault('', {})
+    for c in normalised_postcode(destination_prefix):
+      node=node.setdefault(c, {})
+    node['']=price
+
+  def set_price(self, origin_prefix, destination_prefix, price):
+    self.add_rule(origin_prefix, destination_prefix, price)
+    self.version+=1
+
+  def walk(self, node, address):
+    # every rule along the address's postcode, least specific first
+    postcode=normalised_postcode(address['postcode'])
+    boundaries=prefix_boundaries_by_country[address['country']](postcode)
+    found=[]
+    for depth, c in enumerate(postcode):
+      if depth in boundaries and '' in node:
+        found.append((postcode[:depth], node['']))
+      node=node.get(c)
+      if node is None:
+        return found
+    if '' in node:
+      found.append((postcode, node['']))
+    return found
+
+  def match(self, origin, destination):
+    origin_rules=self.walk(self.origins, origin)
+    for origin_prefix, destinations in reversed(origin_rules):
+      destination_rules=self.walk(destinations, destination)
+      if destination_rules:
+        destination_prefix, price=destination_rules[-1]
+        return price, origin_prefix, destination_prefix
+    if not origin_rules:
+      raise KeyError(postcode_area(origin))
+    raise KeyError(postcode_area(destination))
+
+  def price(self, origin, destination):
+    return self.match(origin, destination)[0]
+
+  def price_detail(self, origin, destination):
+    price, origin_prefix, destination_prefix=self.match(origin, destination)
+    return price, {'rule': {'origin': origin_prefix,
+                            'destination': destination_prefix}}
+
+
+class DistanceException(RydzException):
+  pass
+
+
 class DistanceSource:
   def distance(self, origin, destination):
     pass
 
+  def distance_many(self, origins, destinations):
+    return [self.distance(origin, destination)
+            for origin, destination in zip(origins, destinations)]
+
 
 class FlatRateDistanceRateBook:
   def __init__(self, distance_source, rate_pence_per_mile):
@@ -157,7 +633,12 @@ class FlatRateDistanceRateBook:
     self.distance_source=distance_source
 
   def price(self, origin, destination):
-    return self.rate * self.distance_source.distance(origin, destination)
+    return self.rate * float(self.distance_source.distance(origin, destination))
+
+  def price_many(self, origins, destinations):
+    return [self.rate * float(distance)
+            for distance in self.distance_source.distance_many(origins,
+                                                               destinations)]
 
 
 class GoogleDistanceURL:
@@ -165,74 +646,990 @@ class GoogleDistanceURL:
     self.key=key
 
   def url(self, origin, destination):
+    return self.matrix_url([origin], [destination])
+
+  def matrix_url(self, origins, destinations):
     return 'https://maps.googleapis.com/maps/api/distancematrix/json?' +\
-            urlencode({'units': 'imperial', 'origins': address_str(origin),
-                       'destinations': address_str(destination), 'key': self.key}) 
+            urlencode({'units': 'imperial',
+                       'origins': '|'.join(map(address_str, origins)),
+                       'destinations': '|'.join(map(address_str, destinations)),
+                       'key': self.key})
+
 
+METRES_PER_MILE=1609.344
 
 class Distance(MemberwiseEquality):
+  __slots__=('dist_text', 'dist_value', 'time_text', 'time_value')
+
   def __init__(self, dist_text, dist_value, time_text, time_value):
     self.dist_text=dist_text
     self.dist_value=dist_value
     self.time_text=time_text
     self.time_value=time_value
 
+  def __float__(self):
+    # dist_value is in metres, rate books price per mile
+    return self.dist_value/METRES_PER_MILE
 
-class GoogleDistance:
-  def __init__(self, key):
+  def __repr__(self):
+    return 'Distance({!r}, {!r}, {!r}, {!r})'.format(self.dist_text, self.dist_value,
+                                                     self.time_text, self.time_value)
+
+  @classmethod
+  def from_values(cls, metres, seconds):
+    return cls('{:.1f} mi'.format(metres/METRES_PER_MILE), metres,
+               '{} mins'.format(int(round(seconds/60))), seconds)
+
+
+class UrlopenTransport:
+  def get_json(self, url):
+    with urllib.request.urlopen(url) as response:
+      return json.loads(response.read())
+
+
+class PooledHTTPTransport:
+  def __init__(self, pool_size=4, connect_timeout=3.0, read_timeout=10.0,
+               retries=3, backoff=0.2, sleep=time.sleep):
+    self.pool_size=pool_size
+    self.connect_timeout=connect_timeout
+    self.read_timeout=read_timeout
+    self.retries=retries
+    self.backoff=backoff
+    self.sleep=sleep
+    self.pools={}
+    self.lock=threading.Lock()
+    self.connections_opened=0
+
+  def pool(self, scheme, netloc):
+    with self.lock:
+      key=(scheme, netloc)
+      if key not in self.pools:
+        self.pools[key]=queue.LifoQueue(self.pool_size)
+      return self.pools[key]
+
+  def connect(self, scheme, netloc):
+    if scheme=='https':
+      connection=http.client.HTTPSConnection(netloc, timeout=self.connect_timeout)
+    else:
+      connection=http.client.HTTPConnection(netloc, timeout=self.connect_timeout)
+    connection.connect()
+    connection.sock.settimeout(self.read_timeout)
+    self.connections_opened+=1
+    return connection
+
+  def release(self, pool, connection):
+    try:
+      pool.put_nowait(connection)
+    except queue.Full:
+      connection.close()
+
+  def request(self, scheme, netloc, path):
+    pool=self.pool(scheme, netloc)
+    try:
+      connection=pool.get_nowait()
+    except queue.Empty:
+      connection=self.connect(scheme, netloc)
+    try:
+      connection.request('GET', path, headers={'Connection': 'keep-alive'})
+      response=connection.getresponse()
+      body=response.read()
+    except (OSError, http.client.HTTPException):
+      connection.close()
+      raise
+    if response.will_close:
+      connection.close()
+    else:
+      self.release(pool, connection)
+    return response.status, body
+
+  def get_json(self, url):
+    parts=urlsplit(url)
+    path=parts.path+('?'+parts.query if parts.query else '')
+    for attempt in range(self.retries+1):
+      last_attempt=attempt==self.retries
+      try:
+        status, body=self.request(parts.scheme, parts.netloc, path)
+      except (OSError, http.client.HTTPException):
+        if last_attempt:
+          raise
+      else:
+        if status<500:
+          if status>=400:
+            raise DistanceException('HTTP {} from {}'.format(status, parts.netloc))
+          json_response=json.loads(body)
+          if json_response.get('status')!='OVER_QUERY_LIMIT' or last_attempt:
+            return json_response
+        elif last_attempt:
+          raise DistanceException('HTTP {} from {}'.format(status, parts.netloc))
+      self.sleep(self.backoff*2**attempt)
+
+  def close(self):
+    with self.lock:
+      for pool in self.pools.values():
+        while not pool.empty():
+          pool.get_nowait().close()
+
+
+def chunks(items, size):
+  for i in range(0, len(items), size):
+    yield items[i:i+size]
+
+
+class GoogleDistance(DistanceSource):
+  # Distance Matrix API limits per request
+  max_origins=25
+  max_destinations=25
+  max_elements=100
+
+  def __init__(self, key, transport=None):
     self.url=GoogleDistanceURL(key)
+    self.transport=UrlopenTransport() if transport is None else transport
+
+  def fetch(self, url):
+    return self.transport.get_json(url)
 
   def distance(self, origin, destination):
-    with urllib.request.urlopen(self.url.url(origin, destination)) as response:
-      json_response=json.loads(response.read());
-      distance=json_response['rows'][0]['elements'][0]['distance']
-      duration=json_response['rows'][0]['elements'][0]['duration']
-      return Distance(distance['text'], distance['value'],
-                      duration['text'], duration['value'])
+    json_response=self.fetch(self.url.url(origin, destination))
+    distance=json_response['rows'][0]['elements'][0]['distance']
+    duration=json_response['rows'][0]['elements'][0]['duration']
+    return Distance(distance['text'], distance['value'],
+                    duration['text'], duration['value'])
+
+  def distance_matrix(self, origins, destinations):
+    destination_chunk=max(1, min(len(destinations), self.max_destinations))
+    origin_chunk=max(1, min(self.max_origins,
+                            self.max_elements//destination_chunk))
+    rows=[[] for origin in origins]
+    row=0
+    for origin_block in chunks(origins, origin_chunk):
+      for destination_block in chunks(destinations, destination_chunk):
+        json_response=self.fetch(self.url.matrix_url(origin_block,
+                                                     destination_block))
+        status=json_response.get('status')
+        for i in range(len(origin_block)):
+          if status!='OK':
+            rows[row+i].extend((status, None) for d in destination_block)
+            continue
+          for element in json_response['rows'][i]['elements']:
+            if element['status']!='OK':
+              rows[row+i].append((element['status'], None))
+              continue
+            distance=element['distance']
+            duration=element['duration']
+            rows[row+i].append(('OK', Distance(distance['text'],
+                                               distance['value'],
+                                               duration['text'],
+                                               duration['value'])))
+      row+=len(origin_block)
+    return rows
+
+  def distance_many(self, origins, destinations):
+    # Batches usually share one end (an airport, a station), so the matrix of
+    # unique origins by unique destinations stays close to the pair count.
+    origin_index={}
+    destination_index={}
+    for origin, destination in zip(origins, destinations):
+      origin_index.setdefault(address_str(origin), (len(origin_index), origin))
+      destination_index.setdefault(address_str(destination),
+                                   (len(destination_index), destination))
+    matrix=self.distance_matrix([o for i, o in origin_index.values()],
+                                [d for i, d in destination_index.values()])
+    distances=[]
+    for origin, destination in zip(origins, destinations):
+      status, distance=matrix[origin_index[address_str(origin)][0]]\
+                             [destination_index[address_str(destination)][0]]
+      if status!='OK':
+        raise DistanceException('{} -> {}: {}'.format(address_str(origin),
+                                                      address_str(destination),
+                                                      status))
+      distances.append(distance)
+    return distances
+
+
+class LRUCache:
+  def __init__(self, max_size, ttl=None, clock=time.time):
+    self.max_size=max_size
+    self.ttl=ttl
+    self.clock=clock
+    self.entries=OrderedDict()
+    # reentrant so that callers can make a check and a put atomic
+    self.lock=threading.RLock()
+    self.hits=0
+    self.misses=0
+    self.evictions=0
+    self.expirations=0
+
+  def get(self, key, default=None):
+    with self.lock:
+      entry=self.entries.get(key)
+      if entry is not None:
+        value, expires=entry
+        if expires is None or expires>self.clock():
+          self.entries.move_to_end(key)
+          self.hits+=1
+          return value
+        del self.entries[key]
+        self.expirations+=1
+      self.misses+=1
+      return default
+
+  def put(self, key, value, expires=None):
+    if expires is None and self.ttl is not None:
+      expires=self.clock()+self.ttl
+    with self.lock:
+      self.entries[key]=(value, expires)
+      self.entries.move_to_end(key)
+      while len(self.entries)>self.max_size:
+        self.entries.popitem(last=False)
+        self.evictions+=1
+
+  def __setitem__(self, key, value):
+    self.put(key, value)
+
+  def invalidate(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def stats(self):
+    return {'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations}
+
+
+class SqliteDistanceStore:
+  def __init__(self, path):
+    self.connection=sqlite3.connect(path, check_same_thread=False)
+    self.lock=threading.Lock()
+    with self.lock, self.connection:
+      self.connection.execute('''CREATE TABLE IF NOT EXISTS distances
+                                 (key TEXT PRIMARY KEY, dist_text TEXT,
+                                  dist_value NUMERIC, time_text TEXT,
+                                  time_value NUMERIC, expires REAL)''')
+
+  def get(self, key):
+    with self.lock:
+      row=self.connection.execute('''SELECT dist_text, dist_value, time_text,
+                                           time_value, expires
+                                    FROM distances WHERE key=?''',
+                                  (key,)).fetchone()
+    if row is None:
+      return None
+    return Distance(*row[:4]), row[4]
+
+  def put(self, key, distance, expires):
+    with self.lock, self.connection:
+      self.connection.execute('''INSERT OR REPLACE INTO distances
+                                 VALUES (?, ?, ?, ?, ?, ?)''',
+                              (key, distance.dist_text, distance.dist_value,
+                               distance.time_text, distance.time_value,
+                               expires))
+
+  def close(self):
+    self.connection.close()
+
+
+def normalised_address_str(address):
+  return ', '.join(' '.join(part.split())
+                   for part in address_str(address).lower().split(','))
+
+def distance_key(origin, destination):
+  return '{}|{}'.format(normalised_address_str(origin),
+                        normalised_address_str(destination))
+
+
+class CachingDistance(DistanceSource):
+  def __init__(self, distance_source, max_size=10000, ttl=None, store=None,
+               clock=time.time):
+    self.distance_source=distance_source
+    self.cache=LRUCache(max_size, ttl, clock)
+    self.store=store
+    self.store_hits=0
+
+  def distance(self, origin, destination):
+    key=distance_key(origin, destination)
+    distance=self.cache.get(key)
+    if distance is not None:
+      return distance
+    if self.store is not None:
+      stored=self.store.get(key)
+      if stored is not None:
+        distance, expires=stored
+        if expires is None or expires>self.cache.clock():
+          self.store_hits+=1
+          self.cache.put(key, distance, expires)
+          return distance
+    distance=self.distance_source.distance(origin, destination)
+    expires=None
+    if self.cache.ttl is not None:
+      expires=self.cache.clock()+self.cache.ttl
+    self.cache.put(key, distance, expires)
+    if self.store is not None:
+      self.store.put(key, distance, expires)
+    return distance
+
+  def stats(self):
+    stats=self.cache.stats()
+    stats['store_hits']=self.store_hits
+    return stats
+
+class PricingUnavailableException(RydzException):
+  pass
+
+
+class CircuitBreaker:
+  def __init__(self, failure_threshold=5, reset_after=30.0, clock=time.monotonic):
+    self.failure_threshold=failure_threshold
+    self.reset_after=reset_after
+    self.clock=clock
+    self.failures=0
+    self.opened=None
+
+  def allow(self):
+    # once open, let a trial call through after reset_after seconds
+    return self.opened is None or self.clock()-self.opened>=self.reset_after
+
+  def success(self):
+    self.failures=0
+    self.opened=None
+
+  def failure(self):
+    self.failures+=1
+    if self.failures>=self.failure_threshold:
+      self.opened=self.clock()
+
+
+class Tier:
+  def __init__(self, name, ratebook, timeout=None, breaker=None):
+    self.name=name
+    self.ratebook=ratebook
+    self.timeout=timeout
+    self.breaker=CircuitBreaker() if breaker is None else breaker
+
+
+# Tries each tier in order (e.g. cached matrix, live distance, postcode
+# table) and answers with the first price. A tier with no price for the
+# journey (KeyError) falls through to the next one. Slow or failing tiers are
+# timed out and counted against the tier's circuit breaker.
+class TieredRateBook:
+  def __init__(self, tiers, budget=None, max_workers=16, clock=time.monotonic):
+    self.tiers=tiers
+    self.budget=budget
+    self.clock=clock
+    self.executor=ThreadPoolExecutor(max_workers=max_workers)
+
+  def call(self, tier, origin, destination, timeout):
+    price_detail=getattr(tier.ratebook, 'price_detail', None)
+    if price_detail is None:
+      call=lambda: (tier.ratebook.price(origin, destination), {})
+    else:
+      call=lambda: price_detail(origin, destination)
+    if timeout is None:
+      return call()
+    return self.executor.submit(call).result(timeout)
+
+  def price_detail(self, origin, destination):
+    deadline=None if self.budget is None else self.clock()+self.budget
+    not_found=None
+    for tier in self.tiers:
+      if not tier.breaker.allow():
+        continue
+      timeout=tier.timeout
+      if deadline is not None:
+        remaining=deadline-self.clock()
+        if remaining<=0:
+          break
+        timeout=remaining if timeout is None else min(timeout, remaining)
+      try:
+        price, detail=self.call(tier, origin, destination, timeout)
+      except KeyError as e:
+        tier.breaker.success()
+        not_found=e
+        continue
+      except Exception:
+        # timeouts and errors alike count against the tier
+        tier.breaker.failure()
+        continue
+      tier.breaker.success()
+      detail=dict(detail)
+      detail['tier']=tier.name
+      return price, detail
+    if not_found is not None:
+      raise not_found
+    raise PricingUnavailableException('no pricing tier answered in time')
+
+  def price(self, origin, destination):
+    return self.price_detail(origin, destination)[0]
+
 
 class Pricer:
-  def __init__(self, ratebook):
+  def __init__(self, ratebook, cache_size=None):
     self.ratebook=ratebook
+    # quote results keyed on the rate book's pricing_key, cleared whenever the
+    # rate book is replaced or its version changes
+    self.cache=LRUCache(cache_size) if cache_size else None
+    self.cache_owner=None
+    self.lock=threading.Lock()
+
+  def current_cache(self):
+    # the rate book, its version and the cache are taken together, so that a
+    # price is only ever cached against the book it came from
+    if self.cache is None:
+      ratebook=self.ratebook
+      return (ratebook, getattr(ratebook, 'version', 0)), None
+    with self.lock:
+      owner=(self.ratebook, getattr(self.ratebook, 'version', 0))
+      if owner!=self.cache_owner:
+        self.cache.clear()
+        self.cache_owner=owner
+    return owner, self.cache
+
+  def store(self, owner, results, key, result):
+    if results is not self.cache:
+      results[key]=result
+      return
+    with self.lock:
+      # the book may have been swapped or changed while this was priced
+      if owner==self.cache_owner and \
+         owner==(self.ratebook, getattr(self.ratebook, 'version', 0)):
+        results[key]=result
+
+  def result(self, origin, destination, results=None, owner=None):
+    ratebook=self.ratebook if owner is None else owner[0]
+    pricing_key=getattr(ratebook, 'pricing_key', None)
+    try:
+      if results is None or pricing_key is None:
+        price_detail=getattr(ratebook, 'price_detail', None)
+        if price_detail is not None:
+          return ('price',)+tuple(price_detail(origin, destination))
+        return ('price', ratebook.price(origin, destination))
+      key=pricing_key(origin, destination)
+      result=results.get(key)
+      if result is None:
+        try:
+          result=('price', ratebook.key_price(key))
+        except KeyError as e:
+          result=('reason', failure_reason(e, origin, destination))
+        self.store(owner, results, key, result)
+      return result
+    except pricing_errors as e:
+      return failure_result(e, origin, destination)
+
+  @staticmethod
+  def response(origin, destination, result):
+    response={'origin':origin,
+              'destination':destination,
+              'status':'OK' if result[0]=='price' else 'ERROR',
+              result[0]:result[1]}
+    if len(result)>2:
+      # rate books with price_detail say how the price was arrived at
+      response.update(result[2])
+    return response
 
   def quote(self, journey):
     origin=journey['origin']
     destination=journey['destination']
-    try:
-      return {'origin': origin,
-              'destination': destination,
-              'status': 'OK',
-              'price':self.ratebook.price(origin, destination)}
-    except KeyError as e:
-      key=e.args[0]
-      if key=='postcode':
-        reason='postcode required for pricing'
-      elif key==postcode_area(origin):
-        reason="origin postcode not found"
-      elif key==postcode_area(destination):
-        reason="destination postcode not found"
-      else:
-        reason='Unknown'
-      return {'origin':origin,
-              'destination':destination,
-              'status':'ERROR',
-              'reason':reason}
+    owner, cache=self.current_cache()
+    return self.response(origin, destination,
+                         self.result(origin, destination, cache, owner))
+
+  def quote_many(self, journeys):
+    owner, results=self.current_cache()
+    if results is None:
+      results={}
+    quotes=[]
+    for journey in journeys:
+      try:
+        origin=journey['origin']
+        destination=journey['destination']
+      except (KeyError, TypeError):
+        quotes.append({'status':'ERROR',
+                       'reason':'origin and destination required'})
+        continue
+      quotes.append(self.response(origin, destination,
+                                  self.result(origin, destination, results, owner)))
+    return quotes
 
-#TODO factor out explicit validation
-#TODO add update
+# what pricing a journey can fail with, short of a bug
+pricing_errors=(KeyError, RydzException, TypeError, AttributeError)
 
-def add_booking(bookings, booking_json):
+def failure_result(e, origin, destination):
+  if isinstance(e, KeyError):
+    return ('reason', failure_reason(e, origin, destination))
+  if isinstance(e, RydzException):
+    return ('reason', str(e))
+  # a malformed address, e.g. a string or a numeric postcode
+  return ('reason', invalid_address_reason(origin, destination))
+
+def failure_reason(e, origin, destination):
+  key=e.args[0]
+  if key in ('postcode', 'country'):
+    return '{} required for pricing'.format(key)
   try:
-    validate_address(booking_json['origin'])
-    validate_address(booking_json['destination'])
-    datetime.strptime(booking_json['pickup_time'], '%Y-%m-%d %H:%M')
-    booking_json['booker']
-    booking_json['passengers']
-    booking_id=bookings.insert(booking_json)
+    if key==postcode_area(origin):
+      return "origin postcode not found"
+    elif key==postcode_area(destination):
+      return "destination postcode not found"
+  except (KeyError, TypeError, AttributeError):
+    pass
+  return 'Unknown'
+
+def priceable_address(address):
+  # pricing only looks at the country and postcode
+  return isinstance(address, Mapping) and \
+    isinstance(address.get('country'), str) and \
+    isinstance(address.get('postcode'), str)
+
+def invalid_address_reason(origin, destination):
+  if not priceable_address(origin):
+    return 'origin address invalid'
+  if not priceable_address(destination):
+    return 'destination address invalid'
+  return 'Unknown'
+
+booking_indexes=[[('pickup_time', 1), ('_id', 1)],
+                 [('booker', 1), ('pickup_time', 1)],
+                 [('passengers', 1), ('pickup_time', 1)],
+                 [('origin_area', 1), ('pickup_time', 1)],
+                 [('destination_area', 1), ('pickup_time', 1)]]
+
+def ensure_booking_indexes(bookings):
+  return [bookings.create_index(keys) for keys in booking_indexes]
+
+def prepare_booking(booking):
+  # store pickup_time as a real datetime and the postcode areas alongside the
+  # addresses so that both can be indexed
+  booking['pickup_time']=parse_pickup_time(booking['pickup_time'])
+  booking['origin_area']=postcode_area(booking['origin'])
+  booking['destination_area']=postcode_area(booking['destination'])
+  return booking
+
+def migrate_bookings(bookings):
+  migrated=0
+  for booking in bookings.find({'pickup_time': {'$type': 'string'}},
+                               ['pickup_time', 'origin', 'destination']):
+    try:
+      update={'pickup_time': parse_pickup_time(booking['pickup_time'])}
+    except ValueError:
+      continue
+    # an address the area cannot be worked out from still gets its
+    # pickup_time converted
+    for field in ('origin', 'destination'):
+      try:
+        update[field+'_area']=postcode_area(booking[field])
+      except (KeyError, TypeError, AttributeError):
+        pass
+    bookings.update_one({'_id': booking['_id']}, {'$set': update})
+    migrated+=1
+  return migrated
+
+def add_booking(bookings, booking_json, writer=None, pricer=None):
+  # with a pricer the booking is quoted once it is known to be valid, and
+  # one that cannot be priced is not stored
+  if isinstance(booking_json, Booking):
+    booking_json=booking_json.to_json()
+  try:
+    with metrics.timer('rydz_stage_seconds', stage='validate'):
+      raise_first(booking_errors(booking_json))
+      prepare_booking(booking_json)
+    if pricer is not None:
+      with metrics.timer('rydz_stage_seconds', stage='price'):
+        quote=pricer.quote(booking_json)
+      if quote['status']!='OK':
+        return {'status': 'ERROR', 'reason': quote['reason']}
+      booking_json['quoted_price']=quote['price']
+    # the prepared document is what gets stored, so it is echoed back as is
+    # rather than read back from the collection
+    if writer is not None:
+      writer.submit(booking_json)
+    else:
+      with metrics.timer('rydz_stage_seconds', stage='insert'):
+        booking_json['_id']=bookings.insert_one(booking_json).inserted_id
     return {"status":'OK',
-            "booking": bookings.find_one({"_id":booking_id})}
-  except ValueError as ve:
+            "booking": booking_json}
+  except BookingQueueFullException:
+    # the caller answers this with a retry, not an error
+    raise
+  except (ValueError, KeyError, RydzException) as e:
     return {"status": "ERROR",
-            "reason": str(ve)}
-  except KeyError as ke:
-    return {"status": "ERROR",
-            "reason": "{} missing".format(ke)}
+            "reason": error_message(e)}
+
+def not_found(booking_id):
+  return {'status': 'ERROR',
+          'reason': 'no booking for id',
+          'booking_id': booking_id}
+
+def update_booking(bookings, booking_id, changes, pricer=None, retries=3):
+  try:
+    raise_first(update_errors(changes))
+  except (ValueError, KeyError, RydzException) as e:
+    return {'status': 'ERROR', 'reason': error_message(e)}
+  update=dict(changes)
+  if 'pickup_time' in update:
+    update['pickup_time']=parse_pickup_time(update['pickup_time'])
+  for field in ('origin', 'destination'):
+    if field in update:
+      update[field+'_area']=postcode_area(update[field])
+  query={'_id': booking_id}
+  for attempt in range(retries):
+    if pricer is not None and ('origin' in update or 'destination' in update):
+      journey={field: update[field] for field in ('origin', 'destination')
+               if field in update}
+      if len(journey)<2:
+        # repricing needs the other end of the journey; the update only
+        # applies if that end is still the one priced against
+        unchanged='destination' if 'origin' in journey else 'origin'
+        stored=bookings.find_one(query, [unchanged])
+        if stored is None:
+          return not_found(booking_id)
+        journey[unchanged]=stored[unchanged]
+        query={'_id': booking_id, unchanged: stored[unchanged]}
+      quote=pricer.quote(journey)
+      if quote['status']!='OK':
+        return {'status': 'ERROR', 'reason': quote['reason']}
+      update['quoted_price']=quote['price']
+    # return_document=True is pymongo's ReturnDocument.AFTER
+    booking=bookings.find_one_and_update(query, {'$set': update},
+                                         return_document=True)
+    if booking is not None:
+      return {'status': 'OK', 'booking': booking}
+    if len(query)==1:
+      return not_found(booking_id)
+    query={'_id': booking_id}
+  return {'status': 'ERROR',
+          'reason': 'booking changed while being repriced, try again'}
+
+def delete_booking(bookings, booking_id):
+  booking=bookings.find_one_and_delete({'_id': booking_id})
+  if booking is None:
+    return not_found(booking_id)
+  return {'status': 'OK', 'booking': booking}
+
+class CachedBooking:
+  __slots__=('booking', 'body', 'etag')
+
+  def __init__(self, booking, encode=None):
+    self.booking=booking
+    # the encoded response is kept with the booking so that cache hits and
+    # If-None-Match checks never serialise it again
+    self.body=encode(booking) if encode is not None else None
+    self.etag=hashlib.blake2b(self.body, digest_size=16).hexdigest() \
+      if self.body is not None else None
+
+
+# Read-through cache of booking documents by _id for GET /bookings/<id>.
+# Entries live for ttl seconds at most; this process's own updates and
+# deletes invalidate them, and listen() can follow a Mongo change stream so
+# that writes from elsewhere do too. Lookups racing an invalidation are not
+# cached, so a stale read cannot overwrite the invalidation.
+class BookingCache:
+  def __init__(self, bookings, max_size=10000, ttl=5.0, encode=None,
+               clock=time.time):
+    self.bookings=bookings
+    self.encode=encode
+    self.cache=LRUCache(max_size, ttl, clock)
+    self.invalidations=0
+    self.listener=None
+    self.stopping=threading.Event()
+
+  def get(self, booking_id):
+    entry=self.cache.get(booking_id)
+    if entry is not None:
+      metrics.inc('rydz_booking_cache_total', result='hit')
+      return entry
+    metrics.inc('rydz_booking_cache_total', result='miss')
+    invalidations=self.invalidations
+    booking=self.bookings.find_one({'_id': booking_id})
+    if booking is None:
+      # not cached: a write-behind booking may not have landed yet
+      return None
+    entry=CachedBooking(booking, self.encode)
+    with self.cache.lock:
+      if invalidations==self.invalidations:
+        self.cache.put(booking_id, entry)
+    return entry
+
+  def invalidate(self, booking_id):
+    with self.cache.lock:
+      self.invalidations+=1
+      self.cache.entries.pop(booking_id, None)
+
+  def clear(self):
+    with self.cache.lock:
+      self.invalidations+=1
+      self.cache.entries.clear()
+
+  def stats(self):
+    stats=self.cache.stats()
+    lookups=stats['hits']+stats['misses']
+    stats['hit_rate']=stats['hits']/lookups if lookups else 0.0
+    return stats
+
+  def follow_changes(self, max_await_ms=1000):
+    with self.bookings.watch(max_await_time_ms=max_await_ms) as changes:
+      # anything cached before the stream opened may have missed a change
+      self.clear()
+      while not self.stopping.is_set():
+        change=changes.try_next()
+        if change is None:
+          continue
+        if change.get('operationType') in ('invalidate', 'drop', 'dropDatabase'):
+          self.clear()
+          return
+        self.invalidate(change['documentKey']['_id'])
+
+  def listen(self, retry_interval=5.0, on_error=None):
+    # change streams need a replica set; while the stream is down entries
+    # still expire on their ttl
+    def run():
+      while not self.stopping.is_set():
+        try:
+          self.follow_changes()
+        except Exception as e:
+          self.clear()
+          if on_error is not None:
+            on_error(e)
+          self.stopping.wait(retry_interval)
+    self.listener=threading.Thread(target=run, name='rydz-booking-changes',
+                                   daemon=True)
+    self.listener.start()
+    return self.listener
+
+  def stop(self):
+    self.stopping.set()
+    if self.listener is not None:
+      self.listener.join()
+
+def insert_errors(e, count):
+  # unordered inserts carry on past bad documents, so only the indexes
+  # listed as write errors failed
+  details=getattr(e, 'details', None) or {}
+  failed={error['index']: error.get('errmsg', str(e))
+          for error in details.get('writeErrors', [])}
+  return failed or {i: str(e) for i in range(count)}
+
+def new_booking_id():
+  return ObjectId() if ObjectId is not None else uuid.uuid4().hex
+
+
+class BookingQueueFullException(RydzException):
+  pass
+
+
+# Write-behind for add_booking. Bookings get their _id up front and are
+# acknowledged straight away; a background thread group-commits them with
+# insert_many once batch_size are waiting or flush_interval seconds after the
+# first of a batch arrived. The queue is bounded: submit() waits up to
+# put_timeout for room and then refuses. Failed writes are counted, the most
+# recent max_failures kept in failures, and each passed to on_error.
+class BookingWriter:
+  def __init__(self, bookings, batch_size=500, flush_interval=0.05,
+               max_queue=10000, put_timeout=1.0, on_error=None,
+               id_factory=new_booking_id, max_failures=1000):
+    self.bookings=bookings
+    self.batch_size=batch_size
+    self.flush_interval=flush_interval
+    self.put_timeout=put_timeout
+    self.on_error=on_error
+    self.id_factory=id_factory
+    self.queue=queue.Queue(max_queue)
+    self.lock=threading.Lock()
+    self.written=0
+    self.failed=0
+    self.batches=0
+    self.failures=deque(maxlen=max_failures)
+    self.closed=False
+    self.thread=threading.Thread(target=self.run, name='rydz-booking-writer',
+                                 daemon=True)
+    self.thread.start()
+
+  def submit(self, booking):
+    if self.closed:
+      raise RydzException('booking writer is closed')
+    if '_id' not in booking:
+      booking['_id']=self.id_factory()
+    try:
+      self.queue.put(booking, timeout=self.put_timeout)
+    except queue.Full:
+      metrics.inc('rydz_write_behind_rejected_total')
+      raise BookingQueueFullException('booking queue full, try again later')
+    return booking['_id']
+
+  def next_batch(self):
+    batch=[self.queue.get()]
+    deadline=time.monotonic()+self.flush_interval
+    # None is the shutdown marker and always ends a batch
+    while len(batch)<self.batch_size and batch[-1] is not None:
+      remaining=deadline-time.monotonic()
+      if remaining<=0:
+        break
+      try:
+        batch.append(self.queue.get(timeout=remaining))
+      except queue.Empty:
+        break
+    return batch
+
+  def run(self):
+    while True:
+      batch=self.next_batch()
+      stopping=batch[-1] is None
+      if stopping:
+        batch.pop()
+      if batch:
+        self.write(batch)
+      for i in range(len(batch)+stopping):
+        self.queue.task_done()
+      if stopping:
+        return
+
+  def write(self, batch):
+    try:
+      with metrics.timer('rydz_stage_seconds', stage='write_behind_insert'):
+        self.bookings.insert_many(batch, ordered=False)
+      failed={}
+    except Exception as e:
+      failed=insert_errors(e, len(batch))
+    with self.lock:
+      self.batches+=1
+      self.written+=len(batch)-len(failed)
+      self.failed+=len(failed)
+      for i, reason in failed.items():
+        self.failures.append((batch[i], reason))
+    metrics.inc('rydz_write_behind_written_total', len(batch)-len(failed))
+    if failed:
+      metrics.inc('rydz_write_behind_failed_total', len(failed))
+      if self.on_error is not None:
+        for i, reason in failed.items():
+          self.on_error(batch[i], reason)
+
+  def pending(self):
+    return self.queue.qsize()
+
+  def flush(self):
+    self.queue.join()
+
+  def close(self, timeout=None):
+    # stop taking bookings and wait for everything queued to be written
+    if not self.closed:
+      self.closed=True
+      self.queue.put(None)
+    self.thread.join(timeout)
+    return not self.thread.is_alive()
+
+def parse_time_bound(value):
+  if not isinstance(value, str):
+    return value
+  try:
+    return parse_pickup_time(value)
+  except ValueError:
+    return datetime.strptime(value, '%Y-%m-%d')
+
+def booking_query(booker=None, pickup_from=None, pickup_to=None, after=None):
+  pickup_from=parse_time_bound(pickup_from)
+  pickup_to=parse_time_bound(pickup_to)
+  clauses=[]
+  if booker is not None:
+    clauses.append({'booker': booker})
+  pickup_range={}
+  if pickup_from is not None:
+    pickup_range['$gte']=pickup_from
+  if pickup_to is not None:
+    pickup_range['$lt']=pickup_to
+  if pickup_range:
+    clauses.append({'pickup_time': pickup_range})
+  if after is not None:
+    # keyset pagination on (pickup_time, _id), matching the sort order
+    pickup_time, booking_id=after
+    clauses.append({'$or': [{'pickup_time': {'$gt': pickup_time}},
+                            {'pickup_time': pickup_time,
+                             '_id': {'$gt': booking_id}}]})
+  if len(clauses)==1:
+    return clauses[0]
+  return {'$and': clauses} if clauses else {}
+
+def find_bookings(bookings, booker=None, pickup_from=None, pickup_to=None,
+                  after=None, fields=None, limit=None):
+  projection=None
+  if fields:
+    projection=dict.fromkeys(fields, 1)
+    projection['pickup_time']=1
+  cursor=bookings.find(booking_query(booker, pickup_from, pickup_to, after),
+                       projection).sort([('pickup_time', 1), ('_id', 1)])
+  if limit:
+    cursor=cursor.limit(limit)
+  return cursor
+
+def booking_cursor(booking):
+  return (booking['pickup_time'], booking['_id'])
+
+def bulk_error(line, reason):
+  return {'line': line, 'status': 'ERROR', 'reason': reason}
+
+def insert_chunk(bookings, chunk, pricer):
+  results={}
+  valid=[]
+  with metrics.timer('rydz_stage_seconds', stage='bulk_validate'):
+    for line, booking, error in chunk:
+      if error is None:
+        # one odd record must not end the stream part way through
+        try:
+          raise_first(booking_errors(booking))
+          valid.append((line, prepare_booking(booking)))
+        except Exception as e:
+          error=error_message(e)
+      if error is not None:
+        results[line]=bulk_error(line, error)
+  if pricer is not None and valid:
+    priced=[]
+    with metrics.timer('rydz_stage_seconds', stage='bulk_price'):
+      quotes=pricer.quote_many(b for l, b in valid)
+    for (line, booking), quote in zip(valid, quotes):
+      if quote['status']=='OK':
+        booking['quoted_price']=quote['price']
+        priced.append((line, booking))
+      else:
+        results[line]=bulk_error(line, quote['reason'])
+    valid=priced
+  if valid:
+    try:
+      with metrics.timer('rydz_stage_seconds', stage='bulk_insert'):
+        ids=bookings.insert_many([b for l, b in valid], ordered=False).inserted_ids
+      failed={}
+    except Exception as e:
+      failed=insert_errors(e, len(valid))
+      ids=[b.get('_id') for l, b in valid]
+    for i, (line, booking) in enumerate(valid):
+      if i in failed:
+        results[line]=bulk_error(line, failed[i])
+      else:
+        results[line]={'line': line, 'status': 'OK', 'booking_id': ids[i]}
+  return [results[line] for line, booking, error in chunk]
+
+def parse_booking_line(text):
+  try:
+    booking=json.loads(text)
+  except ValueError as e:
+    return None, 'invalid JSON: {}'.format(e)
+  if not isinstance(booking, dict):
+    return None, 'booking must be a JSON object'
+  return booking, None
+
+def import_bookings(bookings, lines, pricer=None, batch_size=500):
+  chunk=[]
+  for line, text in enumerate(lines, 1):
+    if not text.strip():
+      continue
+    chunk.append((line,)+parse_booking_line(text))
+    if len(chunk)>=batch_size:
+      yield from insert_chunk(bookings, chunk, pricer)
+      chunk=[]
+  if chunk:
+    yield from insert_chunk(bookings, chunk, pricer)
@@ -0,0 +1,76 @@
+#!/usr/local/bin/python3
+import asyncio
+from rydz import distance_key, Pricer, pricing_errors, failure_result
+
+class AsyncDistanceSource:
+  async def distance(self, origin, destination):
+    pass
+
+
+# Runs a blocking DistanceSource (or awaits an async one) under a concurrency
+# limit. Concurrent requests for the same pair share one in-flight future.
+class CoalescingDistance(AsyncDistanceSource):
+  def __init__(self, distance_source, max_concurrency=8, executor=None):
+    self.distance_source=distance_source
+    self.semaphore=asyncio.Semaphore(max_concurrency)
+    self.executor=executor
+    self.in_flight={}
+    self.coalesced=0
+
+  async def fetch(self, origin, destination):
+    async with self.semaphore:
+      if asyncio.iscoroutinefunction(self.distance_source.distance):
+        return await self.distance_source.distance(origin, destination)
+      loop=asyncio.get_running_loop()
+      return await loop.run_in_executor(self.executor,
+                                        self.distance_source.distance,
+                                        origin, destination)
+
+  async def distance(self, origin, destination):
+    key=distance_key(origin, destination)
+    future=self.in_flight.get(key)
+    if future is None:
+      future=asyncio.ensure_future(self.fetch(origin, destination))
+      self.in_flight[key]=future
+      def done(f):
+        if self.in_flight.get(key) is f:
+          del self.in_flight[key]
+      future.add_done_callback(done)
+    else:
+      self.coalesced+=1
+    # one waiter being cancelled must not cancel the shared lookup
+    return await asyncio.shield(future)
+
+
+class AsyncFlatRateDistanceRateBook:
+  def __init__(self, distance_source, rate_pence_per_mile):
+    self.rate=rate_pence_per_mile
+    self.distance_source=distance_source
+
+  async def price(self, origin, destination):
+    return self.rate * float(await self.distance_source.distance(origin,
+                                                                 destination))
+
+
+class AsyncPricer:
+  def __init__(self, ratebook):
+    self.ratebook=ratebook
+
+  async def quote(self, journey):
+    origin=journey['origin']
+    destination=journey['destination']
+    try:
+      result=('price', await self.ratebook.price(origin, destination))
+    except pricing_errors as e:
+      result=failure_result(e, origin, destination)
+    return Pricer.response(origin, destination, result)
+
+  async def quote_many(self, journeys):
+    async def quote_one(journey):
+      try:
+        journey['origin'], journey['destination']
+      except (KeyError, TypeError):
+        return {'status':'ERROR',
+                'reason':'origin and destination required'}
+      return await self.quote(journey)
+    return await asyncio.gather(*map(quote_one, journeys))
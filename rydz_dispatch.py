@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+import argparse
+from datetime import timedelta
+from rydz import parse_pickup_time, booking_query
+from rydz_geo import GridIndex
+
+class Driver:
+  __slots__=('driver_id', 'address', 'seats')
+
+  def __init__(self, driver_id, address, seats=4):
+    self.driver_id=driver_id
+    self.address=address
+    self.seats=seats
+
+
+def pickup_window(pickup_time, minutes=15):
+  if isinstance(pickup_time, str):
+    pickup_time=parse_pickup_time(pickup_time)
+  # windows are counted from midnight, so they need not divide the hour
+  elapsed=pickup_time.hour*60+pickup_time.minute
+  return pickup_time.replace(hour=0, minute=0, second=0, microsecond=0)+\
+    timedelta(minutes=elapsed-elapsed%minutes)
+
+def seats_needed(booking):
+  return max(1, len(booking.get('passengers') or ()))
+
+def unassigned(booking, reason):
+  return {'booking_id': booking.get('_id'), 'status': 'ERROR', 'reason': reason}
+
+
+# Available drivers in a GridIndex on their located position, so that
+# nearest() looks at a few cells around a pickup rather than every driver.
+# locator turns addresses into (lat, lon), e.g. a CentroidDistance; the
+# distance_source (the locator by default, if it is one) then ranks the
+# straight-line candidates by road time from driver to pickup. Drivers more
+# than max_pickup_metres away in a straight line are never offered.
+class Dispatcher:
+  def __init__(self, locator, distance_source=None, candidates=8,
+               window_minutes=15, cell_degrees=0.05, max_pickup_metres=50000):
+    self.locator=locator
+    if distance_source is None and hasattr(locator, 'distance_many'):
+      distance_source=locator
+    self.distance_source=distance_source
+    self.candidates=candidates
+    self.window_minutes=window_minutes
+    self.max_pickup_metres=max_pickup_metres
+    self.index=GridIndex(cell_degrees)
+    self.drivers={}
+    # drivers handed a booking, kept until the booking is claimed for them
+    self.assigned={}
+
+  def add_driver(self, driver_id, address, seats=4):
+    # also moves a driver that is already available
+    lat, lon=self.locator.locate(address)
+    self.drivers[driver_id]=Driver(driver_id, address, seats)
+    self.index.insert(driver_id, lat, lon)
+    self.assigned.pop(driver_id, None)
+
+  def remove_driver(self, driver_id):
+    if driver_id in self.drivers:
+      del self.drivers[driver_id]
+      self.index.remove(driver_id)
+
+  def take_driver(self, driver_id):
+    self.assigned[driver_id]=self.drivers[driver_id]
+    self.remove_driver(driver_id)
+
+  def claimed(self, driver_id):
+    self.assigned.pop(driver_id, None)
+
+  def release(self, driver_id):
+    # an assignment that could not be claimed puts the driver back
+    driver=self.assigned.pop(driver_id, None)
+    if driver is not None:
+      self.add_driver(driver.driver_id, driver.address, driver.seats)
+
+  def __len__(self):
+    return len(self.drivers)
+
+  def nearest_drivers(self, booking, k=1):
+    lat, lon=self.locator.locate(booking['origin'])
+    seats=seats_needed(booking)
+    drivers=self.drivers
+    return self.index.nearest(lat, lon, k,
+                              accept=lambda d: drivers[d].seats>=seats,
+                              max_metres=self.max_pickup_metres)
+
+  def pickup_distances(self, pairs):
+    # one batched call per round; straight-line metres stand in for the road
+    # if there is no distance source or it cannot answer
+    if self.distance_source is not None:
+      try:
+        distances=self.distance_source.distance_many(
+          [self.drivers[driver_id].address for booking, metres, driver_id in pairs],
+          [booking['origin'] for booking, metres, driver_id in pairs])
+        return [(d.time_value, d) for d in distances]
+      except Exception:
+        pass
+    return [(metres, None) for booking, metres, driver_id in pairs]
+
+  def assign_window(self, bookings):
+    results={}
+    pending=[]
+    for i, booking in enumerate(bookings):
+      try:
+        self.locator.locate(booking['origin'])
+        pending.append(i)
+      except KeyError:
+        results[i]=unassigned(booking, 'origin postcode not found')
+    # each round offers every waiting booking its nearest free drivers and
+    # hands out the quickest pickups first across the whole window
+    while pending:
+      pairs=[]
+      for i in pending:
+        for metres, driver_id in self.nearest_drivers(bookings[i], self.candidates):
+          pairs.append((i, metres, driver_id))
+      if not pairs:
+        break
+      costs=self.pickup_distances([(bookings[i], metres, driver_id)
+                                   for i, metres, driver_id in pairs])
+      taken=set()
+      for (cost, distance), (i, metres, driver_id) in sorted(zip(costs, pairs),
+                                                             key=lambda p: p[0][0]):
+        if i in results or driver_id in taken:
+          continue
+        taken.add(driver_id)
+        result={'booking_id': bookings[i].get('_id'), 'status': 'OK',
+                'driver_id': driver_id}
+        if distance is not None:
+          result['pickup_distance']=distance.dist_text
+          result['pickup_eta']=distance.time_text
+        results[i]=result
+      for driver_id in taken:
+        self.take_driver(driver_id)
+      pending=[i for i in pending if i not in results]
+    for i in pending:
+      results[i]=unassigned(bookings[i], 'no driver available')
+    return [results[i] for i in range(len(bookings))]
+
+  def assign(self, bookings):
+    # assigned drivers become unavailable until released or added again
+    windows={}
+    for i, booking in enumerate(bookings):
+      windows.setdefault(pickup_window(booking['pickup_time'], self.window_minutes),
+                         []).append(i)
+    results=[None]*len(bookings)
+    for window in sorted(windows):
+      indexes=windows[window]
+      for i, result in zip(indexes,
+                           self.assign_window([bookings[i] for i in indexes])):
+        results[i]=result
+    return results
+
+
+def dispatch(bookings, dispatcher, pickup_from=None, pickup_to=None):
+  query=booking_query(pickup_from=pickup_from, pickup_to=pickup_to)
+  query={'$and': [query, {'driver_id': None}]} if query else {'driver_id': None}
+  pending=list(bookings.find(query, ['origin', 'pickup_time', 'passengers'])
+                       .sort([('pickup_time', 1), ('_id', 1)]))
+  results=dispatcher.assign(pending)
+  for result in results:
+    if result['status']=='OK':
+      # a booking assigned meanwhile by another dispatcher is left alone
+      claimed=bookings.update_one({'_id': result['booking_id'], 'driver_id': None},
+                                  {'$set': {'driver_id': result['driver_id']}})
+      if claimed.modified_count==0:
+        dispatcher.release(result['driver_id'])
+        for key in ('driver_id', 'pickup_distance', 'pickup_eta'):
+          result.pop(key, None)
+        result.update(status='ERROR', reason='already assigned')
+      else:
+        dispatcher.claimed(result['driver_id'])
+  return results
+
+
+if __name__=='__main__':
+  import json
+  from pymongo import MongoClient
+  from rydz_geo import CentroidDistance
+  parser=argparse.ArgumentParser(description='Assign drivers to waiting bookings')
+  parser.add_argument('centroids', help='CSV of postcode,latitude,longitude')
+  parser.add_argument('drivers', help='JSON list of {"driver_id", "address", "seats"}')
+  parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/')
+  parser.add_argument('--db', default='restdb')
+  parser.add_argument('--from', dest='pickup_from', default=None)
+  parser.add_argument('--to', dest='pickup_to', default=None)
+  parser.add_argument('--window', type=int, default=15, help='minutes per batch')
+  parser.add_argument('--max-pickup-metres', type=float, default=50000,
+                      help='furthest straight-line distance to send a driver')
+  args=parser.parse_args()
+  dispatcher=Dispatcher(CentroidDistance.from_csv(args.centroids),
+                        window_minutes=args.window,
+                        max_pickup_metres=args.max_pickup_metres)
+  with open(args.drivers) as drivers:
+    for driver in json.load(drivers):
+      dispatcher.add_driver(driver['driver_id'], driver['address'],
+                            driver.get('seats', 4))
+  bookings=MongoClient(args.mongo_uri)[args.db].bookings
+  for result in dispatch(bookings, dispatcher, args.pickup_from, args.pickup_to):
+    print(json.dumps(result, default=str))
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+import csv
+from math import radians, sin, cos, asin, sqrt
+from rydz import DistanceSource, Distance, METRES_PER_MILE, postcode_area, \
+  normalised_postcode
+
+EARTH_RADIUS_METRES=6371008.8
+METRES_PER_DEGREE=EARTH_RADIUS_METRES*3.141592653589793/180
+
+def great_circle_metres(lat1, lon1, lat2, lon2):
+  lat1, lon1, lat2, lon2=radians(lat1), radians(lon1), radians(lat2), radians(lon2)
+  a=sin((lat2-lat1)/2)**2+cos(lat1)*cos(lat2)*sin((lon2-lon1)/2)**2
+  return 2*EARTH_RADIUS_METRES*asin(min(1.0, sqrt(a)))
+
+
+# Points bucketed into square cells of cell_degrees. nearest() searches rings
+# of cells outward from the query point and stops once no unvisited cell can
+# hold anything closer, so lookups touch a handful of cells, not every point.
+class GridIndex:
+  def __init__(self, cell_degrees=0.05):
+    self.cell_degrees=cell_degrees
+    self.cells={}
+    self.points={}
+
+  def cell(self, lat, lon):
+    return (int(lat//self.cell_degrees), int(lon//self.cell_degrees))
+
+  def insert(self, key, lat, lon):
+    if key in self.points:
+      self.remove(key)
+    self.points[key]=(lat, lon)
+    self.cells.setdefault(self.cell(lat, lon), {})[key]=(lat, lon)
+
+  def remove(self, key):
+    lat, lon=self.points.pop(key)
+    cell=self.cell(lat, lon)
+    del self.cells[cell][key]
+    if not self.cells[cell]:
+      del self.cells[cell]
+
+  def __len__(self):
+    return len(self.points)
+
+  def __contains__(self, key):
+    return key in self.points
+
+  def ring(self, centre, r):
+    ci, cj=centre
+    if r==0:
+      yield centre
+      return
+    for j in range(cj-r, cj+r+1):
+      yield (ci-r, j)
+      yield (ci+r, j)
+    for i in range(ci-r+1, ci+r):
+      yield (i, cj-r)
+      yield (i, cj+r)
+
+  def lower_bound(self, lat, lon, r):
+    # how close a point outside ring r can be: at least r cells away in
+    # latitude, or within the ring's latitude band but r cells away in
+    # longitude, which is least at the band's poleward edge and shrinks again
+    # going round the back of the globe
+    lat_metres=r*self.cell_degrees*METRES_PER_DEGREE
+    far_lat=min(90.0, abs(lat)+(r+1)*self.cell_degrees)
+    dlon=min(r*self.cell_degrees, 180.0-abs(lon))
+    if dlon<=0:
+      return 0.0
+    a=cos(radians(lat))*cos(radians(far_lat))*sin(radians(dlon)/2)**2
+    return min(lat_metres, 2*EARTH_RADIUS_METRES*asin(min(1.0, sqrt(max(0.0, a)))))
+
+  def scan(self, lat, lon, k, accept, max_metres):
+    found=[(great_circle_metres(lat, lon, plat, plon), key)
+           for key, (plat, plon) in self.points.items()
+           if accept is None or accept(key)]
+    found.sort()
+    if max_metres is not None:
+      found=[f for f in found if f[0]<=max_metres]
+    return found[:k]
+
+  def nearest(self, lat, lon, k=1, accept=None, max_metres=None):
+    centre=self.cell(lat, lon)
+    found=[]
+    r=0
+    while True:
+      if (2*r+1)**2>len(self.cells):
+        # sparse or far apart points: past this many cells, checking every
+        # point is cheaper than walking more empty rings
+        return self.scan(lat, lon, k, accept, max_metres)
+      for cell in self.ring(centre, r):
+        for key, (plat, plon) in self.cells.get(cell, {}).items():
+          if accept is None or accept(key):
+            found.append((great_circle_metres(lat, lon, plat, plon), key))
+      bound=self.lower_bound(lat, lon, r)
+      if len(found)>=k:
+        found.sort()
+        if found[k-1][0]<=bound:
+          break
+      if max_metres is not None and bound>=max_metres:
+        break
+      r+=1
+    found.sort()
+    if max_metres is not None:
+      found=[f for f in found if f[0]<=max_metres]
+    return found[:k]
+
+
+class CentroidDistance(DistanceSource):
+  def __init__(self, centroids, road_factor=1.3, speed_mph=25.0):
+    self.centroids={normalised_postcode(code): (float(lat), float(lon))
+                    for code, (lat, lon) in centroids.items()}
+    self.road_factor=road_factor
+    self.metres_per_second=speed_mph*METRES_PER_MILE/3600
+    self.index=GridIndex()
+    for code, (lat, lon) in self.centroids.items():
+      self.index.insert(code, lat, lon)
+
+  @classmethod
+  def from_csv(cls, path, **kwargs):
+    with open(path, newline='') as source:
+      return cls({row['postcode']: (row['latitude'], row['longitude'])
+                  for row in csv.DictReader(source)}, **kwargs)
+
+  def locate(self, address):
+    # full US ZIPs or UK postcodes first, then the outward code or ZIP prefix
+    location=self.centroids.get(normalised_postcode(address['postcode']))
+    if location is None:
+      area=postcode_area(address)
+      location=self.centroids.get(normalised_postcode(area))
+      if location is None:
+        raise KeyError(area)
+    return location
+
+  def nearest(self, address, k=1):
+    lat, lon=self.locate(address)
+    return self.index.nearest(lat, lon, k)
+
+  def make_distance(self, metres):
+    metres*=self.road_factor
+    return Distance.from_values(metres, metres/self.metres_per_second)
+
+  def distance(self, origin, destination):
+    return self.make_distance(great_circle_metres(*self.locate(origin)+
+                                                   self.locate(destination)))
+
+  def distance_many(self, origins, destinations):
+    # locate each distinct address once and keep the trigonometry on plain
+    # floats in a single loop
+    located={}
+    def locate(address):
+      key=(address.get('country'), address.get('postcode'))
+      if key not in located:
+        lat, lon=self.locate(address)
+        located[key]=(radians(lat), radians(lon), cos(radians(lat)))
+      return located[key]
+    distances=[]
+    make_distance=self.make_distance
+    diameter=2*EARTH_RADIUS_METRES
+    for origin, destination in zip(origins, destinations):
+      lat1, lon1, cos1=locate(origin)
+      lat2, lon2, cos2=locate(destination)
+      a=sin((lat2-lat1)/2)**2+cos1*cos2*sin((lon2-lon1)/2)**2
+      distances.append(make_distance(diameter*asin(min(1.0, sqrt(a)))))
+    return distances
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+import argparse
+import json
+import sys
+from pymongo import MongoClient
+from rydz import Pricer, CompiledPostcodeRateBook, import_bookings, \
+  ensure_booking_indexes, migrate_bookings
+
+def main(argv=None):
+  parser=argparse.ArgumentParser(description='Bulk import NDJSON bookings')
+  parser.add_argument('bookings', nargs='?', default='-',
+                      help='NDJSON file of bookings, - for stdin')
+  parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/')
+  parser.add_argument('--db', default='restdb')
+  parser.add_argument('--batch-size', type=int, default=500)
+  parser.add_argument('--rates',
+                      help='JSON postcode rate map used to quote each booking')
+  parser.add_argument('--migrate', action='store_true',
+                      help='convert string pickup times to datetimes and exit')
+  args=parser.parse_args(argv)
+
+  bookings=MongoClient(args.mongo_uri)[args.db].bookings
+  ensure_booking_indexes(bookings)
+  if args.migrate:
+    print('migrated {} bookings'.format(migrate_bookings(bookings)))
+    return 0
+
+  pricer=None
+  if args.rates:
+    with open(args.rates) as rates:
+      pricer=Pricer(CompiledPostcodeRateBook(json.load(rates)))
+  source=sys.stdin if args.bookings=='-' else open(args.bookings)
+  failures=0
+  with source:
+    for result in import_bookings(bookings, source, pricer, args.batch_size):
+      failures+=result['status']!='OK'
+      sys.stdout.write(json.dumps(result, default=str)+'\n')
+  return 1 if failures else 0
+
+if __name__=='__main__':
+  sys.exit(main())
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+import json
+import timeit
+from datetime import datetime
+from rydz import PICKUP_TIME_FORMAT, WireModel
+try:
+  import orjson
+except ImportError:
+  orjson=None
+try:
+  from bson import ObjectId
+except ImportError:
+  ObjectId=None
+
+def json_default(o):
+  if ObjectId is not None and isinstance(o, ObjectId):
+    return str(o)
+  if isinstance(o, datetime):
+    return o.strftime(PICKUP_TIME_FORMAT)
+  if isinstance(o, WireModel):
+    return o.to_json()
+  raise TypeError('{!r} is not JSON serializable'.format(o))
+
+def dumps_stdlib(obj):
+  return json.dumps(obj, default=json_default, separators=(',', ':')).encode()
+
+def dumps_orjson(obj):
+  # datetimes go through json_default to keep the '%Y-%m-%d %H:%M' wire format
+  return orjson.dumps(obj, default=json_default,
+                      option=orjson.OPT_PASSTHROUGH_DATETIME)
+
+backends={'stdlib': dumps_stdlib}
+if orjson is not None:
+  backends['orjson']=dumps_orjson
+
+backend='orjson' if orjson is not None else 'stdlib'
+dumps=backends[backend]
+
+def use_backend(name):
+  global backend, dumps
+  dumps=backends[name]
+  backend=name
+  return dumps
+
+
+class LegacyMongoJSONEncoder(json.JSONEncoder):
+  # the encoder rydz_rest used before this module, kept for the benchmark
+  def default(self, o):
+    if ObjectId is not None and isinstance(o, ObjectId):
+      return str(o)
+    if isinstance(o, datetime):
+      return o.strftime(PICKUP_TIME_FORMAT)
+    return json.JSONEncoder.default(self, o)
+
+def benchmark(count=1000, repeat=20):
+  bookings=[{'_id': ObjectId() if ObjectId is not None else i,
+             'origin': {'number': '55', 'street': 'King Edward Road',
+                        'town': 'Teddington', 'postcode': 'TW11 1AB',
+                        'country': 'UK'},
+             'destination': {'number': '14', 'street': 'Forth Road',
+                             'town': 'Upminster', 'postcode': 'RM14 2QY',
+                             'country': 'UK'},
+             'pickup_time': datetime(2017, 9, 15, 15, 30),
+             'origin_area': 'TW11',
+             'destination_area': 'RM14',
+             'passengers': ['a.passenger@acompany.com'],
+             'booker': 'a.booker@acompany.com',
+             'quoted_price': 65.25}
+            for i in range(count)]
+  response={'status': 'OK', 'bookings': bookings}
+  timings={'legacy': min(timeit.repeat(
+    lambda: json.dumps(response, cls=LegacyMongoJSONEncoder).encode(),
+    number=1, repeat=repeat))}
+  for name, encode in backends.items():
+    timings[name]=min(timeit.repeat(lambda: encode(response),
+                                    number=1, repeat=repeat))
+  return timings
+
+if __name__=='__main__':
+  for name, seconds in benchmark().items():
+    print('{:8} {:8.3f} ms'.format(name, seconds*1000))
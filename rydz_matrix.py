@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+import argparse
+import json
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from rydz import DistanceSource, Distance, RydzException, GoogleDistance, \
+  PooledHTTPTransport, postcode_area
+
+# Distance matrix file layout:
+#   header   magic, format version, area count and area table length
+#   areas    area names, newline separated UTF-8
+#   done     one byte per origin row, 1 once the row has been filled
+#            (padded to 8 bytes)
+#   metres   area count squared native doubles, NaN where unknown
+#   seconds  area count squared native doubles, NaN where unknown
+MAGIC=b'RYDZDIST'
+FORMAT_VERSION=1
+HEADER=struct.Struct('<8sIII')
+
+class MatrixFileException(RydzException):
+  pass
+
+
+def ratebook_areas(ratebook):
+  if hasattr(ratebook, 'areas'):
+    return list(ratebook.areas)
+  areas=dict.fromkeys(ratebook.postcode_map)
+  for row in ratebook.postcode_map.values():
+    areas.update(dict.fromkeys(row))
+  return list(areas)
+
+def area_address(area, country):
+  return {'postcode': area, 'country': country}
+
+
+class DistanceMatrix:
+  def __init__(self, areas, done=None, metres=None, seconds=None):
+    size=len(areas)
+    self.areas=list(areas)
+    self.index={area: i for i, area in enumerate(areas)}
+    self.size=size
+    self.done=bytearray(size) if done is None else done
+    nan=array('d', [float('nan')])
+    self.metres=nan*(size*size) if metres is None else metres
+    self.seconds=nan*(size*size) if seconds is None else seconds
+
+  def set_row(self, i, distances):
+    base=i*self.size
+    complete=True
+    for j, distance in enumerate(distances):
+      if distance is None:
+        complete=False
+      else:
+        self.metres[base+j]=distance.dist_value
+        self.seconds[base+j]=distance.time_value
+    # rows with failed elements are retried when the build is resumed
+    self.done[i]=complete
+
+  def lookup(self, origin_area, destination_area):
+    i=self.index.get(origin_area)
+    j=self.index.get(destination_area)
+    if i is None or j is None:
+      return None
+    metres=self.metres[i*self.size+j]
+    if metres!=metres:
+      return None
+    return Distance.from_values(metres, self.seconds[i*self.size+j])
+
+  def save(self, path):
+    area_table='\n'.join(self.areas).encode('utf-8')
+    fd, temp_path=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                   prefix='.matrix-')
+    try:
+      with os.fdopen(fd, 'wb') as out:
+        out.write(HEADER.pack(MAGIC, FORMAT_VERSION, self.size, len(area_table)))
+        out.write(area_table)
+        padding=-(HEADER.size+len(area_table)+self.size)%8
+        out.write(bytes(self.done)+b'\0'*padding)
+        array('d', self.metres).tofile(out)
+        array('d', self.seconds).tofile(out)
+      os.replace(temp_path, path)
+    except BaseException:
+      os.unlink(temp_path)
+      raise
+
+  @classmethod
+  def load(cls, path, writable=False):
+    with open(path, 'rb') as matrix_file:
+      data=matrix_file.read() if writable else \
+           mmap.mmap(matrix_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if len(data)<HEADER.size:
+      raise MatrixFileException('{} is not a distance matrix'.format(path))
+    magic, version, size, table_length=HEADER.unpack_from(data)
+    if magic!=MAGIC or version!=FORMAT_VERSION:
+      raise MatrixFileException('{} is not a version {} distance matrix'.format(path, FORMAT_VERSION))
+    offset=HEADER.size
+    areas=bytes(data[offset:offset+table_length]).decode('utf-8').split('\n') if size else []
+    offset+=table_length
+    done=bytearray(data[offset:offset+size])
+    offset+=size+(-offset-size)%8
+    cells=size*size
+    if len(data)!=offset+16*cells:
+      raise MatrixFileException('{} is truncated'.format(path))
+    if writable:
+      metres=array('d', data[offset:offset+8*cells])
+      seconds=array('d', data[offset+8*cells:])
+    else:
+      view=memoryview(data)
+      metres=view[offset:offset+8*cells].cast('d')
+      seconds=view[offset+8*cells:].cast('d')
+    return cls(areas, done, metres, seconds)
+
+
+def fill_row(distance_source, origin, destinations):
+  try:
+    return distance_source.distance_many([origin]*len(destinations), destinations)
+  except Exception:
+    # one bad element should not lose the rest of the row
+    row=[]
+    for destination in destinations:
+      try:
+        row.append(distance_source.distance(origin, destination))
+      except Exception:
+        row.append(None)
+    return row
+
+def build_matrix(areas, distance_source, path, country='UK', concurrency=4,
+                 checkpoint_rows=50):
+  if os.path.exists(path):
+    matrix=DistanceMatrix.load(path, writable=True)
+    if matrix.areas!=list(areas):
+      raise MatrixFileException('{} was built for different areas'.format(path))
+  else:
+    matrix=DistanceMatrix(areas)
+  addresses=[area_address(area, country) for area in areas]
+  pending=[i for i in range(matrix.size) if not matrix.done[i]]
+  lock=threading.Lock()
+  filled=[0]
+  def work(i):
+    row=fill_row(distance_source, addresses[i], addresses)
+    with lock:
+      matrix.set_row(i, row)
+      filled[0]+=1
+      if filled[0]%checkpoint_rows==0:
+        matrix.save(path)
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    list(executor.map(work, pending))
+  matrix.save(path)
+  return matrix
+
+
+class MatrixDistanceSource(DistanceSource):
+  def __init__(self, matrix, fallback=None):
+    self.matrix=matrix
+    self.fallback=fallback
+    self.hits=0
+    self.fallbacks=0
+
+  def distance(self, origin, destination):
+    origin_area=postcode_area(origin)
+    destination_area=postcode_area(destination)
+    distance=self.matrix.lookup(origin_area, destination_area)
+    if distance is not None:
+      self.hits+=1
+      return distance
+    if self.fallback is None:
+      if origin_area not in self.matrix.index:
+        raise KeyError(origin_area)
+      raise KeyError(destination_area)
+    self.fallbacks+=1
+    return self.fallback.distance(origin, destination)
+
+
+if __name__=='__main__':
+  parser=argparse.ArgumentParser(description='Build an area-to-area distance matrix')
+  parser.add_argument('areas', help='JSON list of postcode areas')
+  parser.add_argument('matrix', help='matrix file to build or resume')
+  parser.add_argument('--key', required=True, help='Distance Matrix API key')
+  parser.add_argument('--country', default='UK')
+  parser.add_argument('--concurrency', type=int, default=4)
+  args=parser.parse_args()
+  with open(args.areas) as areas:
+    area_list=json.load(areas)
+  source=GoogleDistance(args.key, PooledHTTPTransport(pool_size=args.concurrency))
+  matrix=build_matrix(area_list, source, args.matrix, args.country,
+                      args.concurrency)
+  print('{} of {} rows filled'.format(sum(matrix.done), matrix.size))
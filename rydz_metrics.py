@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import threading
+import time
+from bisect import bisect_left
+
+DEFAULT_BUCKETS=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                 0.5, 1.0, 2.5, 5.0)
+
+class NullTimer:
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+null_timer=NullTimer()
+
+
+class Histogram:
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    self.buckets=buckets
+    self.counts=[0]*(len(buckets)+1)
+    self.sum=0.0
+    self.count=0
+
+  def observe(self, value):
+    self.counts[bisect_left(self.buckets, value)]+=1
+    self.sum+=value
+    self.count+=1
+
+
+class Timer:
+  def __init__(self, metrics, name, labels):
+    self.metrics=metrics
+    self.name=name
+    self.labels=labels
+
+  def __enter__(self):
+    self.started=time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.metrics.observe(self.name, time.perf_counter()-self.started, **self.labels)
+    return False
+
+
+# Counters and latency histograms, keyed on a metric name plus label values.
+# While disabled, timer() hands back a shared no-op context manager and
+# inc()/observe() return straight away.
+class Metrics:
+  def __init__(self, enabled=False):
+    self.enabled=enabled
+    self.lock=threading.Lock()
+    self.counters={}
+    self.histograms={}
+
+  def inc(self, name, amount=1, **labels):
+    if not self.enabled:
+      return
+    key=(name, tuple(sorted(labels.items())))
+    with self.lock:
+      self.counters[key]=self.counters.get(key, 0)+amount
+
+  def observe(self, name, value, **labels):
+    if not self.enabled:
+      return
+    key=(name, tuple(sorted(labels.items())))
+    with self.lock:
+      histogram=self.histograms.get(key)
+      if histogram is None:
+        histogram=self.histograms[key]=Histogram()
+      histogram.observe(value)
+
+  def timer(self, name, **labels):
+    if not self.enabled:
+      return null_timer
+    return Timer(self, name, labels)
+
+  def reset(self):
+    with self.lock:
+      self.counters.clear()
+      self.histograms.clear()
+
+  def render(self):
+    # Prometheus text exposition format
+    lines=[]
+    with self.lock:
+      for name in sorted({name for name, labels in self.counters}):
+        lines.append('# TYPE {} counter'.format(name))
+        for (metric, labels), value in sorted(self.counters.items()):
+          if metric==name:
+            lines.append('{}{} {}'.format(name, format_labels(labels), value))
+      for name in sorted({name for name, labels in self.histograms}):
+        lines.append('# TYPE {} histogram'.format(name))
+        for (metric, labels), histogram in sorted(self.histograms.items()):
+          if metric!=name:
+            continue
+          cumulative=0
+          for bound, count in zip(histogram.buckets+('+Inf',), histogram.counts):
+            cumulative+=count
+            lines.append('{}_bucket{} {}'.format(name,
+                                                 format_labels(labels+(('le', bound),)),
+                                                 cumulative))
+          lines.append('{}_sum{} {}'.format(name, format_labels(labels), histogram.sum))
+          lines.append('{}_count{} {}'.format(name, format_labels(labels), histogram.count))
+    return '\n'.join(lines)+'\n'
+
+def format_labels(labels):
+  if not labels:
+    return ''
+  return '{'+','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                      for k, v in labels)+'}'
+
+metrics=Metrics()
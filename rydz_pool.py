@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+import argparse
+from rydz import postcode_area, address_str, booking_query, RydzException
+from rydz_dispatch import pickup_window, seats_needed
+from rydz_geo import GridIndex
+
+def pool_key(booking, window_minutes=15):
+  return (postcode_area(booking['origin']),
+          pickup_window(booking['pickup_time'], window_minutes))
+
+def bucket_bookings(bookings, window_minutes=15):
+  buckets={}
+  unpooled=[]
+  for booking in bookings:
+    try:
+      buckets.setdefault(pool_key(booking, window_minutes), []).append(booking)
+    except (KeyError, ValueError, TypeError):
+      unpooled.append(booking)
+  return buckets, unpooled
+
+
+# Candidate pruning within a bucket: bookings are only compared with others
+# whose destination is nearby. With a locator that is a GridIndex over the
+# destinations; without one it is the destination postcode area.
+class DestinationIndex:
+  def __init__(self, bookings, locator=None, neighbours=8, max_spread_metres=5000,
+               cell_degrees=0.05):
+    self.bookings=bookings
+    self.locator=locator
+    self.neighbours=neighbours
+    self.max_spread_metres=max_spread_metres
+    self.located={}
+    self.grid=None
+    self.areas={}
+    self.area_of={}
+    if locator is not None:
+      self.grid=GridIndex(cell_degrees)
+      for i, booking in enumerate(bookings):
+        try:
+          self.located[i]=locator.locate(booking['destination'])
+        except KeyError:
+          continue
+        self.grid.insert(i, *self.located[i])
+    for i, booking in enumerate(bookings):
+      if i not in self.located:
+        try:
+          self.area_of[i]=postcode_area(booking['destination'])
+        except KeyError:
+          continue
+        self.areas.setdefault(self.area_of[i], []).append(i)
+
+  def remove(self, i):
+    if i in self.located:
+      self.grid.remove(i)
+      del self.located[i]
+    elif i in self.area_of:
+      self.areas[self.area_of.pop(i)].remove(i)
+
+  def candidates(self, i):
+    if i in self.located:
+      return [j for metres, j in self.grid.nearest(*self.located[i], self.neighbours+1,
+                                                   max_metres=self.max_spread_metres)
+              if j!=i]
+    if i in self.area_of:
+      return [j for j in self.areas[self.area_of[i]] if j!=i][:self.neighbours]
+    return []
+
+
+# Proposes shared rides from bookings that set off from the same postcode
+# area in the same pickup window. A trip picks riders up in booking order
+# and drops them off nearest destination first; it is feasible while the
+# passengers fit and nobody's ride takes more than max_detour times (and
+# max_extra_seconds longer than) their own direct journey. Detours are timed
+# with distance_source and trips are priced leg by leg through ratebook, and
+# only proposed if they cost less than the separate journeys.
+class Pooler:
+  def __init__(self, ratebook, distance_source, locator=None, capacity=4,
+               max_detour=1.5, max_extra_seconds=900, window_minutes=15,
+               neighbours=8, max_spread_metres=5000):
+    self.ratebook=ratebook
+    self.distance_source=distance_source
+    if locator is None and hasattr(distance_source, 'locate'):
+      locator=distance_source
+    self.locator=locator
+    self.capacity=capacity
+    self.max_detour=max_detour
+    self.max_extra_seconds=max_extra_seconds
+    self.window_minutes=window_minutes
+    self.neighbours=neighbours
+    self.max_spread_metres=max_spread_metres
+    self.times={}
+    self.comparisons=0
+
+  def travel_times(self, legs):
+    # legs repeat heavily between candidate trips, so each is asked for once
+    keys=[(address_str(a), address_str(b)) for a, b in legs]
+    missing={}
+    for key, (a, b) in zip(keys, legs):
+      if key not in self.times and key not in missing:
+        missing[key]=(a, b)
+    if missing:
+      distances=self.distance_source.distance_many([a for a, b in missing.values()],
+                                                   [b for a, b in missing.values()])
+      for key, distance in zip(missing, distances):
+        self.times[key]=distance.time_value
+    return [self.times[key] for key in keys]
+
+  def route(self, group):
+    direct=self.travel_times([(b['origin'], b['destination']) for b in group])
+    dropoffs=sorted(range(len(group)), key=lambda i: direct[i])
+    stops=[('pickup', i, group[i]['origin']) for i in range(len(group))]+\
+          [('dropoff', i, group[i]['destination']) for i in dropoffs]
+    return stops, direct
+
+  def trip(self, group):
+    # the stops, each rider's ride time, and their direct time; None if the
+    # trip breaks a limit
+    if sum(seats_needed(b) for b in group)>self.capacity:
+      return None
+    stops, direct=self.route(group)
+    legs=self.travel_times([(a[2], b[2]) for a, b in zip(stops, stops[1:])])
+    elapsed=[0]
+    for leg in legs:
+      elapsed.append(elapsed[-1]+leg)
+    picked={}
+    ride={}
+    for (kind, i, address), at in zip(stops, elapsed):
+      if kind=='pickup':
+        picked[i]=at
+      else:
+        ride[i]=at-picked[i]
+    for i in range(len(group)):
+      if ride[i]>direct[i]*self.max_detour or ride[i]-direct[i]>self.max_extra_seconds:
+        return None
+    return stops, ride, direct
+
+  def prices(self, origins, destinations):
+    price_many=getattr(self.ratebook, 'price_many', None)
+    if price_many is not None:
+      # a leg that cannot be priced comes back as its error
+      prices=price_many(origins, destinations)
+      for price in prices:
+        if isinstance(price, Exception):
+          raise price
+      return prices
+    return [self.ratebook.price(o, d) for o, d in zip(origins, destinations)]
+
+  def proposal(self, group, stops, ride, direct):
+    try:
+      separate=self.prices([b['origin'] for b in group],
+                           [b['destination'] for b in group])
+      legs=self.prices([a[2] for a in stops[:-1]], [b[2] for b in stops[1:]])
+    except (KeyError, RydzException):
+      return None
+    pooled=sum(legs)
+    if pooled>=sum(separate):
+      return None
+    # riders share the pooled price in proportion to their separate prices
+    share=pooled/sum(separate)
+    return {'bookings': [b.get('_id') for b in group],
+            'passengers': sum(seats_needed(b) for b in group),
+            'origin_area': postcode_area(group[0]['origin']),
+            'route': [(kind, group[i].get('_id')) for kind, i, address in stops],
+            'price': pooled,
+            'separate_price': sum(separate),
+            'saving': sum(separate)-pooled,
+            'shares': {b.get('_id'): price*share for b, price in zip(group, separate)},
+            'detours': {b.get('_id'): ride[i]/direct[i] if direct[i] else 1.0
+                        for i, b in enumerate(group)}}
+
+  def pool_bucket(self, bookings):
+    # greedy: each unpooled booking, biggest parties first, gathers nearby
+    # candidates while the trip stays within its limits
+    index=DestinationIndex(bookings, self.locator, self.neighbours,
+                           self.max_spread_metres)
+    order=sorted(range(len(bookings)), key=lambda i: -seats_needed(bookings[i]))
+    pooled=set()
+    proposals=[]
+    for seed in order:
+      if seed in pooled:
+        continue
+      members=[seed]
+      best=None
+      for j in index.candidates(seed):
+        if j in pooled:
+          continue
+        self.comparisons+=1
+        try:
+          trip=self.trip([bookings[i] for i in members+[j]])
+        except (KeyError, RydzException):
+          continue
+        if trip is not None:
+          members.append(j)
+          best=trip
+      if best is None:
+        continue
+      proposal=self.proposal([bookings[i] for i in members], *best)
+      if proposal is None:
+        continue
+      proposals.append(proposal)
+      for i in members:
+        pooled.add(i)
+        index.remove(i)
+    return proposals
+
+  def propose(self, bookings):
+    self.times={}
+    buckets, unpooled=bucket_bookings(bookings, self.window_minutes)
+    proposals=[]
+    for key in sorted(buckets):
+      if len(buckets[key])>1:
+        proposals.extend(self.pool_bucket(buckets[key]))
+    return proposals
+
+
+def pending_pools(bookings, pooler, pickup_from=None, pickup_to=None):
+  # proposals only: nothing is written until a trip is accepted
+  query=booking_query(pickup_from=pickup_from, pickup_to=pickup_to)
+  query={'$and': [query, {'driver_id': None}]} if query else {'driver_id': None}
+  return pooler.propose(list(bookings.find(query).sort([('pickup_time', 1),
+                                                        ('_id', 1)])))
+
+
+if __name__=='__main__':
+  import json
+  from pymongo import MongoClient
+  from rydz import FlatRateDistanceRateBook
+  from rydz_geo import CentroidDistance
+  parser=argparse.ArgumentParser(description='Propose shared rides for waiting bookings')
+  parser.add_argument('centroids', help='CSV of postcode,latitude,longitude')
+  parser.add_argument('--rate', type=float, default=200, help='pence per mile')
+  parser.add_argument('--mongo-uri', default='mongodb://localhost:27017/')
+  parser.add_argument('--db', default='restdb')
+  parser.add_argument('--from', dest='pickup_from', default=None)
+  parser.add_argument('--to', dest='pickup_to', default=None)
+  parser.add_argument('--capacity', type=int, default=4)
+  parser.add_argument('--max-detour', type=float, default=1.5)
+  args=parser.parse_args()
+  source=CentroidDistance.from_csv(args.centroids)
+  pooler=Pooler(FlatRateDistanceRateBook(source, args.rate), source,
+                capacity=args.capacity, max_detour=args.max_detour)
+  bookings=MongoClient(args.mongo_uri)[args.db].bookings
+  for proposal in pending_pools(bookings, pooler, args.pickup_from, args.pickup_to):
+    print(json.dumps(proposal, default=str))
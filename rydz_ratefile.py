@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+import csv
+import json
+import mmap
+import os
+import signal
+import struct
+import sys
+import tempfile
+import threading
+from array import array
+from rydz import CompiledPostcodeRateBook, RydzException
+
+# Binary rate file layout:
+#   header   magic, format version, byte order, area count, origin count and
+#            area table length
+#   areas    area names, newline separated UTF-8, padded to 8 bytes
+#   rates    area count squared native doubles, NaN for a missing rate
+MAGIC=b'RYDZRATE'
+FORMAT_VERSION=1
+HEADER=struct.Struct('<8sIBxxxIII')
+
+class RateFileException(RydzException):
+  pass
+
+
+def read_rate_source(path):
+  if path.endswith('.json'):
+    with open(path) as source:
+      return json.load(source)
+  postcode_map={}
+  with open(path, newline='') as source:
+    for row in csv.DictReader(source):
+      postcode_map.setdefault(row['origin'], {})[row['destination']]=float(row['price'])
+  return postcode_map
+
+def write_rate_file(ratebook, path):
+  area_table='\n'.join(ratebook.areas).encode('utf-8')
+  padding=-(HEADER.size+len(area_table))%8
+  directory=os.path.dirname(os.path.abspath(path))
+  fd, temp_path=tempfile.mkstemp(dir=directory, prefix='.rates-')
+  try:
+    with os.fdopen(fd, 'wb') as out:
+      out.write(HEADER.pack(MAGIC, FORMAT_VERSION,
+                            sys.byteorder=='little', ratebook.size,
+                            ratebook.origin_count, len(area_table)))
+      out.write(area_table+b'\0'*padding)
+      array('d', ratebook.rates).tofile(out)
+    # readers either see the old file or the new one, never half of one
+    os.replace(temp_path, path)
+  except BaseException:
+    os.unlink(temp_path)
+    raise
+
+def compile_rate_file(source_path, path):
+  ratebook=CompiledPostcodeRateBook(read_rate_source(source_path))
+  write_rate_file(ratebook, path)
+  return ratebook
+
+def load_rate_file(path):
+  with open(path, 'rb') as rate_file:
+    if os.fstat(rate_file.fileno()).st_size<HEADER.size:
+      raise RateFileException('{} is not a rate file'.format(path))
+    mapped=mmap.mmap(rate_file.fileno(), 0, access=mmap.ACCESS_READ)
+  magic, version, little_endian, size, origin_count, table_length=\
+    HEADER.unpack_from(mapped)
+  if magic!=MAGIC or version!=FORMAT_VERSION:
+    raise RateFileException('{} is not a version {} rate file'.format(path, FORMAT_VERSION))
+  offset=HEADER.size
+  areas=mapped[offset:offset+table_length].decode('utf-8').split('\n') if size else []
+  offset+=table_length+(-(offset+table_length)%8)
+  if len(mapped)!=offset+8*size*size:
+    raise RateFileException('{} is truncated'.format(path))
+  if bool(little_endian)==(sys.byteorder=='little'):
+    # shared, read-only pages: every worker mapping the file shares them
+    rates=memoryview(mapped)[offset:].cast('d')
+  else:
+    rates=array('d', mapped[offset:])
+    rates.byteswap()
+  return CompiledPostcodeRateBook.from_table(areas, origin_count, rates)
+
+
+class RateBookReloader:
+  def __init__(self, pricer, path, interval=5.0):
+    self.pricer=pricer
+    self.path=path
+    self.interval=interval
+    self.stamp=None
+    self.stopped=threading.Event()
+    self.thread=None
+    self.reloads=0
+    self.errors=0
+
+  def file_stamp(self):
+    stat=os.stat(self.path)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+  def reload(self):
+    stamp=self.file_stamp()
+    ratebook=load_rate_file(self.path)
+    # a single attribute assignment: quotes already running keep the old book
+    self.pricer.ratebook=ratebook
+    self.stamp=stamp
+    self.reloads+=1
+    return ratebook
+
+  def check(self):
+    try:
+      if self.file_stamp()!=self.stamp:
+        self.reload()
+        return True
+    except (OSError, RateFileException):
+      self.errors+=1
+    return False
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      self.check()
+
+  def start(self):
+    self.thread=threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopped.set()
+    if self.thread is not None:
+      self.thread.join()
+
+  def install_signal_handler(self, signum=signal.SIGHUP):
+    signal.signal(signum, lambda signum, frame: self.check())
+
+
+if __name__=='__main__':
+  if len(sys.argv)!=3:
+    sys.exit('usage: rydz_ratefile.py RATES.csv|RATES.json RATES.bin')
+  ratebook=compile_rate_file(sys.argv[1], sys.argv[2])
+  print('compiled {} areas into {}'.format(ratebook.size, sys.argv[2]))
@@ -1,35 +1,130 @@
 #!/usr/bin/env python
-from rydz import Pricer, PostcodeRateBook, add_booking
+from rydz import Pricer, PostcodeRateBook, add_booking, import_bookings, \
+  find_bookings, booking_cursor, ensure_booking_indexes, BookingWriter, \
+  BookingQueueFullException, update_booking, delete_booking, not_found, \
+  BookingCache, CachedBooking
+import rydz_json
+from rydz_ratefile import RateBookReloader
+from rydz_metrics import metrics
+import atexit
 import logging
-import json
-from flask import Flask, request, Response, jsonify
+import os
+import threading
+import time
+from flask import Flask, request, Response, stream_with_context, g
 from flask_pymongo import PyMongo
-from flask.json import JSONEncoder
 from bson import ObjectId
+from datetime import datetime
 
-class MongoJSONEncoder(JSONEncoder):
-  def default(self, o):
-    if isinstance(o, ObjectId):
-      return str(o)
-    else:
-      return JSONEncoder(self, o)
+def json_response(obj):
+  with metrics.timer('rydz_stage_seconds', stage='encode'):
+    body=rydz_json.dumps(obj)
+  return Response(body, mimetype='application/json')
 
 
 app = Flask(__name__)
-app.json_encoder=MongoJSONEncoder
+
+# RYDZ_METRICS=1 turns on stage timers, route histograms and /metrics
+metrics.enabled=os.environ.get('RYDZ_METRICS', '')=='1'
+
+@app.before_request
+def start_timer():
+  if metrics.enabled:
+    g.started=time.perf_counter()
+
+@app.after_request
+def record_request(response):
+  if metrics.enabled and 'started' in g:
+    route=request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe('rydz_request_seconds', time.perf_counter()-g.started,
+                    route=route, method=request.method)
+    metrics.inc('rydz_requests_total', route=route, method=request.method,
+                status=response.status_code)
+  return response
 
 app.config['MONGO_DBNAME'] = 'rides'
 app.config['MONGO_URI'] = 'mongodb://localhost:27017/restdb'
 
 mongo = PyMongo(app)
 
+# one quote at a time the nested dict is as quick as the compiled table
 postcode_pricer=Pricer(PostcodeRateBook({'TW11':{'NW1':22.5, 'RM14':65.25},
                                          'NW1': {'RM14':52.5, 'TW11':23.25},
-                                         'RM14':{'NW1':62.5, 'TW11':63.25}}))
+                                         'RM14':{'NW1':62.5, 'TW11':63.25}}),
+                       cache_size=10000)
+
+# RYDZ_RATES names a compiled rate file (see rydz_ratefile.py) that replaces
+# the built-in rates and is reloaded when it changes or on SIGHUP
+rate_reloader=None
+if os.environ.get('RYDZ_RATES'):
+  rate_reloader=RateBookReloader(postcode_pricer, os.environ['RYDZ_RATES'])
+  rate_reloader.reload()
+  rate_reloader.start()
+
+# RYDZ_WRITE_BEHIND=1 acknowledges POST /bookings once the booking is
+# validated and priced, and leaves the insert to a background group-committing
+# writer that is drained at exit
+booking_writer=None
+if os.environ.get('RYDZ_WRITE_BEHIND', '')=='1':
+  booking_writer=BookingWriter(
+    mongo.db.bookings,
+    batch_size=int(os.environ.get('RYDZ_WRITE_BATCH', 500)),
+    flush_interval=float(os.environ.get('RYDZ_WRITE_INTERVAL', 0.05)),
+    on_error=lambda booking, reason: app.logger.error('booking %s not written: %s',
+                                                      booking['_id'], reason))
+  atexit.register(booking_writer.close)
+
+def encode_booking(booking):
+  return rydz_json.dumps({'status': 'OK', 'booking': booking})
+
+# RYDZ_BOOKING_CACHE=<size> caches GET /bookings/<id> for
+# RYDZ_BOOKING_CACHE_TTL seconds; RYDZ_CHANGE_STREAM=1 also invalidates on
+# writes made by other processes (needs a replica set)
+booking_cache=None
+if os.environ.get('RYDZ_BOOKING_CACHE'):
+  booking_cache=BookingCache(mongo.db.bookings,
+                             max_size=int(os.environ['RYDZ_BOOKING_CACHE']),
+                             ttl=float(os.environ.get('RYDZ_BOOKING_CACHE_TTL', 5)),
+                             encode=encode_booking)
+  if os.environ.get('RYDZ_CHANGE_STREAM', '')=='1':
+    booking_cache.listen(on_error=lambda e: app.logger.warning(
+      'booking change stream: %s', e))
+
+# the indexes are provisioned by the first request that uses the bookings,
+# so the app starts, and quotes, while mongo is still coming up
+indexes_ensured=False
+indexes_lock=threading.Lock()
+
+def booking_collection():
+  global indexes_ensured
+  bookings=mongo.db.bookings
+  if not indexes_ensured:
+    with indexes_lock:
+      if not indexes_ensured:
+        ensure_booking_indexes(bookings)
+        indexes_ensured=True
+  return bookings
+
+def load_booking(key):
+  if booking_cache is not None:
+    return booking_cache.get(key)
+  booking=booking_collection().find_one({'_id': key})
+  return None if booking is None else CachedBooking(booking, encode_booking)
+
+def parse_booking_id(booking_id):
+  return ObjectId(booking_id) if ObjectId.is_valid(booking_id) else booking_id
 
-def price_booking(pricer, booking_json):
-  booking_json['quoted_price']=pricer.quote(booking_json)['price']
-  return booking_json
+def parse_page_cursor(after):
+  if not after:
+    return None
+  pickup_time, _, booking_id=after.rpartition('|')
+  return (datetime.fromisoformat(pickup_time), parse_booking_id(booking_id))
+
+@app.route("/metrics")
+def metrics_endpoint():
+  if not metrics.enabled:
+    return Response('metrics disabled\n', status=404, mimetype='text/plain')
+  return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route("/quote") #GET by default
 def quote():
@@ -37,52 +132,116 @@ def quote():
   logging.debug('/quote: %s', content)
   response=postcode_pricer.quote(content)
   logging.debug('/quote: %s', response)
-  return jsonify(response)
+  return json_response(response)
+
+@app.route("/quotes", methods=['POST'])
+def quotes():
+  content = request.get_json(silent=True)
+  logging.debug('/quotes: %s', content)
+  journeys=content.get('journeys') if isinstance(content, dict) else content
+  if not isinstance(journeys, list):
+    response=json_response({'status': 'ERROR',
+                            'reason': 'a list of journeys, or an object with one, required'})
+    response.status_code=400
+    return response
+  response={'status':'OK', 'quotes':postcode_pricer.quote_many(journeys)}
+  logging.debug('/quotes: %s', response)
+  return json_response(response)
 
 @app.route("/bookings", methods=['GET', 'POST'])
 def bookings():
-  content = request.get_json()
+  content = request.get_json(silent=True)
   app.logger.debug('/bookings: %s', content)
   if request.method=='POST':
-    response=add_booking(mongo.db.bookings, price_booking(postcode_pricer, request.get_json()))
+    try:
+      response=add_booking(booking_collection(), content, booking_writer,
+                           postcode_pricer)
+    except BookingQueueFullException as e:
+      response=json_response({'status': 'ERROR', 'reason': str(e)})
+      response.status_code=503
+      response.headers['Retry-After']='1'
+      return response
   elif request.method=='GET':
-    #list bookings
-    bs=[]
-    for b in mongo.db.bookings.find():
-      bs.append(b)
-    response={'status':'OK', 'bookings':bs}
+    #list bookings, a page at a time
+    stream=request.args.get('stream', type=int)
+    limit=request.args.get('limit', 0 if stream else 100, type=int)
+    if not stream:
+      limit=min(max(limit, 1), 1000)
+    fields=request.args.get('fields')
+    try:
+      cursor=find_bookings(booking_collection(),
+                           booker=request.args.get('booker'),
+                           pickup_from=request.args.get('from'),
+                           pickup_to=request.args.get('to'),
+                           after=parse_page_cursor(request.args.get('after')),
+                           fields=fields.split(',') if fields else None,
+                           limit=limit)
+    except ValueError as e:
+      # a malformed from, to or after cursor
+      response=json_response({'status': 'ERROR', 'reason': str(e)})
+      response.status_code=400
+      return response
+    if stream:
+      def lines():
+        for b in cursor:
+          yield rydz_json.dumps(b)+b'\n'
+      return Response(stream_with_context(lines()),
+                      mimetype='application/x-ndjson')
+    bs=list(cursor)
+    next_page=None
+    if len(bs)==limit:
+      pickup_time, booking_id=booking_cursor(bs[-1])
+      next_page='{}|{}'.format(pickup_time.isoformat(), booking_id)
+    response={'status':'OK', 'bookings':bs, 'next':next_page}
   else:
     pass
   app.logger.debug('/bookings: %s', response)
-  return jsonify(response)
+  return json_response(response)
+
+@app.route("/bookings/bulk", methods=['POST'])
+def bookings_bulk():
+  batch_size=request.args.get('batch_size', 500, type=int)
+  app.logger.debug('/bookings/bulk: batch_size=%s', batch_size)
+  def results():
+    for result in import_bookings(booking_collection(), request.stream,
+                                  postcode_pricer, batch_size):
+      yield rydz_json.dumps(result)+b'\n'
+  return Response(stream_with_context(results()),
+                  mimetype='application/x-ndjson')
 
 @app.route("/bookings/<booking_id>", methods=['GET', 'PUT', 'DELETE'])
 def bookings_by_id(booking_id):
-  content = request.get_json()
+  content = request.get_json(silent=True)
   app.logger.debug('/bookings/%s: %s', booking_id, content)
-  bookings=mongo.db.bookings
-  try:
-    if request.method=='GET':
-      #fetch booking details
-      booking=bookings.find_one({"_id":ObjectId(booking_id)})
-      response={'status':'OK',
-                'booking':booking}
-    elif request.method=='PUT':
-      #update booking details
-      #TODO update in place
-      response=add_booking(mongo.db.bookings, request.get_json())
-    elif request.method=='DELETE':
-      #cancel booking
-      response={'status': 'OK',
-                'booking': booking_store.pop(booking_id)}
+  bookings=booking_collection()
+  key=parse_booking_id(booking_id)
+  if request.method=='GET':
+    #fetch booking details, cached and with an ETag for conditional polls
+    entry=load_booking(key)
+    if entry is None:
+      response=not_found(booking_id)
+    elif request.if_none_match.contains(entry.etag):
+      metrics.inc('rydz_not_modified_total')
+      response=Response(status=304)
+      response.set_etag(entry.etag)
+      return response
+    else:
+      response=Response(entry.body, mimetype='application/json')
+      response.set_etag(entry.etag)
+      return response
+  elif request.method=='PUT':
+    #update the given fields in place, repricing if the journey changed
+    if not isinstance(content, dict):
+      response={'status': 'ERROR', 'reason': 'JSON object of changes required'}
     else:
-      pass
-  except KeyError:
-    response={'status':'ERROR',
-             'reason':'no booking for id',
-             'booking_id':booking_id}
+      response=update_booking(bookings, key, content, postcode_pricer)
+  elif request.method=='DELETE':
+    #cancel booking
+    response=delete_booking(bookings, key)
+  if booking_cache is not None and request.method!='GET':
+    booking_cache.invalidate(key)
   app.logger.debug('/bookings/%s: %s', booking_id, response)
-  return jsonify(response)
+  return json_response(response)
 
 if __name__ == "__main__":
   #TODO set sensible logging format
@@ -90,4 +249,6 @@ if __name__ == "__main__":
   handler.setLevel(logging.DEBUG)
   app.logger.addHandler(handler)
   app.logger.setLevel(logging.DEBUG)
+  if rate_reloader is not None:
+    rate_reloader.install_signal_handler()
   app.run()
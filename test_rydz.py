@@ -1,12 +1,28 @@
 #!/usr/bin/env python
-from unittest import TestCase,main
+from unittest import TestCase,main,skipIf
 from unittest.mock import MagicMock, mock_open, patch
 import urllib.request
+import time
+import json
+from urllib.parse import urlparse, parse_qs
 from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
 from pytz import timezone
-from rydz import PostcodeRateBook, \
+try:
+  import mongomock
+except ImportError:
+  mongomock=None
+from rydz import PostcodeRateBook, CompiledPostcodeRateBook, \
   DistanceSource, FlatRateDistanceRateBook, GoogleDistanceURL, Distance,\
   GoogleDistance, Pricer, add_booking, validate_booking, \
+  LRUCache, SqliteDistanceStore, CachingDistance, DistanceException, \
+  PooledHTTPTransport, InvalidBookingException, validate_many, \
+  parse_pickup_time, address_errors, booking_errors, import_bookings, find_bookings, \
+  booking_cursor, ensure_booking_indexes, migrate_bookings, PrefixRateBook, \
+  TieredRateBook, Tier, CircuitBreaker, Address, Journey, Booking, \
+  BookingWriter, BookingQueueFullException, RydzException, update_booking, \
+  delete_booking, BookingCache, \
   InvalidAddressException, \
   address_str, postcode_area, validate_address
 
@@ -55,6 +71,203 @@ class TestPostcodePricing(TestCase):
                                                   {'postcode': 'TW10 2CD', 'country': 'UK'}))
 
 
+class TestCompiledPostcodePricing(TestCase):
+  def setUp(self):
+    self.ratebook = CompiledPostcodeRateBook({'TW11':{'NW1':22.5, 'RM14':65.25},
+                                             'NW1': {'RM14':52.5, 'TW11':23.25},
+                                             'RM14':{'NW1':62.5},
+                                             'TW1': {'E1':10.0}})
+
+  def test_valid_address(self):
+    self.assertEqual(52.5, self.ratebook.price({'postcode': 'NW1 1AB', 'country': 'UK'},
+                                               {'postcode': 'RM14 2CD', 'country': 'UK'}))
+    self.assertEqual(10.0, self.ratebook.price({'postcode': 'TW1 1AB', 'country': 'UK'},
+                                               {'postcode': 'E1 2CD', 'country': 'UK'}))
+
+  def test_unknown_origin_postcode(self):
+    with self.assertRaises(KeyError) as context:
+      self.ratebook.price({'postcode': 'RM12 1AB', 'country': 'UK'},
+                          {'postcode': 'TW11 2CD', 'country': 'UK'})
+    self.assertEqual('RM12', context.exception.args[0])
+
+  def test_destination_only_area_as_origin(self):
+    with self.assertRaises(KeyError) as context:
+      self.ratebook.price({'postcode': 'E1 1AB', 'country': 'UK'},
+                          {'postcode': 'TW11 2CD', 'country': 'UK'})
+    self.assertEqual('E1', context.exception.args[0])
+
+  def test_unknown_destination_postcode(self):
+    with self.assertRaises(KeyError) as context:
+      self.ratebook.price({'postcode': 'RM14 1AB', 'country': 'UK'},
+                          {'postcode': 'TW10 2CD', 'country': 'UK'})
+    self.assertEqual('TW10', context.exception.args[0])
+
+  def test_missing_rate(self):
+    with self.assertRaises(KeyError) as context:
+      self.ratebook.price({'postcode': 'RM14 1AB', 'country': 'UK'},
+                          {'postcode': 'TW11 2CD', 'country': 'UK'})
+    self.assertEqual('TW11', context.exception.args[0])
+
+  def test_price_many(self):
+    self.assertEqual([52.5, 22.5, 52.5],
+                     self.ratebook.price_many([{'postcode': 'NW1 1AB', 'country': 'UK'},
+                                               {'postcode': 'TW11 1AB', 'country': 'UK'},
+                                               {'postcode': 'NW1 1AB', 'country': 'UK'}],
+                                              [{'postcode': 'RM14 2CD', 'country': 'UK'},
+                                               {'postcode': 'NW1 2CD', 'country': 'UK'},
+                                               {'postcode': 'RM14 3EF', 'country': 'UK'}]))
+
+  def test_price_many_reports_each_missing_pair(self):
+    prices=self.ratebook.price_many([{'postcode': 'E1 1AB', 'country': 'UK'},
+                                     {'postcode': 'NW1 1AB', 'country': 'UK'},
+                                     {'postcode': 'RM14 1AB', 'country': 'UK'},
+                                     {'postcode': 'NW1 1AB', 'country': 'UK'}],
+                                    [{'postcode': 'NW1 2CD', 'country': 'UK'},
+                                     {'postcode': 'RM14 2CD', 'country': 'UK'},
+                                     {'postcode': 'TW11 2CD', 'country': 'UK'},
+                                     {'postcode': 'TW10 2CD', 'country': 'UK'}])
+    self.assertEqual(52.5, prices[1])
+    for price, area in zip([prices[0], prices[2], prices[3]], ['E1', 'TW11', 'TW10']):
+      self.assertIsInstance(price, KeyError)
+      self.assertEqual(area, price.args[0])
+
+  def test_quote_matches_postcode_rate_book(self):
+    postcode_map={'TW11':{'NW1':22.5}, 'NW1':{'TW11':23.25}}
+    compiled=Pricer(CompiledPostcodeRateBook(postcode_map))
+    plain=Pricer(PostcodeRateBook(postcode_map))
+    for o, d in [('TW11 1AB', 'NW1 2CD'), ('NW9 1AB', 'NW1 2CD'),
+                 ('TW11 1AB', 'RM14 2CD'), ('NW1 1AB', 'NW1 2CD')]:
+      journey={'origin':{'postcode':o, 'country':'UK'},
+               'destination':{'postcode':d, 'country':'UK'}}
+      self.assertEqual(plain.quote(journey), compiled.quote(journey))
+
+
+class TestPrefixPricing(TestCase):
+  def setUp(self):
+    self.ratebook=PrefixRateBook({'TW': {'NW': 30.0, 'NW1': 25.0},
+                                  'TW11 9': {'NW': 20.0},
+                                  'TW1': {'RM14 2': 40.0},
+                                  '902': {'100': 500.0},
+                                  '90210': {'10001': 450.0}})
+
+  def address(self, postcode, country='UK'):
+    return {'postcode': postcode, 'country': country}
+
+  def test_most_specific_origin_wins(self):
+    self.assertEqual((20.0, 'TW11 9', 'NW'),
+                     self.ratebook.match(self.address('tw11  9bc'),
+                                         self.address('NW1 2CD')))
+
+  def test_falls_back_to_area(self):
+    self.assertEqual((25.0, 'TW', 'NW1'),
+                     self.ratebook.match(self.address('TW11 8BC'),
+                                         self.address('NW1 2CD')))
+    self.assertEqual((30.0, 'TW', 'NW'),
+                     self.ratebook.match(self.address('TW11 8BC'),
+                                         self.address('NW10 2CD')))
+
+  def test_district_prefix_does_not_match_longer_district(self):
+    self.assertEqual((40.0, 'TW1', 'RM14 2'),
+                     self.ratebook.match(self.address('TW1 3AB'),
+                                         self.address('RM14 2QY')))
+    with self.assertRaises(KeyError) as context:
+      self.ratebook.price(self.address('TW11 3AB'), self.address('RM14 2QY'))
+    self.assertEqual('RM14', context.exception.args[0])
+
+  def test_us_zip_prefixes(self):
+    self.assertEqual((450.0, '90210', '10001'),
+                     self.ratebook.match(self.address('90210', 'US'),
+                                         self.address('10001', 'US')))
+    self.assertEqual((500.0, '902', '100'),
+                     self.ratebook.match(self.address('90211', 'US'),
+                                         self.address('10001', 'US')))
+
+  def test_quote_reports_rule_and_errors(self):
+    pricer=Pricer(self.ratebook)
+    self.assertEqual({'origin': self.address('TW11 9BC'),
+                      'destination': self.address('NW1 2CD'),
+                      'status': 'OK', 'price': 20.0,
+                      'rule': {'origin': 'TW11 9', 'destination': 'NW'}},
+                     pricer.quote({'origin': self.address('TW11 9BC'),
+                                   'destination': self.address('NW1 2CD')}))
+    self.assertEqual('origin postcode not found',
+                     pricer.quote({'origin': self.address('E1 1AB'),
+                                   'destination': self.address('NW1 2CD')})['reason'])
+    self.assertEqual('destination postcode not found',
+                     pricer.quote({'origin': self.address('TW11 9BC'),
+                                   'destination': self.address('E1 2CD')})['reason'])
+    self.assertEqual('postcode required for pricing',
+                     pricer.quote({'origin': {'country': 'UK'},
+                                   'destination': self.address('E1 2CD')})['reason'])
+
+
+class SlowRateBook:
+  def __init__(self, price, delay=0, error=None):
+    self.price_value=price
+    self.delay=delay
+    self.error=error
+    self.calls=0
+
+  def price(self, origin, destination):
+    self.calls+=1
+    time.sleep(self.delay)
+    if self.error is not None:
+      raise self.error
+    return self.price_value
+
+
+class TestTieredPricing(TestCase):
+  def setUp(self):
+    self.journey={'origin': {'postcode': 'TW11 9BC', 'country': 'UK'},
+                  'destination': {'postcode': 'NW1 2CD', 'country': 'UK'}}
+    self.table=PostcodeRateBook({'TW11': {'NW1': 22.5}})
+
+  def test_first_tier_with_a_price_wins(self):
+    pricer=Pricer(TieredRateBook([Tier('matrix', SlowRateBook(None, error=KeyError('TW11'))),
+                                  Tier('table', self.table)]))
+    self.assertEqual({'origin': self.journey['origin'],
+                      'destination': self.journey['destination'],
+                      'status': 'OK', 'price': 22.5, 'tier': 'table'},
+                     pricer.quote(self.journey))
+
+  def test_slow_tier_times_out(self):
+    pricer=Pricer(TieredRateBook([Tier('live', SlowRateBook(10.0, delay=0.5), timeout=0.05),
+                                  Tier('table', self.table)]))
+    started=time.monotonic()
+    self.assertEqual('table', pricer.quote(self.journey)['tier'])
+    self.assertLess(time.monotonic()-started, 0.4)
+
+  def test_budget_covers_all_tiers(self):
+    pricer=Pricer(TieredRateBook([Tier('live', SlowRateBook(10.0, delay=0.5)),
+                                  Tier('slow table', SlowRateBook(20.0, delay=0.5))],
+                                 budget=0.05))
+    self.assertEqual({'status': 'ERROR',
+                      'reason': 'no pricing tier answered in time'},
+                     {k: v for k, v in pricer.quote(self.journey).items()
+                      if k in ('status', 'reason')})
+
+  def test_not_found_everywhere(self):
+    pricer=Pricer(TieredRateBook([Tier('table', self.table)]))
+    self.assertEqual('destination postcode not found',
+                     pricer.quote({'origin': self.journey['origin'],
+                                   'destination': {'postcode': 'E1 6AN',
+                                                   'country': 'UK'}})['reason'])
+
+  def test_circuit_breaker_skips_failing_tier(self):
+    now=[0]
+    failing=SlowRateBook(None, error=ConnectionError('down'))
+    ratebook=TieredRateBook([Tier('live', failing,
+                                  breaker=CircuitBreaker(2, 30, lambda: now[0])),
+                             Tier('table', self.table)])
+    for i in range(4):
+      self.assertEqual(22.5, ratebook.price(self.journey['origin'],
+                                            self.journey['destination']))
+    self.assertEqual(2, failing.calls)
+    now[0]=30
+    ratebook.price(self.journey['origin'], self.journey['destination'])
+    self.assertEqual(3, failing.calls)
+
+
 class TestDistancePricing(TestCase):
   def test_flat_rate(self):
     distance_source=MagicMock(DistanceSource)
@@ -72,6 +285,58 @@ class TestDistance(TestCase):
   def test_equal_false(self):
     self.assertNotEqual(Distance("1", 5, "3", 4), Distance("1", 2, "3", 4))
 
+  def test_slotted(self):
+    self.assertFalse(hasattr(Distance("1", 2, "3", 4), '__dict__'))
+
+
+class TestModels(TestCase):
+  def setUp(self):
+    self.origin={'number': '55', 'street': 'Kingston Road', 'town': 'Teddington',
+                 'postcode': 'TW11 9JJ', 'country': 'UK', 'flat': '2'}
+    self.destination={'number': '14', 'street': 'Fairfield Avenue',
+                      'town': 'Upminster', 'postcode': 'RM14 3QY', 'country': 'UK'}
+
+  def test_address_reads_like_dict(self):
+    address=Address.from_json(self.origin)
+    self.assertFalse(hasattr(address, '__dict__'))
+    self.assertEqual(self.origin, address)
+    self.assertEqual(self.origin, address.to_json())
+    self.assertEqual('TW11', address.area)
+    self.assertEqual(address_str(self.origin), address_str(address))
+    self.assertEqual('TW11', postcode_area(address))
+    self.assertNotIn('state', address)
+    self.assertIsNone(address.get('state'))
+    validate_address(address)
+
+  def test_address_errors_match_dict(self):
+    for wire in ({'postcode': 'TW11 9JJ'}, {'postcode': 'x', 'country': 'FR'},
+                 {'country': 'UK', 'number': '1'}):
+      with self.assertRaises(KeyError) as from_dict:
+        postcode_area(wire)
+      with self.assertRaises(KeyError) as from_model:
+        postcode_area(Address.from_json(wire))
+      self.assertEqual(from_dict.exception.args, from_model.exception.args)
+      self.assertEqual([str(e) for e in address_errors(wire)],
+                       [str(e) for e in address_errors(Address.from_json(wire))])
+
+  def test_journey_quotes(self):
+    pricer=Pricer(PostcodeRateBook({'TW11': {'RM14': 65.25}}))
+    journey={'origin': self.origin, 'destination': self.destination}
+    self.assertEqual(pricer.quote(journey), pricer.quote(Journey.from_json(journey)))
+    self.assertEqual('origin postcode not found',
+                     pricer.quote(Journey(self.destination, self.origin))['reason'])
+
+  def test_booking_round_trip(self):
+    wire={'origin': self.origin, 'destination': self.destination,
+          'pickup_time': '2017-09-15 15:30', 'passengers': ['p@acompany.com'],
+          'booker': 'b@acompany.com', 'quoted_price': 65.25}
+    booking=Booking.from_json(wire)
+    self.assertIsInstance(booking['origin'], Address)
+    self.assertEqual(wire, booking.to_json())
+    self.assertEqual([], booking_errors(booking))
+    self.assertEqual([["'booker' missing"]],
+                     validate_many([Booking.from_json(dict(wire, booker=None))]))
+
 
 class TestGoogleDistanceURL(TestCase):
   def test_city_to_city(self):
@@ -120,6 +385,178 @@ class TestGoogleDistance(TestCase):
     mock_urlopen.assert_called_with('https://maps.googleapis.com/maps/api/distancematrix/json?units=imperial&origins=London%2C+UK&destinations=Edinburgh%2C+UK&key=my_key')
 
 
+def matrix_response(origins, destinations, status='OK'):
+  return {'status': 'OK',
+          'rows': [{'elements': [{'status': status,
+                                  'distance': {'text': '{} mi'.format(o*100+d),
+                                               'value': o*100+d},
+                                  'duration': {'text': '1 min', 'value': 60}}
+                                 for d in destinations]}
+                   for o in origins]}
+
+def fake_fetch(url):
+  query=parse_qs(urlparse(url).query)
+  return matrix_response([int(o.split(', ')[0]) for o in query['origins'][0].split('|')],
+                         [int(d.split(', ')[0]) for d in query['destinations'][0].split('|')])
+
+
+class TestGoogleDistanceMatrix(TestCase):
+  def setUp(self):
+    self.gd=GoogleDistance('my_key')
+    self.gd.fetch=MagicMock(side_effect=fake_fetch)
+
+  def test_matrix_url(self):
+    self.assertEqual('https://maps.googleapis.com/maps/api/distancematrix/json?units=imperial&origins=London%2C+UK%7CLeeds%2C+UK&destinations=Edinburgh%2C+UK&key=my_key',
+                     self.gd.url.matrix_url([{'town': 'London', 'country': 'UK'},
+                                             {'town': 'Leeds', 'country': 'UK'}],
+                                            [{'town': 'Edinburgh', 'country': 'UK'}]))
+
+  def test_packs_elements_per_request(self):
+    origins=[{'town': str(o), 'country': 'UK'} for o in range(30)]
+    destinations=[{'town': str(d), 'country': 'UK'} for d in range(10)]
+    rows=self.gd.distance_matrix(origins, destinations)
+    # 10 destinations per request leaves room for 10 origins
+    self.assertEqual(3, self.gd.fetch.call_count)
+    self.assertEqual(30, len(rows))
+    self.assertEqual(('OK', Distance('2907 mi', 2907, '1 min', 60)), rows[29][7])
+
+  def test_element_status(self):
+    self.gd.fetch=MagicMock(return_value=matrix_response([1], [2], 'NOT_FOUND'))
+    self.assertEqual([[('NOT_FOUND', None)]],
+                     self.gd.distance_matrix([{'town': '1'}], [{'town': '2'}]))
+    with self.assertRaises(DistanceException):
+      self.gd.distance_many([{'town': '1'}], [{'town': '2'}])
+
+  def test_flat_rate_price_many(self):
+    ratebook=FlatRateDistanceRateBook(self.gd, 2)
+    airport={'town': '5', 'country': 'UK'}
+    prices=ratebook.price_many([airport]*3,
+                               [{'town': str(d), 'country': 'UK'} for d in (1, 2, 1)])
+    self.assertEqual(1, self.gd.fetch.call_count)
+    self.assertAlmostEqual(2*501/1609.344, prices[0])
+    self.assertAlmostEqual(2*502/1609.344, prices[1])
+    self.assertEqual(prices[0], prices[2])
+
+
+class StubMatrixHandler(BaseHTTPRequestHandler):
+  protocol_version='HTTP/1.1'
+
+  def do_GET(self):
+    server=self.server
+    server.requests+=1
+    if server.responses:
+      status, body=server.responses.pop(0)
+    else:
+      status, body=200, json.dumps(matrix_response([1], [2])).encode()
+    self.send_response(status)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, *args):
+    pass
+
+
+class TestPooledHTTPTransport(TestCase):
+  def setUp(self):
+    self.server=ThreadingHTTPServer(('127.0.0.1', 0), StubMatrixHandler)
+    self.server.requests=0
+    self.server.responses=[]
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url='http://127.0.0.1:{}/maps/api/distancematrix/json?units=imperial'.format(self.server.server_port)
+    self.transport=PooledHTTPTransport(pool_size=2, sleep=MagicMock())
+
+  def tearDown(self):
+    self.transport.close()
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_keep_alive_reuses_connection(self):
+    for i in range(3):
+      self.assertEqual('OK', self.transport.get_json(self.url)['status'])
+    self.assertEqual(3, self.server.requests)
+    self.assertEqual(1, self.transport.connections_opened)
+
+  def test_retries_server_errors(self):
+    self.server.responses=[(503, b'busy'),
+                           (200, json.dumps({'status': 'OVER_QUERY_LIMIT'}).encode())]
+    self.assertEqual('OK', self.transport.get_json(self.url)['status'])
+    self.assertEqual(3, self.server.requests)
+    self.assertEqual([((0.2,),), ((0.4,),)], self.transport.sleep.call_args_list)
+
+  def test_gives_up_after_retries(self):
+    self.server.responses=[(500, b'down')]*4
+    with self.assertRaises(DistanceException):
+      self.transport.get_json(self.url)
+    self.assertEqual(4, self.server.requests)
+
+  def test_google_distance_over_transport(self):
+    gd=GoogleDistance('my_key', transport=self.transport)
+    gd.url.matrix_url=MagicMock(return_value=self.url)
+    self.assertEqual(Distance('102 mi', 102, '1 min', 60),
+                     gd.distance({'town': 'London'}, {'town': 'Leeds'}))
+
+
+class TestLRUCache(TestCase):
+  def test_eviction(self):
+    cache=LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    self.assertEqual(1, cache.get('a'))
+    cache.put('c', 3)
+    self.assertIsNone(cache.get('b'))
+    self.assertEqual(3, cache.get('c'))
+    self.assertEqual({'size': 2, 'hits': 2, 'misses': 1, 'evictions': 1,
+                      'expirations': 0}, cache.stats())
+
+  def test_ttl(self):
+    now=[100]
+    cache=LRUCache(2, ttl=10, clock=lambda: now[0])
+    cache.put('a', 1)
+    now[0]=109
+    self.assertEqual(1, cache.get('a'))
+    now[0]=110
+    self.assertIsNone(cache.get('a'))
+    self.assertEqual(1, cache.stats()['expirations'])
+
+
+class TestCachingDistance(TestCase):
+  def setUp(self):
+    self.source=MagicMock(DistanceSource)
+    self.source.distance=MagicMock(return_value=Distance('1 mi', 1609, '3 mins', 180))
+    self.london={'town': 'London', 'country': 'UK'}
+    self.edinburgh={'town': 'Edinburgh', 'country': 'UK'}
+
+  def test_repeat_lookup_is_cached(self):
+    cd=CachingDistance(self.source, max_size=10)
+    self.assertEqual(Distance('1 mi', 1609, '3 mins', 180),
+                     cd.distance(self.london, self.edinburgh))
+    self.assertEqual(Distance('1 mi', 1609, '3 mins', 180),
+                     cd.distance({'town': 'london ', 'country': 'UK'},
+                                 self.edinburgh))
+    self.assertEqual(1, self.source.distance.call_count)
+    self.assertEqual(1, cd.stats()['hits'])
+    self.assertEqual(1, cd.stats()['misses'])
+
+  def test_ttl_expiry_refetches(self):
+    now=[0]
+    cd=CachingDistance(self.source, ttl=60, clock=lambda: now[0])
+    cd.distance(self.london, self.edinburgh)
+    now[0]=61
+    cd.distance(self.london, self.edinburgh)
+    self.assertEqual(2, self.source.distance.call_count)
+
+  def test_store_survives_restart(self):
+    store=SqliteDistanceStore(':memory:')
+    CachingDistance(self.source, store=store).distance(self.london,
+                                                       self.edinburgh)
+    restarted=CachingDistance(self.source, store=store)
+    self.assertEqual(Distance('1 mi', 1609, '3 mins', 180),
+                     restarted.distance(self.london, self.edinburgh))
+    self.assertEqual(1, self.source.distance.call_count)
+    self.assertEqual(1, restarted.stats()['store_hits'])
+
+
 class TestJsonQuote(TestCase):
   def setUp(self):
     self.pricer=Pricer(PostcodeRateBook({'TW11':{'NW1':22.5, 'RM14':65.25},
@@ -162,23 +599,173 @@ class TestJsonQuote(TestCase):
                                          "destination":{"postcode":"TW1 2CD",
                                                         'country': 'UK'}}))
 
+  def test_missing_country(self):
+    self.assertEqual({"origin":{"postcode":"NW1 1AB"},
+                      "destination":{"postcode":"RM14 2CD", 'country': 'UK'},
+                      "status":"ERROR",
+                      "reason":"country required for pricing"},
+                      self.pricer.quote({"origin":{"postcode":"NW1 1AB"},
+                                         "destination":{"postcode":"RM14 2CD",
+                                                        'country': 'UK'}}))
+
+  def test_quote_many(self):
+    journeys=[{"origin":{"postcode":"NW1 1AB", 'country': 'UK'},
+               "destination":{"postcode":"RM14 2CD", 'country': 'UK'}},
+              {"origin":{"postcode":"NW9 1AB", 'country': 'UK'},
+               "destination":{"postcode":"RM14 2CD", 'country': 'UK'}},
+              {"destination":{"postcode":"RM14 2CD", 'country': 'UK'}},
+              {"origin":{"country": 'UK'},
+               "destination":{"postcode":"RM14 2CD", 'country': 'UK'}},
+              {"origin":{"postcode":"NW1 3EF", 'country': 'UK'},
+               "destination":{"postcode":"RM14 9ZZ", 'country': 'UK'}}]
+    self.assertEqual([self.pricer.quote(journeys[0]),
+                      self.pricer.quote(journeys[1]),
+                      {'status':'ERROR',
+                       'reason':'origin and destination required'},
+                      self.pricer.quote(journeys[3]),
+                      self.pricer.quote(journeys[4])],
+                     self.pricer.quote_many(journeys))
+
+  def test_quote_many_malformed_addresses(self):
+    good={"postcode":"RM14 2CD", 'country': 'UK'}
+    self.assertEqual(['origin address invalid', 'origin address invalid',
+                      'origin address invalid', 'destination address invalid'],
+                     [q['reason'] for q in self.pricer.quote_many(
+                       [{'origin':'x', 'destination':good},
+                        {'origin':None, 'destination':good},
+                        {'origin':{'postcode':5, 'country':'UK'}, 'destination':good},
+                        {'origin':good, 'destination':[good]}])])
+
+  def test_quote_many_shares_lookups(self):
+    ratebook=MagicMock(wraps=self.pricer.ratebook)
+    pricer=Pricer(ratebook)
+    journey={"origin":{"postcode":"NW1 1AB", 'country': 'UK'},
+             "destination":{"postcode":"RM14 2CD", 'country': 'UK'}}
+    self.assertEqual([52.5, 52.5],
+                     [q['price'] for q in pricer.quote_many([journey, journey])])
+    self.assertEqual(1, ratebook.key_price.call_count)
+
+
+class TestQuoteCache(TestCase):
+  def setUp(self):
+    self.ratebook=CompiledPostcodeRateBook({'TW11':{'NW1':22.5},
+                                           'NW1': {'TW11':23.25}})
+    self.pricer=Pricer(self.ratebook, cache_size=10)
+    self.journey={"origin":{"postcode":"TW11 1AB", 'country': 'UK'},
+                  "destination":{"postcode":"NW1 2CD", 'country': 'UK'}}
+    self.bad_journey={"origin":{"postcode":"NW9 1AB", 'country': 'UK'},
+                      "destination":{"postcode":"NW1 2CD", 'country': 'UK'}}
+
+  def test_hits_and_negative_results(self):
+    for i in range(3):
+      self.assertEqual(22.5, self.pricer.quote(self.journey)['price'])
+      self.assertEqual('origin postcode not found',
+                       self.pricer.quote(self.bad_journey)['reason'])
+    self.assertEqual(4, self.pricer.cache.hits)
+    self.assertEqual(2, self.pricer.cache.misses)
+
+  def test_same_quotes_as_uncached(self):
+    uncached=Pricer(self.ratebook)
+    for journey in [self.journey, self.bad_journey,
+                    {"origin":{'country': 'UK'},
+                     "destination":{"postcode":"NW1 2CD", 'country': 'UK'}}]:
+      self.assertEqual(uncached.quote(journey), self.pricer.quote(journey))
+      self.assertEqual(uncached.quote(journey), self.pricer.quote(journey))
+
+  def test_invalidated_by_rate_change(self):
+    self.pricer.quote(self.journey)
+    self.pricer.quote(self.bad_journey)
+    self.ratebook.set_price('TW11', 'NW1', 30.0)
+    self.assertEqual(30.0, self.pricer.quote(self.journey)['price'])
+    self.ratebook.set_price('NW9', 'NW1', 12.0)
+    self.assertEqual(12.0, self.pricer.quote(self.bad_journey)['price'])
+    self.assertEqual(22.5+0.75, self.ratebook.price({"postcode":"NW1 1AB", 'country': 'UK'},
+                                                    {"postcode":"TW11 2CD", 'country': 'UK'}))
+
+  def test_invalidated_by_rate_book_swap(self):
+    self.pricer.quote(self.journey)
+    self.pricer.ratebook=PostcodeRateBook({'TW11':{'NW1':40.0}})
+    self.assertEqual(40.0, self.pricer.quote(self.journey)['price'])
+
+  def test_swap_while_pricing_not_cached(self):
+    # the rate file is reloaded, and another quote clears the cache for the
+    # new book, while this quote is still being priced from the old one
+    pricer=self.pricer
+    new_book=PostcodeRateBook({'TW11':{'NW1':40.0}})
+    old_book=MagicMock(wraps=self.ratebook, version=0)
+    def swap(key):
+      pricer.ratebook=new_book
+      pricer.quote(self.bad_journey)
+      return 22.5
+    old_book.key_price.side_effect=swap
+    pricer.ratebook=old_book
+    self.assertEqual(22.5, pricer.quote(self.journey)['price'])
+    self.assertEqual(40.0, pricer.quote(self.journey)['price'])
+
+  def test_change_while_pricing_not_cached(self):
+    pricer=self.pricer
+    key_price=self.ratebook.key_price
+    def change(key):
+      price=key_price(key)
+      self.ratebook.set_price('TW11', 'NW1', 30.0)
+      pricer.quote(self.bad_journey)
+      return price
+    self.ratebook.key_price=change
+    self.assertEqual(22.5, pricer.quote(self.journey)['price'])
+    self.ratebook.key_price=key_price
+    self.assertEqual(30.0, pricer.quote(self.journey)['price'])
+
+
+def json_dumps_bytes(obj):
+  return json.dumps(obj).encode()
+
+
 class MockMongoCollection:
   def __init__(self):
     self.last_id=0
     self.rows=[]
+    self.insert_many_calls=0
+    self.calls=[]
 
   def insert(self, doc):
     self.last_id+=1
     doc_=doc.copy()
-    doc_['_id']=self.last_id
+    doc_.setdefault('_id', self.last_id)
     self.rows.append(doc_)
-    return self.last_id
+    return doc_['_id']
 
-  def find_one(self, key_map):
-    result_rows=self.rows
-    for k in key_map:
-      filter(lambda r: r[k]==key_map[k], result_rows)
-    return list(result_rows)[0]
+  def insert_one(self, doc):
+    doc['_id']=self.insert(doc)
+    return MagicMock(inserted_id=doc['_id'])
+
+  def insert_many(self, docs, ordered=True):
+    self.insert_many_calls+=1
+    return MagicMock(inserted_ids=[self.insert(doc) for doc in docs])
+
+  def find_one(self, key_map, projection=None):
+    self.calls.append('find_one')
+    for row in self.rows:
+      if all(row.get(k)==v for k, v in key_map.items()):
+        if projection is None:
+          return row
+        return {k: row[k] for k in ['_id']+list(projection) if k in row}
+    return None
+
+  def find_one_and_update(self, key_map, update, return_document=False):
+    self.calls.append('find_one_and_update')
+    for row in self.rows:
+      if all(row.get(k)==v for k, v in key_map.items()):
+        before=dict(row)
+        row.update(update['$set'])
+        return dict(row) if return_document else before
+    return None
+
+  def find_one_and_delete(self, key_map):
+    self.calls.append('find_one_and_delete')
+    for i, row in enumerate(self.rows):
+      if all(row.get(k)==v for k, v in key_map.items()):
+        return self.rows.pop(i)
+    return None
 
 class TestAddBooking(TestCase):
   def setUp(self):
@@ -202,7 +789,9 @@ class TestAddBooking(TestCase):
                             'postcode':'RM14 2QY',
                             'country':'UK'
                          },
-                          'pickup_time':'2017-09-15 15:30',
+                          'pickup_time':datetime(2017, 9, 15, 15, 30),
+                          'origin_area':'TW11',
+                          'destination_area':'RM14',
                           'passengers':['a.passenger@acompany.com'],
                           'booker':'a.booker@acompany.com',
                           'quoted_price':65.25
@@ -237,13 +826,426 @@ class TestAddBooking(TestCase):
                                         'town': 'Upminster',
                                         'postcode': 'RM14 2QY',
                                         'country': 'UK'},
-                        'pickup_time': '2017-09-15 15:30',
+                        'pickup_time': datetime(2017, 9, 15, 15, 30),
+                        'origin_area': 'TW11',
+                        'destination_area': 'RM14',
                         'passengers': ['a.passenger@acompany.com'],
                         'booker': 'a.booker@acompany.com',
                         'quoted_price': 65.25}],
                       self.bs.rows)
 
 
+class TestUpdateBooking(TestCase):
+  def setUp(self):
+    self.bs=MockMongoCollection()
+    self.pricer=Pricer(PostcodeRateBook({'TW11':{'RM14':65.25, 'NW1':22.5},
+                                         'NW1':{'RM14':52.5}}))
+    self.nw1={'number':'1', 'street':'Euston Road', 'town':'London',
+              'postcode':'NW1 2DB', 'country':'UK'}
+    booking={'origin':{'number':'55', 'street':'King Edward Road',
+                       'town':'Teddington', 'postcode':'TW11 1AB',
+                       'country':'UK'},
+             'destination':{'number':'14', 'street':'Forth Road',
+                            'town':'Upminster', 'postcode':'RM14 2QY',
+                            'country':'UK'},
+             'pickup_time':'2017-09-15 15:30',
+             'passengers':['a.passenger@acompany.com'],
+             'booker':'a.booker@acompany.com',
+             'quoted_price':65.25}
+    self.id=add_booking(self.bs, booking)['booking']['_id']
+    self.bs.calls.clear()
+
+  def test_partial_update_in_place(self):
+    response=update_booking(self.bs, self.id, {'pickup_time':'2017-09-16 09:00'},
+                            self.pricer)
+    self.assertEqual('OK', response['status'])
+    self.assertEqual(datetime(2017, 9, 16, 9, 0), response['booking']['pickup_time'])
+    self.assertEqual(65.25, response['booking']['quoted_price'])
+    self.assertEqual(1, len(self.bs.rows))
+    self.assertEqual(['find_one_and_update'], self.bs.calls)
+
+  def test_origin_change_reprices(self):
+    response=update_booking(self.bs, self.id, {'origin':self.nw1}, self.pricer)
+    self.assertEqual('OK', response['status'])
+    self.assertEqual(52.5, self.bs.rows[0]['quoted_price'])
+    self.assertEqual('NW1', self.bs.rows[0]['origin_area'])
+    self.assertEqual(['find_one', 'find_one_and_update'], self.bs.calls)
+
+  def test_both_ends_changed_prices_without_reading(self):
+    response=update_booking(self.bs, self.id,
+                            {'origin':self.bs.rows[0]['origin'],
+                             'destination':self.nw1}, self.pricer)
+    self.assertEqual(22.5, response['booking']['quoted_price'])
+    self.assertEqual(['find_one_and_update'], self.bs.calls)
+
+  def test_unpriceable_change_rejected(self):
+    response=update_booking(self.bs, self.id,
+                            {'destination':dict(self.nw1, postcode='SW1 6AN')},
+                            self.pricer)
+    self.assertEqual({'status':'ERROR', 'reason':'destination postcode not found'},
+                     response)
+    self.assertEqual('RM14', self.bs.rows[0]['destination_area'])
+
+  def test_only_changed_fields_validated(self):
+    self.assertEqual({'status':'ERROR', 'reason':"'postcode'"},
+                     update_booking(self.bs, self.id,
+                                    {'origin':dict(self.nw1, postcode='nw1')}))
+    self.assertEqual({'status':'ERROR', 'reason':"'quoted_price' cannot be updated"},
+                     update_booking(self.bs, self.id, {'quoted_price':1}))
+    self.assertEqual({'status':'ERROR', 'reason':"'booker' missing"},
+                     update_booking(self.bs, self.id, {'booker':None}))
+    self.assertEqual({'status':'ERROR', 'reason':'address must be an object'},
+                     update_booking(self.bs, self.id, {'origin':5}))
+    self.assertEqual({'status':'ERROR', 'reason':'changes must be an object'},
+                     update_booking(self.bs, self.id, [1]))
+    self.assertEqual([], self.bs.calls)
+
+  def test_unknown_id(self):
+    self.assertEqual({'status':'ERROR', 'reason':'no booking for id',
+                      'booking_id':99},
+                     update_booking(self.bs, 99, {'booker':'b'}))
+
+  def test_delete(self):
+    self.assertEqual(self.id, delete_booking(self.bs, self.id)['booking']['_id'])
+    self.assertEqual([], self.bs.rows)
+    self.assertEqual('no booking for id', delete_booking(self.bs, self.id)['reason'])
+    self.assertEqual(['find_one_and_delete']*2, self.bs.calls)
+
+
+@skipIf(mongomock is None, 'mongomock not installed')
+class TestUpdateBookingMongo(TestCase):
+  def test_update_and_delete(self):
+    bs=mongomock.MongoClient().db.bookings
+    pricer=Pricer(PostcodeRateBook({'TW11':{'RM14':65.25}, 'NW1':{'RM14':52.5}}))
+    booking_id=add_booking(bs, {'origin':{'number':'55', 'street':'King Edward Road',
+                                          'town':'Teddington', 'postcode':'TW11 1AB',
+                                          'country':'UK'},
+                                'destination':{'number':'14', 'street':'Forth Road',
+                                               'town':'Upminster', 'postcode':'RM14 2QY',
+                                               'country':'UK'},
+                                'pickup_time':'2017-09-15 15:30',
+                                'passengers':['a.passenger@acompany.com'],
+                                'booker':'a.booker@acompany.com'})['booking']['_id']
+    response=update_booking(bs, booking_id,
+                            {'origin':{'number':'1', 'street':'Euston Road',
+                                       'town':'London', 'postcode':'NW1 2DB',
+                                       'country':'UK'}}, pricer)
+    self.assertEqual((52.5, 'NW1'), (response['booking']['quoted_price'],
+                                     response['booking']['origin_area']))
+    self.assertEqual('OK', delete_booking(bs, booking_id)['status'])
+    self.assertEqual(0, bs.count_documents({}))
+
+
+class FakeChangeStream:
+  def __init__(self, changes, stopping):
+    self.changes=list(changes)
+    self.stopping=stopping
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    return False
+
+  def try_next(self):
+    if not self.changes:
+      self.stopping.set()
+      return None
+    change=self.changes.pop(0)
+    if callable(change):
+      # something happening between changes
+      change()
+      return None
+    return change
+
+
+class TestBookingCache(TestCase):
+  def setUp(self):
+    self.now=1000.0
+    self.bs=MockMongoCollection()
+    self.bs.rows=[{'_id': 1, 'booker': 'a'}, {'_id': 2, 'booker': 'b'}]
+    self.cache=BookingCache(self.bs, max_size=10, ttl=5, encode=json_dumps_bytes,
+                            clock=lambda: self.now)
+
+  def test_read_through(self):
+    self.assertEqual('a', self.cache.get(1).booking['booker'])
+    self.assertEqual('a', self.cache.get(1).booking['booker'])
+    self.assertIsNone(self.cache.get(3))
+    self.assertEqual(['find_one', 'find_one'], self.bs.calls)
+    self.assertEqual({'size': 1, 'hits': 1, 'misses': 2, 'evictions': 0,
+                      'expirations': 0, 'hit_rate': 1/3}, self.cache.stats())
+
+  def test_ttl(self):
+    self.cache.get(1)
+    self.bs.rows[0]['booker']='c'
+    self.now+=6
+    self.assertEqual('c', self.cache.get(1).booking['booker'])
+
+  def test_invalidate(self):
+    etag=self.cache.get(1).etag
+    self.assertEqual(etag, self.cache.get(1).etag)
+    self.bs.rows[0]['booker']='c'
+    self.cache.invalidate(1)
+    entry=self.cache.get(1)
+    self.assertEqual(b'{"_id": 1, "booker": "c"}', entry.body)
+    self.assertNotEqual(etag, entry.etag)
+
+  def test_read_racing_invalidation_not_cached(self):
+    find_one=self.bs.find_one
+    def racing_find_one(query):
+      booking=dict(find_one(query))
+      self.cache.invalidate(query['_id'])
+      return booking
+    self.bs.find_one=racing_find_one
+    self.cache.get(1)
+    self.assertEqual(0, len(self.cache.cache))
+
+  def test_change_stream(self):
+    self.cache.get(1)
+    def opened():
+      # entries cached before the stream opened are dropped as it opens
+      self.assertEqual(0, len(self.cache.cache))
+      self.cache.get(1)
+      self.cache.get(2)
+    changes=[opened, {'operationType': 'update', 'documentKey': {'_id': 2}}]
+    self.bs.watch=lambda **kwargs: FakeChangeStream(changes, self.cache.stopping)
+    self.cache.follow_changes()
+    self.assertEqual([1], list(self.cache.cache.entries))
+
+
+class BlockingCollection(MockMongoCollection):
+  def __init__(self):
+    MockMongoCollection.__init__(self)
+    self.release=threading.Event()
+
+  def insert_many(self, docs, ordered=True):
+    self.release.wait(5)
+    return MockMongoCollection.insert_many(self, docs, ordered)
+
+
+class FailingCollection(MockMongoCollection):
+  def insert_many(self, docs, ordered=True):
+    error=Exception('batch op errors occurred')
+    error.details={'writeErrors': [{'index': 1, 'errmsg': 'duplicate key'}]}
+    raise error
+
+
+class TestBookingWriter(TestCase):
+  def setUp(self):
+    self.ids=iter(range(100, 200))
+    self.booking={'origin':{'number':'55', 'street':'King Edward Road',
+                            'town':'Teddington', 'postcode':'TW11 1AB',
+                            'country':'UK'},
+                  'destination':{'number':'14', 'street':'Forth Road',
+                                 'town':'Upminster', 'postcode':'RM14 2QY',
+                                 'country':'UK'},
+                  'pickup_time':'2017-09-15 15:30',
+                  'passengers':['a.passenger@acompany.com'],
+                  'booker':'a.booker@acompany.com'}
+
+  def writer(self, bookings, **kwargs):
+    writer=BookingWriter(bookings, id_factory=lambda: next(self.ids), **kwargs)
+    self.addCleanup(writer.close, 5)
+    return writer
+
+  def test_acknowledged_before_write(self):
+    bs=BlockingCollection()
+    writer=self.writer(bs)
+    response=add_booking(bs, dict(self.booking), writer)
+    self.assertEqual('OK', response['status'])
+    self.assertEqual(100, response['booking']['_id'])
+    self.assertEqual('TW11', response['booking']['origin_area'])
+    self.assertEqual([], bs.rows)
+    bs.release.set()
+    writer.flush()
+    self.assertEqual(1, len(bs.rows))
+
+  def test_group_commit_by_size(self):
+    bs=BlockingCollection()
+    writer=self.writer(bs, batch_size=2, flush_interval=1)
+    for i in range(5):
+      writer.submit(dict(self.booking))
+    bs.release.set()
+    self.assertTrue(writer.close(5))
+    self.assertEqual(5, writer.written)
+    self.assertEqual(list(range(100, 105)), [r['_id'] for r in bs.rows])
+    self.assertLessEqual(bs.insert_many_calls, 4)
+
+  def test_flush_interval(self):
+    bs=MockMongoCollection()
+    writer=self.writer(bs, batch_size=100, flush_interval=0.01)
+    writer.submit(dict(self.booking))
+    writer.flush()
+    self.assertEqual(1, writer.written)
+    self.assertEqual(1, bs.insert_many_calls)
+
+  def test_backpressure(self):
+    bs=BlockingCollection()
+    writer=self.writer(bs, batch_size=1, max_queue=1, put_timeout=0.01)
+    writer.submit(dict(self.booking))
+    # the writer is holding the first in insert_many, the second fills the queue
+    deadline=time.monotonic()+5
+    while writer.pending() and time.monotonic()<deadline:
+      time.sleep(0.001)
+    writer.submit(dict(self.booking))
+    with self.assertRaises(BookingQueueFullException):
+      writer.submit(dict(self.booking))
+    # left for the caller to answer with a retry rather than an error
+    with self.assertRaises(BookingQueueFullException):
+      add_booking(bs, dict(self.booking), writer)
+    bs.release.set()
+    writer.flush()
+    self.assertEqual(2, len(bs.rows))
+
+  def test_failures_surfaced(self):
+    errors=[]
+    writer=self.writer(FailingCollection(), flush_interval=1,
+                       on_error=lambda booking, reason: errors.append((booking['_id'], reason)))
+    for i in range(3):
+      writer.submit(dict(self.booking))
+    writer.close(5)
+    self.assertEqual([(101, 'duplicate key')], errors)
+    self.assertEqual((2, 1), (writer.written, writer.failed))
+    self.assertEqual(101, writer.failures[0][0]['_id'])
+
+  def test_closed(self):
+    writer=self.writer(MockMongoCollection())
+    writer.close(5)
+    with self.assertRaises(RydzException):
+      writer.submit(dict(self.booking))
+
+
+class TestImportBookings(TestCase):
+  def setUp(self):
+    self.bs=MockMongoCollection()
+    self.pricer=Pricer(PostcodeRateBook({'TW11':{'RM14':65.25}}))
+    self.booking={'origin':{'number':'55', 'street':'King Edward Road',
+                            'town':'Teddington', 'postcode':'TW11 1AB',
+                            'country':'UK'},
+                  'destination':{'number':'14', 'street':'Forth Road',
+                                 'town':'Upminster', 'postcode':'RM14 2QY',
+                                 'country':'UK'},
+                  'pickup_time':'2017-09-15 15:30',
+                  'passengers':['a.passenger@acompany.com'],
+                  'booker':'a.booker@acompany.com'}
+
+  def test_batched_insert_with_per_line_results(self):
+    reversed_booking=dict(self.booking, origin=self.booking['destination'],
+                          destination=self.booking['origin'])
+    lines=[json.dumps(self.booking)+'\n',
+           '{not json\n',
+           '\n',
+           json.dumps(reversed_booking)+'\n',
+           json.dumps(dict(self.booking, pickup_time='soon'))+'\n',
+           json.dumps(self.booking)+'\n',
+           json.dumps([1])+'\n']
+    results=list(import_bookings(self.bs, lines, self.pricer, batch_size=2))
+    self.assertEqual([1, 2, 4, 5, 6, 7], [r['line'] for r in results])
+    self.assertEqual(['OK', 'ERROR', 'ERROR', 'ERROR', 'OK', 'ERROR'],
+                     [r['status'] for r in results])
+    self.assertEqual('origin postcode not found', results[2]['reason'])
+    self.assertEqual("time data 'soon' does not match format '%Y-%m-%d %H:%M'",
+                     results[3]['reason'])
+    self.assertEqual([1, 2], [r['booking_id'] for r in results if r['status']=='OK'])
+    self.assertEqual([65.25, 65.25], [r['quoted_price'] for r in self.bs.rows])
+    self.assertEqual(2, self.bs.insert_many_calls)
+
+  def test_malformed_records_do_not_stop_the_import(self):
+    lines=[json.dumps(dict(self.booking, origin=5)),
+           json.dumps(dict(self.booking, destination=dict(self.booking['destination'],
+                                                          postcode=12345))),
+           json.dumps(dict(self.booking, origin=None)),
+           json.dumps(self.booking)]
+    results=list(import_bookings(self.bs, lines, self.pricer, batch_size=2))
+    self.assertEqual([(1, 'ERROR', 'address must be an object'),
+                      (2, 'ERROR', "'postcode'"),
+                      (3, 'ERROR', 'address must be an object'),
+                      (4, 'OK', None)],
+                     [(r['line'], r['status'], r.get('reason')) for r in results])
+    self.assertEqual(1, len(self.bs.rows))
+
+  def test_is_lazy(self):
+    lines=iter([json.dumps(self.booking)]*5)
+    results=import_bookings(self.bs, lines, batch_size=2)
+    next(results)
+    self.assertEqual(2, len(self.bs.rows))
+    self.assertEqual(3, len(list(lines)))
+
+
+@skipIf(mongomock is None, 'mongomock not installed')
+class TestFindBookings(TestCase):
+  def setUp(self):
+    self.bs=mongomock.MongoClient().db.bookings
+    for i in range(10):
+      self.bs.insert_one({'_id': i,
+                          'pickup_time': datetime(2017, 9, 15+i//3, 10, 0),
+                          'booker': 'b{}@acompany.com'.format(i%2),
+                          'passengers': ['p{}@acompany.com'.format(i)]})
+
+  def test_keyset_pages(self):
+    seen=[]
+    after=None
+    while True:
+      page=list(find_bookings(self.bs, after=after, limit=4))
+      seen.extend(b['_id'] for b in page)
+      if len(page)<4:
+        break
+      after=booking_cursor(page[-1])
+    self.assertEqual(list(range(10)), seen)
+
+  def test_filters_and_projection(self):
+    page=list(find_bookings(self.bs, booker='b1@acompany.com',
+                            pickup_from='2017-09-16', pickup_to='2017-09-18',
+                            fields=['booker']))
+    self.assertEqual([3, 5, 7], [b['_id'] for b in page])
+    self.assertEqual({'_id', 'booker', 'pickup_time'}, set(page[0]))
+
+  def test_time_window(self):
+    page=list(find_bookings(self.bs, pickup_from='2017-09-16 10:00',
+                            pickup_to='2017-09-17 10:00'))
+    self.assertEqual([3, 4, 5], [b['_id'] for b in page])
+
+
+@skipIf(mongomock is None, 'mongomock not installed')
+class TestBookingStorage(TestCase):
+  def setUp(self):
+    self.bs=mongomock.MongoClient().db.bookings
+
+  def test_ensure_indexes(self):
+    ensure_booking_indexes(self.bs)
+    keys=[index['key'] for index in self.bs.index_information().values()]
+    self.assertIn([('booker', 1), ('pickup_time', 1)], keys)
+    self.assertIn([('origin_area', 1), ('pickup_time', 1)], keys)
+
+  def test_migrate_string_pickup_times(self):
+    self.bs.insert_one({'_id': 1, 'pickup_time': '2017-09-15 15:30',
+                        'origin': {'postcode': 'TW11 1AB', 'country': 'UK'},
+                        'destination': {'postcode': '90210', 'country': 'US'}})
+    self.bs.insert_one({'_id': 2, 'pickup_time': datetime(2017, 9, 16, 9, 0)})
+    self.assertEqual(1, migrate_bookings(self.bs))
+    self.assertEqual({'_id': 1, 'pickup_time': datetime(2017, 9, 15, 15, 30),
+                      'origin': {'postcode': 'TW11 1AB', 'country': 'UK'},
+                      'destination': {'postcode': '90210', 'country': 'US'},
+                      'origin_area': 'TW11', 'destination_area': '902'},
+                     self.bs.find_one({'_id': 1}))
+    self.assertEqual(0, migrate_bookings(self.bs))
+
+  def test_migrate_without_areas(self):
+    self.bs.insert_one({'_id': 1, 'pickup_time': '2017-09-15 15:30',
+                        'origin': {'postcode': 'TW11 1AB', 'country': 'UK'},
+                        'destination': {'postcode': 'D02 X285', 'country': 'IE'}})
+    self.bs.insert_one({'_id': 2, 'pickup_time': '2017-09-15 16:00', 'origin': 'x'})
+    self.bs.insert_one({'_id': 3, 'pickup_time': 'soon'})
+    self.assertEqual(2, migrate_bookings(self.bs))
+    migrated=self.bs.find_one({'_id': 1})
+    self.assertEqual(datetime(2017, 9, 15, 15, 30), migrated['pickup_time'])
+    self.assertEqual('TW11', migrated['origin_area'])
+    self.assertNotIn('destination_area', migrated)
+    self.assertEqual({'_id': 2, 'pickup_time': datetime(2017, 9, 15, 16, 0), 'origin': 'x'},
+                     self.bs.find_one({'_id': 2}))
+    self.assertEqual('soon', self.bs.find_one({'_id': 3})['pickup_time'])
+
+
 class TestUsableAddress(TestCase):
   def test_empty(self):
     with self.assertRaises(InvalidAddressException) as context:
@@ -384,6 +1386,73 @@ class TestValidateBooking(TestCase):
                       'booker':'a.booker@acompany.com',
                       'quoted_price':65.25})
 
+  def test_invalid_booking_reports_all_errors(self):
+    with self.assertRaises(InvalidBookingException) as context:
+      validate_booking({'origin':{'street':'King Edward Road',
+                                  'postcode':'TW11 1AB',
+                                  'country':'UK'},
+                        'destination':{'number':14,
+                                       'street':'Forth Road',
+                                       'postcode':'RM14',
+                                       'country':'UK'},
+                        'pickup_time':'2017-09-15',
+                        'booker':'a.booker@acompany.com'})
+    self.assertEqual("'number'", str(context.exception))
+    self.assertEqual([InvalidAddressException, InvalidAddressException,
+                      InvalidAddressException, InvalidAddressException,
+                      ValueError, KeyError],
+                     [type(e) for e in context.exception.errors])
+
+  def test_validate_many(self):
+    self.assertEqual([[], ["'origin' missing", "'destination' missing",
+                           "'pickup_time' missing", "'booker' missing",
+                           "'passengers' missing"]],
+                     validate_many([{'origin':{'number':1, 'street':'Forth Road',
+                                               'postcode':'90210', 'country':'US'},
+                                     'destination':{'number':2, 'street':'Hutton Drive',
+                                                    'postcode':'90211', 'country':'US'},
+                                     'pickup_time':'2017-09-15 15:30',
+                                     'passengers':['a.passenger@acompany.com'],
+                                     'booker':'a.booker@acompany.com'},
+                                    {}]))
+    self.assertEqual([["Unsupported country: 'FR'"], ["'country'"]],
+                     validate_many([{'country':'FR'}, {}],
+                                   errors_for=address_errors))
+
+  def test_malformed_records_reported_not_raised(self):
+    good={'number':1, 'street':'Forth Road', 'postcode':'90210', 'country':'US'}
+    self.assertEqual([['address must be an object', 'address must be an object',
+                       "'pickup_time' missing", "'booker' missing",
+                       "'passengers' missing"],
+                      ["'postcode'"],
+                      ['booking must be an object']],
+                     validate_many([{'origin':5, 'destination':None},
+                                    {'origin':good, 'destination':dict(good, postcode=90210),
+                                     'pickup_time':'2017-09-15 15:30',
+                                     'passengers':['a.passenger@acompany.com'],
+                                     'booker':'a.booker@acompany.com'},
+                                    [1]]))
+    self.assertEqual(["Unsupported country: ['UK']"],
+                     validate_many([{'country':['UK']}], errors_for=address_errors)[0])
+
+
+class TestParsePickupTime(TestCase):
+  def test_fast_path(self):
+    self.assertEqual(datetime(2017, 9, 15, 15, 30),
+                     parse_pickup_time('2017-09-15 15:30'))
+
+  def test_matches_strptime(self):
+    for value in ['2017-9-15 15:30', '2017-02-30 10:00', '2017-13-01 10:00',
+                  '2017-09-15 24:00', '2017-09-15T15:30']:
+      try:
+        expected=datetime.strptime(value, '%Y-%m-%d %H:%M')
+      except ValueError as e:
+        with self.assertRaises(ValueError) as context:
+          parse_pickup_time(value)
+        self.assertEqual(str(e), str(context.exception))
+      else:
+        self.assertEqual(expected, parse_pickup_time(value))
+
 
 if __name__=='__main__':
   main()
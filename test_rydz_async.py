@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+import asyncio
+import threading
+from unittest import IsolatedAsyncioTestCase, main
+from rydz import DistanceSource, Distance, DistanceException
+from rydz_async import CoalescingDistance, AsyncFlatRateDistanceRateBook, \
+  AsyncPricer
+
+class SlowDistance(DistanceSource):
+  def __init__(self):
+    self.calls=0
+    self.release=threading.Event()
+
+  def distance(self, origin, destination):
+    self.calls+=1
+    self.release.wait(5)
+    if origin.get('town')=='Nowhere':
+      raise KeyError('Nowhere')
+    if origin.get('town')=='Offline':
+      raise DistanceException('distance lookup failed')
+    return Distance('1 mi', 1609.344, '2 mins', 120)
+
+
+class TestCoalescingDistance(IsolatedAsyncioTestCase):
+  async def test_identical_pairs_share_one_lookup(self):
+    source=SlowDistance()
+    cd=CoalescingDistance(source)
+    origin={'town': 'Wembley', 'country': 'UK'}
+    destination={'town': 'Teddington', 'country': 'UK'}
+    lookups=[asyncio.ensure_future(cd.distance(origin, destination))
+             for i in range(10)]
+    await asyncio.sleep(0.05)
+    source.release.set()
+    distances=await asyncio.gather(*lookups)
+    self.assertEqual([Distance('1 mi', 1609.344, '2 mins', 120)]*10, distances)
+    self.assertEqual(1, source.calls)
+    self.assertEqual(9, cd.coalesced)
+    self.assertEqual({}, cd.in_flight)
+
+  async def test_concurrency_is_bounded(self):
+    active=[0, 0]
+    class CountingDistance:
+      async def distance(self, origin, destination):
+        active[0]+=1
+        active[1]=max(active)
+        await asyncio.sleep(0.01)
+        active[0]-=1
+        return Distance('1 mi', 1, '1 min', 60)
+    cd=CoalescingDistance(CountingDistance(), max_concurrency=3)
+    await asyncio.gather(*[cd.distance({'town': str(i)}, {'town': 'x'})
+                           for i in range(12)])
+    self.assertEqual(3, active[1])
+
+
+class TestAsyncPricer(IsolatedAsyncioTestCase):
+  async def test_quote_many(self):
+    source=SlowDistance()
+    source.release.set()
+    pricer=AsyncPricer(AsyncFlatRateDistanceRateBook(CoalescingDistance(source), 10))
+    quotes=await pricer.quote_many([{'origin': {'town': 'Wembley'},
+                                     'destination': {'town': 'Teddington'}},
+                                    {'origin': {'town': 'Nowhere'},
+                                     'destination': {'town': 'Teddington'}},
+                                    {'origin': {'town': 'Wembley'}}])
+    self.assertEqual(['OK', 'ERROR', 'ERROR'], [q['status'] for q in quotes])
+    self.assertAlmostEqual(10, quotes[0]['price'])
+    self.assertEqual('origin and destination required', quotes[2]['reason'])
+
+  async def test_failed_lookups_are_quoted_as_errors(self):
+    source=SlowDistance()
+    source.release.set()
+    pricer=AsyncPricer(AsyncFlatRateDistanceRateBook(CoalescingDistance(source), 10))
+    quotes=await pricer.quote_many([{'origin': {'town': 'Offline'},
+                                     'destination': {'town': 'Teddington'}},
+                                    {'origin': 'x', 'destination': {'town': 'Teddington'}},
+                                    {'origin': {'town': 'Wembley'},
+                                     'destination': {'town': 'Teddington'}}])
+    self.assertEqual([('ERROR', 'distance lookup failed'),
+                      ('ERROR', 'origin address invalid'),
+                      ('OK', None)],
+                     [(q['status'], q.get('reason')) for q in quotes])
+
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+import random
+from datetime import datetime
+from unittest import TestCase, main, skipIf
+from rydz import DistanceSource
+from rydz_geo import CentroidDistance, great_circle_metres
+from rydz_dispatch import Dispatcher, dispatch, pickup_window
+try:
+  import mongomock
+except ImportError:
+  mongomock=None
+
+def address(postcode):
+  return {'postcode': postcode, 'country': 'UK'}
+
+def booking(booking_id, postcode, pickup_time='2017-09-15 15:30', passengers=1):
+  return {'_id': booking_id, 'origin': address(postcode),
+          'pickup_time': pickup_time, 'passengers': ['p']*passengers}
+
+
+class BrokenDistance(DistanceSource):
+  def distance(self, origin, destination):
+    raise KeyError(origin['postcode'])
+
+
+class TestDispatcher(TestCase):
+  def setUp(self):
+    self.centroids=CentroidDistance({'TW11': (51.4266, -0.3318),
+                                     'TW1': (51.4470, -0.3270),
+                                     'NW1': (51.5337, -0.1432),
+                                     'NW3': (51.5530, -0.1700),
+                                     'RM14': (51.5590, 0.2470)})
+    self.dispatcher=Dispatcher(self.centroids)
+    for driver_id, postcode in (('d1', 'TW1'), ('d2', 'NW3'), ('d3', 'RM14')):
+      self.dispatcher.add_driver(driver_id, address(postcode))
+
+  def test_pickup_window(self):
+    self.assertEqual(datetime(2017, 9, 15, 15, 30), pickup_window('2017-09-15 15:44'))
+    self.assertEqual(datetime(2017, 9, 15, 15, 0),
+                     pickup_window(datetime(2017, 9, 15, 15, 29, 59), 30))
+    self.assertEqual([datetime(2017, 9, 15, 14, 15), datetime(2017, 9, 15, 15, 0),
+                      datetime(2017, 9, 15, 15, 0), datetime(2017, 9, 15, 15, 45)],
+                     [pickup_window(datetime(2017, 9, 15, h, m), 45)
+                      for h, m in ((14, 59), (15, 1), (15, 44), (15, 50))])
+    self.assertEqual([datetime(2017, 9, 15, 13, 30), datetime(2017, 9, 15, 15, 0)],
+                     [pickup_window(datetime(2017, 9, 15, h, 59), 90) for h in (14, 15)])
+
+  def test_nearest_drivers(self):
+    self.assertEqual(['d1', 'd2'],
+                     [d for m, d in self.dispatcher.nearest_drivers(booking(1, 'TW11'), 2)])
+    self.dispatcher.add_driver('d2', address('TW11'))
+    self.assertEqual('d2', self.dispatcher.nearest_drivers(booking(1, 'TW11'))[0][1])
+    self.dispatcher.remove_driver('d2')
+    self.assertEqual('d1', self.dispatcher.nearest_drivers(booking(1, 'TW11'))[0][1])
+
+  def test_seats(self):
+    self.dispatcher.add_driver('van', address('RM14'), seats=8)
+    self.assertEqual('van',
+                     self.dispatcher.nearest_drivers(booking(1, 'TW11', passengers=6))[0][1])
+
+  def test_window_assigned_quickest_first(self):
+    # b2 is nearer d1 than b1 is, so b1 goes to the next nearest driver
+    results=self.dispatcher.assign([booking(1, 'NW1'), booking(2, 'TW11')])
+    self.assertEqual([('OK', 'd2'), ('OK', 'd1')],
+                     [(r['status'], r['driver_id']) for r in results])
+    self.assertIn('pickup_eta', results[0])
+    self.assertEqual(['d3'], list(self.dispatcher.drivers))
+
+  def test_windows_in_pickup_order(self):
+    results=self.dispatcher.assign([booking(1, 'TW11', '2017-09-15 16:00'),
+                                    booking(2, 'TW1', '2017-09-15 15:30'),
+                                    booking(3, 'TW11', '2017-09-15 15:40')])
+    # the 15:30 window takes d1 and d2, leaving d3 for 16:00
+    self.assertEqual(['d3', 'd1', 'd2'], [r['driver_id'] for r in results])
+
+  def test_unassigned(self):
+    results=self.dispatcher.assign([booking(i, 'TW11') for i in range(4)]+
+                                   [booking(9, 'SW1')])
+    self.assertEqual({'booking_id': 3, 'status': 'ERROR',
+                      'reason': 'no driver available'}, results[3])
+    self.assertEqual('origin postcode not found', results[4]['reason'])
+
+  def test_max_pickup_distance(self):
+    centroids=CentroidDistance({'TW11': (51.4266, -0.3318),
+                                'NW1': (51.5337, -0.1432),
+                                '90210': (34.1030, -118.4105)})
+    dispatcher=Dispatcher(centroids)
+    dispatcher.add_driver('uk', address('NW1'))
+    dispatcher.add_driver('la', {'postcode': '90210', 'country': 'US'})
+    results=dispatcher.assign([booking(1, 'TW11'), booking(2, 'NW1')])
+    self.assertEqual([('ERROR', 'no driver available'), ('OK', 'uk')],
+                     [(r['status'], r.get('driver_id', r.get('reason'))) for r in results])
+    self.assertEqual(['la'], list(dispatcher.drivers))
+    dispatcher=Dispatcher(centroids, max_pickup_metres=10000)
+    dispatcher.add_driver('uk', address('NW1'))
+    self.assertEqual('no driver available',
+                     dispatcher.assign([booking(1, 'TW11')])[0]['reason'])
+
+  def test_falls_back_to_straight_line(self):
+    dispatcher=Dispatcher(self.centroids, BrokenDistance())
+    dispatcher.add_driver('d1', address('TW1'))
+    self.assertEqual({'booking_id': 1, 'status': 'OK', 'driver_id': 'd1'},
+                     dispatcher.assign([booking(1, 'TW11')])[0])
+
+  def test_nearest_matches_brute_force(self):
+    rng=random.Random(3)
+    centroids={'A{}'.format(i): (51+rng.random(), -1+rng.random()*2)
+               for i in range(500)}
+    dispatcher=Dispatcher(CentroidDistance(centroids))
+    for i in range(0, 500, 2):
+      dispatcher.add_driver(i, address('A{}'.format(i)))
+    for j in range(1, 40, 2):
+      lat, lon=centroids['A{}'.format(j)]
+      expected=sorted((great_circle_metres(lat, lon, *centroids['A{}'.format(i)]), i)
+                      for i in range(0, 500, 2))[:3]
+      self.assertEqual(expected,
+                       dispatcher.nearest_drivers(booking(j, 'A{}'.format(j)), 3))
+
+
+@skipIf(mongomock is None, 'mongomock not installed')
+class TestDispatch(TestCase):
+  def test_assigns_waiting_bookings(self):
+    bookings=mongomock.MongoClient().db.bookings
+    bookings.insert_many([dict(booking(1, 'TW11'), pickup_time=datetime(2017, 9, 15, 15, 30)),
+                          dict(booking(2, 'NW1'), pickup_time=datetime(2017, 9, 15, 15, 35),
+                               driver_id='d9'),
+                          dict(booking(3, 'NW1'), pickup_time=datetime(2017, 9, 16, 9, 0))])
+    dispatcher=Dispatcher(CentroidDistance({'TW11': (51.4266, -0.3318),
+                                            'NW1': (51.5337, -0.1432)}))
+    dispatcher.add_driver('d1', address('TW11'))
+    dispatcher.add_driver('d2', address('NW1'))
+    results=dispatch(bookings, dispatcher, '2017-09-15', '2017-09-16')
+    self.assertEqual([(1, 'd1')], [(r['booking_id'], r['driver_id']) for r in results])
+    self.assertEqual({1: 'd1', 2: 'd9', 3: None},
+                     {b['_id']: b.get('driver_id') for b in bookings.find()})
+
+  def test_driver_released_when_claim_lost(self):
+    bookings=mongomock.MongoClient().db.bookings
+    bookings.insert_one(dict(booking(1, 'TW11'), pickup_time=datetime(2017, 9, 15, 15, 30)))
+    dispatcher=Dispatcher(CentroidDistance({'TW11': (51.4266, -0.3318)}))
+    dispatcher.add_driver('d1', address('TW11'), seats=6)
+    results=dispatch(LosingRace(bookings), dispatcher)
+    self.assertEqual([{'booking_id': 1, 'status': 'ERROR', 'reason': 'already assigned'}],
+                     results)
+    self.assertEqual('d9', bookings.find_one({'_id': 1})['driver_id'])
+    self.assertEqual(1, len(dispatcher))
+    self.assertEqual(6, dispatcher.drivers['d1'].seats)
+    self.assertEqual([(0.0, 'd1')], dispatcher.nearest_drivers(booking(2, 'TW11')))
+    self.assertEqual({}, dispatcher.assigned)
+
+  def test_claimed_driver_not_kept(self):
+    bookings=mongomock.MongoClient().db.bookings
+    bookings.insert_one(dict(booking(1, 'TW11'), pickup_time=datetime(2017, 9, 15, 15, 30)))
+    dispatcher=Dispatcher(CentroidDistance({'TW11': (51.4266, -0.3318)}))
+    dispatcher.add_driver('d1', address('TW11'))
+    dispatch(bookings, dispatcher)
+    self.assertEqual(0, len(dispatcher))
+    self.assertEqual({}, dispatcher.assigned)
+
+
+# another dispatcher assigns each booking just before this one claims it
+class LosingRace:
+  def __init__(self, bookings):
+    self.bookings=bookings
+
+  def find(self, *args):
+    return self.bookings.find(*args)
+
+  def update_one(self, query, update):
+    self.bookings.update_one({'_id': query['_id']}, {'$set': {'driver_id': 'd9'}})
+    return self.bookings.update_one(query, update)
+
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import random
+from unittest import TestCase, main
+from rydz import Pricer, FlatRateDistanceRateBook
+from rydz_geo import GridIndex, CentroidDistance, great_circle_metres
+
+class TestGreatCircle(TestCase):
+  def test_london_to_edinburgh(self):
+    self.assertAlmostEqual(534000, great_circle_metres(51.5074, -0.1278,
+                                                       55.9533, -3.1883),
+                           delta=2000)
+
+
+class TestGridIndex(TestCase):
+  def test_nearest_matches_brute_force(self):
+    rng=random.Random(7)
+    index=GridIndex(cell_degrees=0.05)
+    points={}
+    for i in range(2000):
+      points[i]=(51+rng.random(), -1+rng.random()*2)
+      index.insert(i, *points[i])
+    for i in range(20):
+      lat, lon=51+rng.random(), -1+rng.random()*2
+      expected=sorted((great_circle_metres(lat, lon, *p), k)
+                      for k, p in points.items())[:5]
+      self.assertEqual(expected, index.nearest(lat, lon, 5))
+
+  def test_far_apart_points(self):
+    index=GridIndex()
+    index.insert('london', 51.5, -0.1)
+    index.insert('edinburgh', 55.9, -3.2)
+    index.insert('nyc', 40.7, -74.0)
+    self.assertEqual([('nyc', great_circle_metres(40.75, -73.9, 40.7, -74.0))],
+                     [(k, d) for d, k in index.nearest(40.75, -73.9)])
+    self.assertEqual(['nyc', 'edinburgh', 'london'],
+                     [k for d, k in index.nearest(40.75, -73.9, 3)])
+    self.assertEqual([], index.nearest(-33.9, 151.2, max_metres=1000000))
+    # across the antimeridian the nearest point is a long way off in cells
+    index.insert('fiji', -17.8, 178.4)
+    index.insert('samoa', -13.8, -172.1)
+    self.assertEqual('fiji', index.nearest(-17.0, -179.9)[0][1])
+
+  def test_far_apart_points_among_many(self):
+    rng=random.Random(3)
+    index=GridIndex(cell_degrees=0.05)
+    points={}
+    for i in range(500):
+      points[i]=(51+rng.random(), -1+rng.random()*2)
+      points[i+500]=(34+rng.random(), -118+rng.random())
+    for key, (lat, lon) in points.items():
+      index.insert(key, lat, lon)
+    for lat, lon in [(40.7, -74.0), (-33.9, 151.2), (64.1, -21.9)]:
+      expected=sorted((great_circle_metres(lat, lon, *p), k)
+                      for k, p in points.items())[:3]
+      self.assertEqual(expected, index.nearest(lat, lon, 3))
+
+  def test_max_metres(self):
+    index=GridIndex()
+    index.insert('near', 51.5, -0.1)
+    index.insert('far', 55.9, -3.2)
+    self.assertEqual(['near'], [k for d, k in index.nearest(51.51, -0.1, 2,
+                                                             max_metres=5000)])
+    self.assertEqual(['near', 'far'], [k for d, k in index.nearest(51.51, -0.1, 2)])
+
+  def test_remove_and_move(self):
+    index=GridIndex()
+    index.insert('a', 51.5, -0.1)
+    index.insert('b', 52.5, -0.1)
+    index.insert('a', 53.5, -0.1)
+    self.assertEqual('b', index.nearest(51.5, -0.1)[0][1])
+    index.remove('b')
+    self.assertEqual(['a'], [k for d, k in index.nearest(51.5, -0.1, 3)])
+
+
+class TestCentroidDistance(TestCase):
+  def setUp(self):
+    self.source=CentroidDistance({'TW11': (51.4266, -0.3318),
+                                  'NW1': (51.5337, -0.1432),
+                                  'NW1 2DB': (51.5300, -0.1250),
+                                  '90210': (34.1030, -118.4105)},
+                                 road_factor=1.5)
+
+  def test_distance(self):
+    distance=self.source.distance({'postcode': 'TW11 9BC', 'country': 'UK'},
+                                  {'postcode': 'NW1 5AB', 'country': 'UK'})
+    self.assertAlmostEqual(1.5*great_circle_metres(51.4266, -0.3318,
+                                                   51.5337, -0.1432),
+                           distance.dist_value)
+    self.assertEqual('16.5 mi', distance.dist_text)
+
+  def test_full_postcode_preferred(self):
+    self.assertEqual((51.5300, -0.1250),
+                     self.source.locate({'postcode': 'NW1 2DB', 'country': 'UK'}))
+
+  def test_bulk_matches_single(self):
+    origins=[{'postcode': 'TW11 9BC', 'country': 'UK'},
+             {'postcode': 'NW1 2DB', 'country': 'UK'}]
+    destinations=[{'postcode': 'NW1 5AB', 'country': 'UK'},
+                  {'postcode': 'TW11 1AA', 'country': 'UK'}]
+    for single, bulk in zip(map(self.source.distance, origins, destinations),
+                            self.source.distance_many(origins, destinations)):
+      self.assertAlmostEqual(single.dist_value, bulk.dist_value)
+      self.assertEqual(single.time_text, bulk.time_text)
+
+  def test_unknown_postcode_prices_as_not_found(self):
+    pricer=Pricer(FlatRateDistanceRateBook(self.source, 200))
+    self.assertEqual('destination postcode not found',
+                     pricer.quote({'origin': {'postcode': 'TW11 9BC', 'country': 'UK'},
+                                   'destination': {'postcode': 'E1 6AN', 'country': 'UK'}})['reason'])
+
+
+if __name__=='__main__':
+  main()
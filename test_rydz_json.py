@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+import json
+from unittest import TestCase, main, skipIf
+from datetime import datetime
+import rydz_json
+
+class TestDumps(TestCase):
+  def setUp(self):
+    self.booking={'_id': 1,
+                  'pickup_time': datetime(2017, 9, 15, 15, 30),
+                  'passengers': ['a.passenger@acompany.com'],
+                  'quoted_price': 65.25}
+
+  def test_backends_agree(self):
+    for name, dumps in rydz_json.backends.items():
+      encoded=dumps(self.booking)
+      self.assertIsInstance(encoded, bytes)
+      self.assertEqual({'_id': 1, 'pickup_time': '2017-09-15 15:30',
+                        'passengers': ['a.passenger@acompany.com'],
+                        'quoted_price': 65.25},
+                       json.loads(encoded), name)
+
+  @skipIf(rydz_json.ObjectId is None, 'bson not installed')
+  def test_object_id(self):
+    oid=rydz_json.ObjectId('59bbf2e1c3d4a1b2c3d4e5f6')
+    for name, dumps in rydz_json.backends.items():
+      self.assertEqual(b'{"_id":"59bbf2e1c3d4a1b2c3d4e5f6"}', dumps({'_id': oid}), name)
+
+  def test_unknown_type(self):
+    for name, dumps in rydz_json.backends.items():
+      with self.assertRaises(TypeError):
+        dumps({'x': object()})
+
+  def test_use_backend(self):
+    previous=rydz_json.backend
+    try:
+      self.assertIs(rydz_json.dumps_stdlib, rydz_json.use_backend('stdlib'))
+      self.assertIs(rydz_json.dumps_stdlib, rydz_json.dumps)
+    finally:
+      rydz_json.use_backend(previous)
+
+
+if __name__=='__main__':
+  main()
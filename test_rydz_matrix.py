@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from unittest.mock import MagicMock
+from rydz import DistanceSource, Distance, PostcodeRateBook
+from rydz_geo import CentroidDistance
+from rydz_matrix import build_matrix, DistanceMatrix, MatrixDistanceSource, \
+  ratebook_areas, MatrixFileException
+
+class FlakyDistance(DistanceSource):
+  def __init__(self, source, fail_area=None):
+    self.source=source
+    self.fail_area=fail_area
+    self.calls=0
+
+  def distance(self, origin, destination):
+    self.calls+=1
+    if destination['postcode']==self.fail_area:
+      raise KeyError(self.fail_area)
+    return self.source.distance(origin, destination)
+
+
+class TestBuildMatrix(TestCase):
+  def setUp(self):
+    self.directory=tempfile.mkdtemp()
+    self.path=os.path.join(self.directory, 'areas.matrix')
+    self.centroids=CentroidDistance({'TW11': (51.4266, -0.3318),
+                                     'NW1': (51.5337, -0.1432),
+                                     'RM14': (51.5590, 0.2470)})
+    self.areas=ratebook_areas(PostcodeRateBook({'TW11': {'NW1': 22.5},
+                                                'NW1': {'RM14': 52.5}}))
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_matrix_matches_source(self):
+    build_matrix(self.areas, self.centroids, self.path, concurrency=2)
+    source=MatrixDistanceSource(DistanceMatrix.load(self.path))
+    origin={'postcode': 'TW11 9BC', 'country': 'UK'}
+    destination={'postcode': 'RM14 2QY', 'country': 'UK'}
+    self.assertEqual(self.centroids.distance(origin, destination),
+                     source.distance(origin, destination))
+    with self.assertRaises(KeyError):
+      source.distance(origin, {'postcode': 'E1 6AN', 'country': 'UK'})
+
+  def test_resume_only_fills_missing_rows(self):
+    flaky=FlakyDistance(self.centroids, fail_area='RM14')
+    matrix=build_matrix(self.areas, flaky, self.path)
+    self.assertEqual([0, 0, 0], list(matrix.done))
+    self.assertIsNotNone(matrix.lookup('TW11', 'NW1'))
+    self.assertIsNone(matrix.lookup('TW11', 'RM14'))
+    flaky.fail_area=None
+    flaky.calls=0
+    matrix=build_matrix(self.areas, flaky, self.path)
+    self.assertEqual([1, 1, 1], list(matrix.done))
+    self.assertEqual(9, flaky.calls)
+    flaky.calls=0
+    build_matrix(self.areas, flaky, self.path)
+    self.assertEqual(0, flaky.calls)
+
+  def test_rejects_different_areas(self):
+    build_matrix(self.areas, self.centroids, self.path)
+    with self.assertRaises(MatrixFileException):
+      build_matrix(['TW11'], self.centroids, self.path)
+
+  def test_falls_back_for_missing_pairs(self):
+    fallback=MagicMock(DistanceSource)
+    fallback.distance=MagicMock(return_value=Distance('1 mi', 1609, '3 mins', 180))
+    source=MatrixDistanceSource(DistanceMatrix(['TW11']), fallback)
+    self.assertEqual(Distance('1 mi', 1609, '3 mins', 180),
+                     source.distance({'postcode': 'TW11 1AB', 'country': 'UK'},
+                                     {'postcode': 'TW11 2CD', 'country': 'UK'}))
+    self.assertEqual(1, source.fallbacks)
+
+
+if __name__=='__main__':
+  main()
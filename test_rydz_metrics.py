@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+from unittest import TestCase, main
+from rydz import add_booking
+from rydz_metrics import Metrics, metrics, null_timer
+from test_rydz import MockMongoCollection
+
+class TestMetrics(TestCase):
+  def test_disabled_records_nothing(self):
+    m=Metrics()
+    self.assertIs(null_timer, m.timer('t', stage='x'))
+    m.inc('c')
+    m.observe('h', 0.1)
+    self.assertEqual('\n', m.render())
+
+  def test_render(self):
+    m=Metrics(enabled=True)
+    m.inc('rydz_requests_total', route='/quote', status=200)
+    m.inc('rydz_requests_total', route='/quote', status=200)
+    m.observe('rydz_stage_seconds', 0.003, stage='price')
+    m.observe('rydz_stage_seconds', 7, stage='price')
+    text=m.render().splitlines()
+    self.assertIn('# TYPE rydz_requests_total counter', text)
+    self.assertIn('rydz_requests_total{route="/quote",status="200"} 2', text)
+    self.assertIn('rydz_stage_seconds_bucket{stage="price",le="0.0025"} 0', text)
+    self.assertIn('rydz_stage_seconds_bucket{stage="price",le="0.005"} 1', text)
+    self.assertIn('rydz_stage_seconds_bucket{stage="price",le="5.0"} 1', text)
+    self.assertIn('rydz_stage_seconds_bucket{stage="price",le="+Inf"} 2', text)
+    self.assertIn('rydz_stage_seconds_count{stage="price"} 2', text)
+
+
+class TestBookingStages(TestCase):
+  def setUp(self):
+    metrics.enabled=True
+    metrics.reset()
+
+  def tearDown(self):
+    metrics.enabled=False
+    metrics.reset()
+
+  def test_add_booking_stages(self):
+    add_booking(MockMongoCollection(),
+                {'origin': {'number': '55', 'street': 'Kingston Road',
+                            'town': 'Teddington', 'postcode': 'TW11 9JJ',
+                            'country': 'UK'},
+                 'destination': {'number': '14', 'street': 'Fairfield Avenue',
+                                 'town': 'Upminster', 'postcode': 'RM14 3QY',
+                                 'country': 'UK'},
+                 'pickup_time': '2017-09-15 15:30',
+                 'passengers': ['a.passenger@acompany.com'],
+                 'booker': 'a.booker@acompany.com'})
+    stages={dict(labels)['stage']: histogram.count
+            for (name, labels), histogram in metrics.histograms.items()}
+    self.assertEqual({'validate': 1, 'insert': 1}, stages)
+
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+from datetime import datetime
+from unittest import TestCase, main, skipIf
+from rydz import FlatRateDistanceRateBook, PostcodeRateBook, CompiledPostcodeRateBook
+from rydz_geo import CentroidDistance
+from rydz_pool import Pooler, DestinationIndex, bucket_bookings, pending_pools
+try:
+  import mongomock
+except ImportError:
+  mongomock=None
+
+def address(postcode):
+  return {'postcode': postcode, 'country': 'UK'}
+
+def booking(booking_id, origin, destination, pickup_time='2017-09-15 15:30',
+            passengers=1):
+  return {'_id': booking_id, 'origin': address(origin),
+          'destination': address(destination), 'pickup_time': pickup_time,
+          'passengers': ['p']*passengers}
+
+
+class TestPooler(TestCase):
+  def setUp(self):
+    self.source=CentroidDistance({'TW11': (51.4266, -0.3318),
+                                  'TW11 9AA': (51.4270, -0.3300),
+                                  'NW1': (51.5337, -0.1432),
+                                  'NW1 2DB': (51.5300, -0.1250),
+                                  'NW3': (51.5530, -0.1700),
+                                  'RM14': (51.5590, 0.2470)})
+    self.pooler=Pooler(FlatRateDistanceRateBook(self.source, 200), self.source)
+
+  def test_buckets(self):
+    buckets, unpooled=bucket_bookings([booking(1, 'TW11 1AB', 'NW1 1AA'),
+                                       booking(2, 'TW11 9AA', 'NW3 1AA', '2017-09-15 15:44'),
+                                       booking(3, 'TW11 9AA', 'NW3 1AA', '2017-09-15 15:45'),
+                                       dict(booking(4, 'TW11 9AA', 'NW1 1AA'), pickup_time='soon')])
+    self.assertEqual([[1, 2], [3]], [[b['_id'] for b in buckets[key]]
+                                     for key in sorted(buckets)])
+    self.assertEqual([4], [b['_id'] for b in unpooled])
+
+  def test_pools_nearby_destinations(self):
+    proposals=self.pooler.propose([booking(1, 'TW11 1AB', 'NW1 2DB'),
+                                   booking(2, 'TW11 9AA', 'NW1 5AB'),
+                                   booking(3, 'TW11 9AA', 'RM14 2QY')])
+    self.assertEqual(1, len(proposals))
+    proposal=proposals[0]
+    self.assertEqual([1, 2], sorted(proposal['bookings']))
+    self.assertEqual(2, proposal['passengers'])
+    self.assertEqual('TW11', proposal['origin_area'])
+    self.assertEqual(['pickup', 'pickup', 'dropoff', 'dropoff'],
+                     [kind for kind, booking_id in proposal['route']])
+    self.assertLess(proposal['price'], proposal['separate_price'])
+    self.assertAlmostEqual(proposal['price'], sum(proposal['shares'].values()))
+    self.assertTrue(all(d<=1.5 for d in proposal['detours'].values()))
+
+  def test_capacity(self):
+    self.assertEqual([], self.pooler.propose([booking(1, 'TW11 1AB', 'NW1 2DB', passengers=3),
+                                              booking(2, 'TW11 9AA', 'NW1 5AB', passengers=2)]))
+
+  def test_detour_limit(self):
+    pooler=Pooler(FlatRateDistanceRateBook(self.source, 200), self.source,
+                  max_detour=1.01, max_spread_metres=20000)
+    self.assertEqual([], pooler.propose([booking(1, 'TW11 1AB', 'NW1 2DB'),
+                                         booking(2, 'TW11 9AA', 'NW3 5AB')]))
+
+  def test_other_windows_not_compared(self):
+    self.assertEqual([], self.pooler.propose([booking(1, 'TW11 1AB', 'NW1 2DB'),
+                                              booking(2, 'TW11 9AA', 'NW1 5AB',
+                                                      '2017-09-15 15:45')]))
+    self.assertEqual(0, self.pooler.comparisons)
+
+  def test_area_index_without_locator(self):
+    bookings=[booking(1, 'TW11 1AB', 'NW1 2DB'), booking(2, 'TW11 9AA', 'RM14 2QY'),
+              booking(3, 'TW11 9AA', 'NW1 5AB')]
+    index=DestinationIndex(bookings)
+    self.assertEqual([2], index.candidates(0))
+    self.assertEqual([], index.candidates(1))
+    index.remove(2)
+    self.assertEqual([], index.candidates(0))
+
+  def test_unpriceable_legs_not_proposed(self):
+    # the rate book has no price for the pickup leg within TW11
+    for ratebook in [PostcodeRateBook({'TW11': {'NW1': 40.0}}),
+                     CompiledPostcodeRateBook({'TW11': {'NW1': 40.0}})]:
+      pooler=Pooler(ratebook, self.source)
+      self.assertEqual([], pooler.propose([booking(1, 'TW11 1AB', 'NW1 2DB'),
+                                           booking(2, 'TW11 9AA', 'NW1 5AB')]))
+
+
+@skipIf(mongomock is None, 'mongomock not installed')
+class TestPendingPools(TestCase):
+  def test_only_unassigned_bookings(self):
+    source=CentroidDistance({'TW11': (51.4266, -0.3318), 'NW1': (51.5337, -0.1432)})
+    bookings=mongomock.MongoClient().db.bookings
+    pickup_time=datetime(2017, 9, 15, 15, 30)
+    bookings.insert_many([dict(booking(i, 'TW11 1AB', 'NW1 2DB'), pickup_time=pickup_time)
+                          for i in range(3)])
+    bookings.update_one({'_id': 2}, {'$set': {'driver_id': 'd1'}})
+    proposals=pending_pools(bookings, Pooler(FlatRateDistanceRateBook(source, 200), source))
+    self.assertEqual([[0, 1]], [sorted(p['bookings']) for p in proposals])
+
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+from rydz import Pricer, PostcodeRateBook
+from rydz_ratefile import compile_rate_file, load_rate_file, write_rate_file, \
+  RateBookReloader, RateFileException
+from rydz import CompiledPostcodeRateBook
+
+class TestRateFile(TestCase):
+  def setUp(self):
+    self.directory=tempfile.mkdtemp()
+    self.csv_path=os.path.join(self.directory, 'rates.csv')
+    with open(self.csv_path, 'w') as rates:
+      rates.write('origin,destination,price\n'
+                  'TW11,NW1,22.5\n'
+                  'TW11,RM14,65.25\n'
+                  'NW1,TW11,23.25\n')
+    self.path=os.path.join(self.directory, 'rates.bin')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def journey(self, origin, destination):
+    return {'origin': {'postcode': origin, 'country': 'UK'},
+            'destination': {'postcode': destination, 'country': 'UK'}}
+
+  def test_round_trip_matches_source(self):
+    compile_rate_file(self.csv_path, self.path)
+    loaded=Pricer(load_rate_file(self.path))
+    plain=Pricer(PostcodeRateBook({'TW11': {'NW1': 22.5, 'RM14': 65.25},
+                                   'NW1': {'TW11': 23.25}}))
+    for o, d in [('TW11 1AB', 'RM14 2CD'), ('NW1 1AB', 'TW11 2CD'),
+                 ('RM14 1AB', 'TW11 2CD'), ('NW1 1AB', 'RM14 2CD')]:
+      self.assertEqual(plain.quote(self.journey(o, d)),
+                       loaded.quote(self.journey(o, d)))
+
+  def test_set_price_copies_mapped_rates(self):
+    compile_rate_file(self.csv_path, self.path)
+    ratebook=load_rate_file(self.path)
+    ratebook.set_price('TW11', 'NW1', 30.0)
+    ratebook.set_price('NW1', 'TW11', 24.0)
+    self.assertEqual(2, ratebook.version)
+    self.assertEqual({'TW11': {'NW1': 30.0, 'RM14': 65.25}, 'NW1': {'TW11': 24.0}},
+                     ratebook.postcode_map())
+    # the file itself is left as it was
+    self.assertEqual(22.5, load_rate_file(self.path).area_price('TW11', 'NW1'))
+
+  def test_rejects_other_files(self):
+    with open(self.path, 'wb') as out:
+      out.write(b'not a rate file at all, honest')
+    with self.assertRaises(RateFileException):
+      load_rate_file(self.path)
+
+  def test_reload_swaps_rate_book(self):
+    compile_rate_file(self.csv_path, self.path)
+    pricer=Pricer(PostcodeRateBook({}), cache_size=10)
+    reloader=RateBookReloader(pricer, self.path)
+    self.assertTrue(reloader.check())
+    self.assertFalse(reloader.check())
+    old=pricer.ratebook
+    self.assertEqual(22.5, pricer.quote(self.journey('TW11 1AB', 'NW1 2CD'))['price'])
+    write_rate_file(CompiledPostcodeRateBook({'TW11': {'NW1': 30.0}}), self.path)
+    self.assertTrue(reloader.check())
+    self.assertEqual(30.0, pricer.quote(self.journey('TW11 1AB', 'NW1 2CD'))['price'])
+    # a quote holding the old book still prices from it
+    self.assertEqual(22.5, old.price({'postcode': 'TW11 1AB', 'country': 'UK'},
+                                     {'postcode': 'NW1 2CD', 'country': 'UK'}))
+    self.assertEqual(2, reloader.reloads)
+
+
+if __name__=='__main__':
+  main()
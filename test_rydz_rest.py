@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+import json
+from types import SimpleNamespace
+from unittest import TestCase, main, skipIf
+try:
+  import mongomock
+  import rydz_rest
+  from rydz import BookingCache
+  from rydz_metrics import metrics
+except ImportError:
+  mongomock=None
+
+def journey(origin, destination):
+  return {'origin': {'postcode': origin, 'country': 'UK'},
+          'destination': {'postcode': destination, 'country': 'UK'}}
+
+def booking(origin, destination, pickup_time, booker='b@acompany.com'):
+  return {'origin': {'number': 55, 'street': 'King Edward Road', 'town': 'Teddington',
+                     'postcode': origin, 'country': 'UK'},
+          'destination': {'number': 14, 'street': 'Forth Road', 'town': 'Upminster',
+                          'postcode': destination, 'country': 'UK'},
+          'pickup_time': pickup_time, 'passengers': ['p@acompany.com'],
+          'booker': booker}
+
+
+@skipIf(mongomock is None, 'flask, flask_pymongo or mongomock not installed')
+class RestTestCase(TestCase):
+  def setUp(self):
+    self.db=mongomock.MongoClient().db
+    self.saved_mongo=rydz_rest.mongo
+    rydz_rest.mongo=SimpleNamespace(db=self.db)
+    rydz_rest.indexes_ensured=False
+    self.client=rydz_rest.app.test_client()
+
+  def tearDown(self):
+    rydz_rest.mongo=self.saved_mongo
+
+  def add(self, *bookings):
+    ids=[]
+    for b in bookings:
+      response=self.client.post('/bookings', json=b)
+      self.assertEqual('OK', response.get_json()['status'])
+      ids.append(response.get_json()['booking']['_id'])
+    return ids
+
+
+class TestQuotes(RestTestCase):
+  def test_bad_journeys_do_not_abort_the_batch(self):
+    response=self.client.post('/quotes', json=[journey('TW11 1AB', 'NW1 2DB'),
+                                               dict(journey('TW11 1AB', 'NW1 2DB'), origin='x'),
+                                               dict(journey('TW11 1AB', 'NW1 2DB'), origin=None),
+                                               journey('TW11 1AB', 5),
+                                               'x',
+                                               journey('TW11 1AB', 'E1 6AN')])
+    self.assertEqual(200, response.status_code)
+    quotes=response.get_json()['quotes']
+    self.assertEqual([('OK', 22.5),
+                      ('ERROR', 'origin address invalid'),
+                      ('ERROR', 'origin address invalid'),
+                      ('ERROR', 'destination address invalid'),
+                      ('ERROR', 'origin and destination required'),
+                      ('ERROR', 'destination postcode not found')],
+                     [(q['status'], q.get('price', q.get('reason'))) for q in quotes])
+
+  def test_journeys_object(self):
+    response=self.client.post('/quotes', json={'journeys': [journey('NW1 2DB', 'RM14 2QY')]})
+    self.assertEqual(52.5, response.get_json()['quotes'][0]['price'])
+
+  def test_body_must_hold_a_list(self):
+    for body in (5, 'abc', {'journeys': 5}, {'journeys': 'abc'}, {}, None):
+      response=self.client.post('/quotes', json=body)
+      self.assertEqual(400, response.status_code, body)
+      self.assertEqual('ERROR', response.get_json()['status'])
+    response=self.client.post('/quotes', data='not json', content_type='application/json')
+    self.assertEqual(400, response.status_code)
+    self.assertEqual([], self.client.post('/quotes', json=[]).get_json()['quotes'])
+
+
+class TestAddBooking(RestTestCase):
+  def test_invalid_or_unpriceable_bookings_are_errors(self):
+    no_origin=booking('TW11 1AB', 'RM14 2QY', '2017-09-15 15:30')
+    del no_origin['origin']
+    bad_postcode=booking('TW11 1AB', 'RM14 2QY', '2017-09-15 15:30')
+    bad_postcode['origin']['postcode']='nonsense'
+    for body, reason in [(booking('TW11 1AB', 'SW1 1AA', '2017-09-15 15:30'),
+                          'destination postcode not found'),
+                         (no_origin, "'origin' missing"),
+                         (booking('TW11 1AB', 'E1 1AB', '2017-09-15 15:30'), None),
+                         (bad_postcode, None),
+                         ('x', 'booking must be an object')]:
+      response=self.client.post('/bookings', json=body)
+      self.assertEqual(200, response.status_code, body)
+      self.assertEqual('ERROR', response.get_json()['status'])
+      if reason is not None:
+        self.assertEqual(reason, response.get_json()['reason'])
+    self.assertEqual(0, self.db.bookings.count_documents({}))
+
+  def test_priced_and_stored(self):
+    response=self.client.post('/bookings', json=booking('TW11 1AB', 'RM14 2QY',
+                                                        '2017-09-15 15:30')).get_json()
+    self.assertEqual(('OK', 65.25), (response['status'], response['booking']['quoted_price']))
+    self.assertEqual(65.25, self.db.bookings.find_one()['quoted_price'])
+
+
+class TestIndexes(RestTestCase):
+  def test_first_bookings_request_provisions_indexes(self):
+    self.client.post('/quotes', json=[journey('TW11 1AB', 'NW1 2DB')])
+    self.assertNotIn('bookings', self.db.list_collection_names())
+    self.client.get('/bookings')
+    keys=[index['key'] for index in self.db.bookings.index_information().values()]
+    self.assertIn([('booker', 1), ('pickup_time', 1)], keys)
+    self.assertTrue(rydz_rest.indexes_ensured)
+
+
+class TestListBookings(RestTestCase):
+  def setUp(self):
+    super().setUp()
+    self.ids=self.add(booking('TW11 1AB', 'RM14 2QY', '2017-09-15 15:30'),
+                      booking('NW1 2DB', 'RM14 2QY', '2017-09-15 09:00', 'c@acompany.com'),
+                      booking('TW11 1AB', 'NW1 2DB', '2017-09-16 10:00'),
+                      booking('RM14 2QY', 'NW1 2DB', '2017-09-15 15:30'))
+
+  def test_pages_in_pickup_order(self):
+    seen=[]
+    after=None
+    while True:
+      query={'limit': 3}
+      if after:
+        query['after']=after
+      page=self.client.get('/bookings', query_string=query).get_json()
+      self.assertEqual('OK', page['status'])
+      seen.extend(b['pickup_time'] for b in page['bookings'])
+      after=page['next']
+      if after is None:
+        break
+    self.assertEqual(['2017-09-15 09:00', '2017-09-15 15:30', '2017-09-15 15:30',
+                      '2017-09-16 10:00'], seen)
+
+  def test_filters_and_fields(self):
+    page=self.client.get('/bookings', query_string={'from': '2017-09-15 10:00',
+                                                    'to': '2017-09-16',
+                                                    'booker': 'b@acompany.com',
+                                                    'fields': 'quoted_price'}).get_json()
+    self.assertEqual([{'pickup_time': '2017-09-15 15:30', 'quoted_price': 65.25},
+                      {'pickup_time': '2017-09-15 15:30', 'quoted_price': 62.5}],
+                     [{k: v for k, v in b.items() if k!='_id'} for b in page['bookings']])
+    self.assertIsNone(page['next'])
+
+  def test_stream(self):
+    response=self.client.get('/bookings', query_string={'stream': 1, 'to': '2017-09-16'})
+    self.assertEqual('application/x-ndjson', response.mimetype)
+    lines=[json.loads(line) for line in response.data.splitlines()]
+    self.assertEqual(['2017-09-15 09:00', '2017-09-15 15:30', '2017-09-15 15:30'],
+                     [b['pickup_time'] for b in lines])
+
+  def test_malformed_bounds_are_bad_requests(self):
+    for query in ({'after': 'yesterday|1'}, {'after': 'nonsense'},
+                  {'from': 'soon'}, {'to': '2017-13-45'}):
+      response=self.client.get('/bookings', query_string=query)
+      self.assertEqual(400, response.status_code, query)
+      self.assertEqual('ERROR', response.get_json()['status'])
+
+
+class TestBulkImport(RestTestCase):
+  def test_results_per_line(self):
+    lines=[json.dumps(booking('TW11 1AB', 'RM14 2QY', '2017-09-15 15:30')),
+           '{not json',
+           json.dumps(dict(booking('TW11 1AB', 'RM14 2QY', '2017-09-15 15:30'), origin=5)),
+           json.dumps(booking('NW1 2DB', 'RM14 2QY', '2017-09-15 16:00')),
+           json.dumps(booking('E1 6AN', 'RM14 2QY', '2017-09-15 16:00'))]
+    response=self.client.post('/bookings/bulk?batch_size=2',
+                              data='\n'.join(lines)+'\n',
+                              content_type='application/x-ndjson')
+    self.assertEqual(200, response.status_code)
+    self.assertEqual('application/x-ndjson', response.mimetype)
+    results=[json.loads(line) for line in response.data.splitlines()]
+    self.assertEqual([(1, 'OK'), (2, 'ERROR'), (3, 'ERROR'), (4, 'OK'), (5, 'ERROR')],
+                     [(r['line'], r['status']) for r in results])
+    self.assertEqual('address must be an object', results[2]['reason'])
+    self.assertEqual([65.25, 52.5], [b['quoted_price'] for b in
+                                     self.db.bookings.find().sort('pickup_time')])
+
+
+class TestGetBooking(RestTestCase):
+  def check_conditional_get(self):
+    booking_id=self.add(booking('TW11 1AB', 'RM14 2QY', '2017-09-15 15:30'))[0]
+    response=self.client.get('/bookings/{}'.format(booking_id))
+    self.assertEqual(200, response.status_code)
+    self.assertEqual(65.25, response.get_json()['booking']['quoted_price'])
+    etag=response.headers['ETag']
+    response=self.client.get('/bookings/{}'.format(booking_id),
+                             headers={'If-None-Match': etag})
+    self.assertEqual(304, response.status_code)
+    self.assertEqual(etag, response.headers['ETag'])
+    self.assertEqual(b'', response.data)
+    # a change through the API is seen by the next poll
+    self.client.put('/bookings/{}'.format(booking_id), json={'booker': 'c@acompany.com'})
+    response=self.client.get('/bookings/{}'.format(booking_id),
+                             headers={'If-None-Match': etag})
+    self.assertEqual(200, response.status_code)
+    self.assertNotEqual(etag, response.headers['ETag'])
+    self.assertEqual('c@acompany.com', response.get_json()['booking']['booker'])
+
+  def test_conditional_get(self):
+    self.check_conditional_get()
+
+  def test_conditional_get_cached(self):
+    saved_cache=rydz_rest.booking_cache
+    rydz_rest.booking_cache=BookingCache(self.db.bookings, max_size=10, ttl=60,
+                                         encode=rydz_rest.encode_booking)
+    try:
+      self.check_conditional_get()
+    finally:
+      rydz_rest.booking_cache=saved_cache
+
+  def test_unknown_booking(self):
+    response=self.client.get('/bookings/59bbb2f9a7b11b1fcc1b8e45')
+    self.assertEqual('ERROR', response.get_json()['status'])
+
+
+class TestChangeBooking(RestTestCase):
+  def setUp(self):
+    super().setUp()
+    self.url='/bookings/{}'.format(self.add(booking('TW11 1AB', 'RM14 2QY',
+                                                    '2017-09-15 15:30'))[0])
+
+  def test_put_reprices(self):
+    response=self.client.put(self.url, json={'destination': {
+      'number': 1, 'street': 'Euston Road', 'town': 'London',
+      'postcode': 'NW1 2DB', 'country': 'UK'}})
+    booking=response.get_json()['booking']
+    self.assertEqual((22.5, 'NW1'), (booking['quoted_price'], booking['destination_area']))
+    self.assertEqual('King Edward Road', booking['origin']['street'])
+
+  def test_put_rejects_bad_changes(self):
+    for changes in ({'origin': 5}, [1], {'pickup_time': 'soon'}):
+      response=self.client.put(self.url, json=changes)
+      self.assertEqual('ERROR', response.get_json()['status'], changes)
+    self.assertEqual(65.25, self.client.get(self.url).get_json()['booking']['quoted_price'])
+
+  def test_delete(self):
+    self.assertEqual('OK', self.client.delete(self.url).get_json()['status'])
+    self.assertEqual('ERROR', self.client.delete(self.url).get_json()['status'])
+    self.assertEqual(0, self.db.bookings.count_documents({}))
+
+
+class TestMetrics(RestTestCase):
+  def tearDown(self):
+    metrics.enabled=False
+    metrics.reset()
+    super().tearDown()
+
+  def test_disabled(self):
+    self.assertEqual(404, self.client.get('/metrics').status_code)
+
+  def test_counts_requests_and_stages(self):
+    metrics.enabled=True
+    metrics.reset()
+    self.client.post('/quotes', json=[journey('TW11 1AB', 'NW1 2DB')])
+    self.add(booking('TW11 1AB', 'RM14 2QY', '2017-09-15 15:30'))
+    response=self.client.get('/metrics')
+    self.assertEqual(200, response.status_code)
+    text=response.get_data(as_text=True)
+    self.assertIn('rydz_requests_total{method="POST",route="/quotes",status="200"} 1', text)
+    self.assertIn('rydz_requests_total{method="POST",route="/bookings",status="200"} 1', text)
+    self.assertIn('rydz_stage_seconds_count{stage="price"} 1', text)
+    self.assertIn('rydz_stage_seconds_count{stage="insert"} 1', text)
+
+
+if __name__=='__main__':
+  main()